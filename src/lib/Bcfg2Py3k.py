@@ -13,6 +13,7 @@ try:
     from urllib2 import build_opener
     from urllib2 import install_opener
     from urllib2 import urlopen
+    from urllib2 import Request
     from urllib2 import HTTPError
 except ImportError:
     from urllib.parse import urljoin, urlparse
@@ -21,6 +22,7 @@ except ImportError:
     from urllib.request import build_opener
     from urllib.request import install_opener
     from urllib.request import urlopen
+    from urllib.request import Request
     from urllib.error import HTTPError
 
 try:
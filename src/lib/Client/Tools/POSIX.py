@@ -17,6 +17,12 @@ import time
 if sys.hexversion >= 0x03000000:
     unicode = str
 
+# FIXME: Remove when client python dep is 2.5 or greater
+if sys.version_info >= (2, 5):
+    from hashlib import sha1
+else:
+    from sha import sha as sha1
+
 import Bcfg2.Client.Tools
 import Bcfg2.Options
 from Bcfg2.Client import XML
@@ -93,6 +99,81 @@ def isString(strng, encoding):
         return False
 
 
+class DigestCache(object):
+    """Digests of local files, kept in a file between runs.  A digest
+    is used until the inode, mtime or size of its file changes."""
+
+    def __init__(self, filename=None):
+        object.__init__(self)
+        self.filename = filename
+        # path -> (inode, mtime, size, digest)
+        self.digests = {}
+        self.dirty = False
+        if filename and os.path.exists(filename):
+            try:
+                for line in open(filename):
+                    (inode, mtime, size, digest, path) = \
+                            line.rstrip('\n').split(' ', 4)
+                    self.digests[path] = (int(inode), float(mtime),
+                                          int(size), digest)
+            except (IOError, ValueError):
+                err = sys.exc_info()[1]
+                log.error("Failed to read digest cache %s: %s" %
+                          (filename, err))
+                self.digests = {}
+
+    def digest(self, path):
+        """Return the sha1 digest of a regular file, or None for any
+        other type of file.  Raises OSError or IOError."""
+        ondisk = os.stat(path)
+        if not stat.S_ISREG(ondisk.st_mode):
+            return None
+        key = (ondisk.st_ino, ondisk.st_mtime, ondisk.st_size)
+        cached = self.digests.get(path)
+        if cached is not None and cached[:3] == key:
+            return cached[3]
+        digest = sha1()
+        datafile = open(path, 'rb')
+        try:
+            while True:
+                chunk = datafile.read(65536)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        finally:
+            datafile.close()
+        digest = digest.hexdigest()
+        after = os.stat(path)
+        # a file changed within the resolution of its mtime could look
+        # unchanged later, so recently modified files are not cached
+        if ((after.st_ino, after.st_mtime, after.st_size) == key and
+            time.time() - ondisk.st_mtime > 2 and '\n' not in path):
+            self.digests[path] = key + (digest,)
+            self.dirty = True
+        return digest
+
+    def save(self):
+        """Write the cache to its file if it has changed."""
+        if not self.filename or not self.dirty:
+            return
+        try:
+            dirname = os.path.dirname(self.filename)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            cachefile = open("%s.new" % self.filename, 'w')
+            for (path, (inode, mtime, size, digest)) in self.digests.items():
+                cachefile.write("%d %r %d %s %s\n" %
+                                (inode, mtime, size, digest, path))
+            cachefile.close()
+            os.chmod(cachefile.name, stat.S_IRUSR | stat.S_IWUSR)
+            os.rename(cachefile.name, self.filename)
+            self.dirty = False
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            log.error("Failed to write digest cache %s: %s" %
+                      (self.filename, err))
+
+
 class POSIX(Bcfg2.Client.Tools.Tool):
     """POSIX File support code."""
     name = 'POSIX'
@@ -107,11 +188,21 @@ class POSIX(Bcfg2.Client.Tools.Tool):
 
     # grab paranoid options from /etc/bcfg2.conf
     opts = {'ppath': Bcfg2.Options.PARANOID_PATH,
-            'max_copies': Bcfg2.Options.PARANOID_MAX_COPIES}
+            'max_copies': Bcfg2.Options.PARANOID_MAX_COPIES,
+            'digest_cache': Bcfg2.Options.POSIX_DIGEST_CACHE}
     setup = Bcfg2.Options.OptionParser(opts)
     setup.parse([])
     ppath = setup['ppath']
     max_copies = setup['max_copies']
+    digest_cache = setup['digest_cache']
+
+    def __init__(self, logger, setup, config):
+        Bcfg2.Client.Tools.Tool.__init__(self, logger, setup, config)
+        self.digests = DigestCache(self.digest_cache)
+
+    def Inventory(self, states, structures=[]):
+        Bcfg2.Client.Tools.Tool.Inventory(self, states, structures)
+        self.digests.save()
 
     def canInstall(self, entry):
         """Check if entry is complete for installation."""
@@ -449,6 +540,10 @@ class POSIX(Bcfg2.Client.Tools.Tool):
             self.logger.error("Cannot verify incomplete Path type='%s' %s" %
                               (entry.get('type'), entry.get('name')))
             return False
+        if self._content_unchanged(entry):
+            # neither the entry nor the file needs to be read
+            self._prompt_permissions(entry, permissionStatus)
+            return permissionStatus
         if entry.get('encoding', 'ascii') == 'base64':
             tempdata = binascii.a2b_base64(entry.text)
             tbin = True
@@ -560,14 +655,30 @@ class POSIX(Bcfg2.Client.Tools.Tool):
                                   binascii.b2a_base64("\n".join(diff)))
                     elif not tbin and isString(content, self.setup['encoding']):
                         entry.set('current_bfile', binascii.b2a_base64(content))
-        elif permissionStatus == False and self.setup['interactive']:
+        else:
+            self._prompt_permissions(entry, permissionStatus)
+
+        return permissionStatus and not different
+
+    def _prompt_permissions(self, entry, permissionStatus):
+        """Ask whether to install a Path type='file' entry whose
+        content is right but whose permissions are not."""
+        if permissionStatus == False and self.setup['interactive']:
             prompt = [entry.get('qtext', '')]
             prompt.append("Install %s %s: (y/N): " % (entry.tag,
                                                       entry.get('name')))
             entry.set("qtext", "\n".join(prompt))
 
-
-        return permissionStatus and not different
+    def _content_unchanged(self, entry):
+        """Return True if the server sent the digest of the content of
+        a Path type='file' entry, and the file has that digest."""
+        if not entry.get('sha1'):
+            return False
+        try:
+            return self.digests.digest(entry.get('name')) == entry.get('sha1')
+        except (IOError, OSError):
+            # the full comparison reports missing and unreadable files
+            return False
 
     def Installfile(self, entry):
         """Install Path type='file' entry."""
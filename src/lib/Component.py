@@ -2,12 +2,15 @@
 
 __revision__ = '$Revision$'
 
-__all__ = ["Component", "exposed", "automatic", "run_component"]
+__all__ = ["Component", "exposed", "automatic", "run_component",
+           "WorkerSupervisor"]
 
+import errno
 import inspect
 import logging
 import os
 import pydoc
+import signal
 import sys
 import time
 import threading
@@ -26,7 +29,8 @@ class NoExposedMethod (Exception):
 def run_component(component_cls, listen_all, location, daemon, pidfile_name,
                   to_file, cfile, argv=None, register=True,
                   state_name=False, cls_kwargs={}, extra_getopt='', time_out=10,
-                  protocol='xmlrpc/ssl', certfile=None, keyfile=None, ca=None):
+                  protocol='xmlrpc/ssl', certfile=None, keyfile=None, ca=None,
+                  workers=1):
 
     # default settings
     level = logging.INFO
@@ -60,7 +64,8 @@ def run_component(component_cls, listen_all, location, daemon, pidfile_name,
         fprint(os.getpid(), pidfile)
         pidfile.close()
 
-    component = component_cls(cfile=cfile, **cls_kwargs)
+    if workers <= 1:
+        component = component_cls(cfile=cfile, **cls_kwargs)
     up = urlparse(location)
     port = tuple(up[1].split(':'))
     port = (port[0], int(port[1]))
@@ -76,6 +81,21 @@ def run_component(component_cls, listen_all, location, daemon, pidfile_name,
     except:
         logger.error("Server startup failed")
         os._exit(1)
+
+    if workers > 1:
+        def serve(worker):
+            component = component_cls(cfile=cfile, worker=worker,
+                                      **cls_kwargs)
+            server.register_instance(component)
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+                component.shutdown()
+        WorkerSupervisor(workers, serve).run()
+        server.server_close()
+        return
+
     server.register_instance(component)
 
     try:
@@ -84,6 +104,130 @@ def run_component(component_cls, listen_all, location, daemon, pidfile_name,
         server.server_close()
     component.shutdown()
 
+
+class WorkerSupervisor(object):
+    """Run a number of forked worker processes that accept requests on
+    a listening socket opened before the fork.
+
+    Each worker runs serve(worker) and builds its own component, so
+    workers share no state.  worker is the number of the worker's
+    slot, from 0 to count - 1; a restarted worker takes over the slot
+    of the one it replaces, so it can find files that one left.  No
+    two live workers ever have the same slot.  Workers that die are restarted.  SIGHUP restarts
+    all workers one at a time, which reloads state that file
+    monitoring does not cover; SIGTERM and SIGINT stop them.
+    """
+    # workers that die sooner than this after starting are restarted
+    # with a delay, so that a broken setup does not fork in a loop
+    min_lifetime = 5
+
+    def __init__(self, count, serve):
+        object.__init__(self)
+        self.count = count
+        self.serve = serve
+        # pid -> start time
+        self.workers = {}
+        # pid -> slot
+        self.slots = {}
+        # pids of workers that were asked to exit
+        self.stopping = set()
+        self.running = True
+        self.restart = False
+
+    def start_worker(self, slot):
+        """Fork a worker process for slot."""
+        pid = os.fork()
+        if pid == 0:
+            for signum in [signal.SIGHUP, signal.SIGINT, signal.SIGTERM]:
+                signal.signal(signum, signal.SIG_DFL)
+            status = 0
+            try:
+                try:
+                    self.serve(slot)
+                except:
+                    logger.error("Worker %s failed" % os.getpid(), exc_info=1)
+                    status = 1
+            finally:
+                os._exit(status)
+        self.workers[pid] = time.time()
+        self.slots[pid] = slot
+        logger.info("Started worker %s" % pid)
+        return pid
+
+    def stop_worker(self, pid):
+        """Ask a worker to finish its current requests and exit."""
+        self.stopping.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _handle_stop(self, *_):
+        self.running = False
+
+    def _handle_restart(self, *_):
+        self.restart = True
+
+    def check_workers(self):
+        """Reap exited workers and restart the ones that were not
+        asked to exit."""
+        while self.workers:
+            try:
+                pid = os.waitpid(-1, os.WNOHANG)[0]
+            except OSError:
+                err = sys.exc_info()[1]
+                if err.errno == errno.ECHILD:
+                    self.workers = {}
+                    self.slots = {}
+                break
+            if pid == 0:
+                break
+            if pid not in self.workers:
+                continue
+            started = self.workers.pop(pid)
+            slot = self.slots.pop(pid)
+            if pid in self.stopping:
+                self.stopping.discard(pid)
+                continue
+            logger.error("Worker %s exited; restarting it" % pid)
+            if time.time() - started < self.min_lifetime:
+                time.sleep(self.min_lifetime)
+            if self.running:
+                self.start_worker(slot)
+
+    def restart_workers(self):
+        """Replace each worker in turn with a new one.  The old
+        worker must exit before the new one takes over its slot."""
+        logger.info("Restarting %d workers" % len(self.workers))
+        for pid in list(self.workers.keys()):
+            slot = self.slots[pid]
+            self.stop_worker(pid)
+            while pid in self.workers:
+                time.sleep(0.5)
+                self.check_workers()
+            if self.running:
+                self.start_worker(slot)
+
+    def run(self):
+        """Start the workers and supervise them until told to stop."""
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+        for slot in range(self.count):
+            self.start_worker(slot)
+        while self.running:
+            if self.restart:
+                self.restart = False
+                self.restart_workers()
+            self.check_workers()
+            time.sleep(1)
+        logger.info("Stopping %d workers" % len(self.workers))
+        for pid in list(self.workers.keys()):
+            self.stop_worker(pid)
+        while self.workers:
+            self.check_workers()
+            time.sleep(0.5)
+
 def exposed(func):
     """Mark a method to be exposed publically.
 
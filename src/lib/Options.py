@@ -215,6 +215,10 @@ PARANOID_PATH = Option('Specify path for paranoid file backups',
 PARANOID_MAX_COPIES = Option('Specify the number of paranoid copies you want',
                              default=1, cf=('paranoid', 'max_copies'),
                              odesc='<max paranoid copies>')
+POSIX_DIGEST_CACHE = Option('Specify path for the file digest cache',
+                            default='/var/cache/bcfg2/posix_digests',
+                            cf=('POSIX', 'digest_cache'),
+                            odesc='<digest cache path>')
 OMIT_LOCK_CHECK = Option('Omit lock check', default=False, cmd='-O')
 CORE_PROFILE = Option('profile',
                       default=False, cmd='-p', )
@@ -264,6 +268,18 @@ SERVER_PLUGINS = Option('Server plugin list', cf=('server', 'plugins'),
                         cook=list_split)
 SERVER_MCONNECT = Option('Server Metadata Connector list', cook=list_split,
                          cf=('server', 'connectors'), default=['Probes'], )
+SERVER_CONFIG_CACHE = Option('Cache client configurations until they change',
+                             cf=('server', 'config_cache'), default=False,
+                             cook=get_bool, odesc='True|False')
+SERVER_BIND_THREADS = Option('Number of threads used to bind entries',
+                             cf=('server', 'bind_threads'), default=0,
+                             cook=int, odesc='<number of threads>')
+SERVER_PATH_DIGESTS = Option('Send content digests with Path entries',
+                             cf=('server', 'path_digests'), default=False,
+                             cook=get_bool, odesc='True|False')
+SERVER_WORKERS = Option('Number of server worker processes',
+                        cf=('server', 'workers'), default=1, cook=int,
+                        odesc='<number of processes>')
 SERVER_FILEMONITOR = Option('Server file monitor', cf=('server', 'filemonitor'),
                             default='default', odesc='File monitoring driver')
 SERVER_LISTEN_ALL = Option('Listen on all interfaces',
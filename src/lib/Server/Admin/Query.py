@@ -59,7 +59,7 @@ class Query(Bcfg2.Server.Admin.Mode):
                 # add probed groups (if present)
                 for conn in self.bcore.connectors:
                     if isinstance(conn, Bcfg2.Server.Plugins.Probes.Probes):
-                        for c, glist in list(conn.cgroups.items()):
+                        for c, glist in list(conn.get_client_groups().items()):
                             for g in glist:
                                 if g in v.split(','):
                                     nc.append(c)
@@ -8,7 +8,9 @@ import pickle
 import platform
 import sys
 import traceback
-from Bcfg2.Server.Reports.importscript import load_stats
+from Bcfg2.Server.Plugins.Statistics import load_statistics, statistics_path
+from Bcfg2.Server.Reports.importscript import load_stats, parallel_load_stats
+from Bcfg2.Server.Reports.retention import retain
 from Bcfg2.Server.Reports.updatefix import update_database
 from Bcfg2.Server.Reports.utils import *
 from lxml.etree import XML, XMLSyntaxError
@@ -45,7 +47,7 @@ from django.db import connection, transaction
 
 from Bcfg2.Server.Reports.reports.models import Client, Interaction, Entries, \
                                 Entries_interactions, Performance, \
-                                Reason, Ping
+                                Reason, Ping, ClientSummary
 
 
 def printStats(fn):
@@ -91,10 +93,17 @@ class Reports(Bcfg2.Server.Admin.Mode):
                  "      -s|--stats         Path to statistics.xml file\n"
                  "      -c|--clients-file  Path to clients.xml file\n"
                  "      -O3                Fast mode.  Duplicates data!\n"
+                 "      -j|--jobs [n]      Stream the statistics files into n\n"
+                 "                         worker processes\n"
+                 "      --state [file]     Record imported files in file and\n"
+                 "                         skip them when run again\n"
                  "    purge                Purge records\n"
                  "      --client [n]       Client to operate on\n"
                  "      --days   [n]       Records older then n days\n"
                  "      --expired          Expired clients only\n"
+                 "    retain               Roll up and remove old records\n"
+                 "      --days   [n]       Records older then n days\n"
+                 "      --rollup-days [n]  Daily rollups older then n days\n"
                  "    scrub                Scrub the database for duplicate reasons and orphaned entries\n"
                  "    update               Apply any updates to the reporting database\n"
                  "\n")
@@ -132,20 +141,36 @@ class Reports(Bcfg2.Server.Admin.Mode):
             update_database()
         elif args[0] == 'load_stats':
             quick = '-O3' in args
-            stats_file = None
+            stats_files = []
             clients_file = None
+            jobs = None
+            state_file = None
             i = 1
             while i < len(args):
                 if args[i] == '-s' or args[i] == '--stats':
-                    stats_file = args[i + 1]
-                    if stats_file[0] == '-':
-                        self.errExit("Invalid statistics file: %s" % stats_file)
+                    stats_files.append(args[i + 1])
+                    if stats_files[-1][0] == '-':
+                        self.errExit("Invalid statistics file: %s" %
+                                     stats_files[-1])
                 elif args[i] == '-c' or args[i] == '--clients-file':
                     clients_file = args[i + 1]
                     if clients_file[0] == '-':
                         self.errExit("Invalid clients file: %s" % clients_file)
+                elif args[i] == '-j' or args[i] == '--jobs':
+                    try:
+                        jobs = int(args[i + 1])
+                    except (IndexError, ValueError):
+                        self.errExit("Invalid number of jobs")
+                elif args[i] == '--state':
+                    state_file = args[i + 1]
                 i = i + 1
-            self.load_stats(stats_file, clients_file, verb, quick)
+            if jobs or state_file or len(stats_files) > 1:
+                self.parallel_load_stats(stats_files, clients_file, verb,
+                                         quick, jobs or 1, state_file)
+            elif stats_files:
+                self.load_stats(stats_files[0], clients_file, verb, quick)
+            else:
+                self.load_stats(None, clients_file, verb, quick)
         elif args[0] == 'purge':
             expired = False
             client = None
@@ -178,9 +203,53 @@ class Reports(Bcfg2.Server.Admin.Mode):
                 self.purge_expired(maxdate)
             else:
                 self.purge(client, maxdate, state)
+        elif args[0] == 'retain':
+            days = self.retention_option('retention_days')
+            rollup_days = self.retention_option('rollup_retention_days')
+            i = 1
+            while i < len(args):
+                if args[i] == '--days':
+                    days = self.retention_days(args[i + 1])
+                    i = i + 1
+                elif args[i] == '--rollup-days':
+                    rollup_days = self.retention_days(args[i + 1])
+                    i = i + 1
+                i = i + 1
+            if days is None:
+                self.errExit("Number of days to retain not specified; use "
+                             "--days or set retention_days in the "
+                             "[statistics] section of %s" % self.configfile)
+            self.retain(days, rollup_days)
         else:
             print("Unknown command: %s" % args[0])
 
+    def retention_days(self, value):
+        """Parse a number of days to retain records."""
+        try:
+            days = int(value)
+            if days < 0:
+                raise ValueError
+            return days
+        except ValueError:
+            self.errExit("Invalid number of days: %s" % value)
+
+    def retention_option(self, option):
+        """Return a number of days set in the [statistics] section
+        of the config file, or None."""
+        try:
+            return self.retention_days(self.cfp.get('statistics', option))
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            return None
+
+    def retain(self, days, rollup_days=None):
+        """Roll up interactions older than days into daily summaries
+        and remove them."""
+        (rolled, deleted, rollups_deleted) = retain(days, rollup_days)
+        self.log.info("Interactions rolled up: %s" % rolled)
+        self.log.info("Interactions removed: %s" % deleted)
+        if rollup_days:
+            self.log.info("Rollups removed: %s" % rollups_deleted)
+
     @transaction.commit_on_success
     def scrub(self):
         ''' Perform a thorough scrub and cleanup of the database '''
@@ -249,19 +318,52 @@ class Reports(Bcfg2.Server.Admin.Mode):
 
         if not stats_file:
             try:
-                stats_file = "%s/etc/statistics.xml" % self.cfp.get('server', 'repository')
+                stats_file = statistics_path(self.cfp.get('server', 'repository'))
             except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
                 self.errExit("Could not read bcfg2.conf; exiting")
         try:
-            statsdata = XML(open(stats_file).read())
-        except (IOError, XMLSyntaxError):
+            statsdata = load_statistics(stats_file)
+        except (IOError, OSError, XMLSyntaxError):
             self.errExit("StatReports: Failed to parse %s" % (stats_file))
 
+        encoding = self.get_encoding()
+        clientsdata = self.load_clients(clientspath)
+
         try:
-            encoding = self.cfp.get('components', 'encoding')
+            load_stats(clientsdata,
+                       statsdata,
+                       encoding,
+                       verb,
+                       self.log,
+                       quick=quick,
+                       location=platform.node())
         except:
-            encoding = 'UTF-8'
+            pass
+
+    def parallel_load_stats(self, stats_files, clientspath=None, verb=0,
+                            quick=False, jobs=1, state_file=None):
+        '''Stream statistics files into the database with several
+        worker processes'''
+        if not stats_files:
+            try:
+                stats_files = [statistics_path(self.cfp.get('server',
+                                                            'repository'))]
+            except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+                self.errExit("Could not read bcfg2.conf; exiting")
+        clientsdata = self.load_clients(clientspath)
+        parallel_load_stats(clientsdata, stats_files, self.get_encoding(),
+                            verb, self.log, jobs=jobs, quick=quick,
+                            location=platform.node(), state_file=state_file)
 
+    def get_encoding(self):
+        '''Return the encoding of client data'''
+        try:
+            return self.cfp.get('components', 'encoding')
+        except:
+            return 'UTF-8'
+
+    def load_clients(self, clientspath=None):
+        '''Parse clients.xml'''
         if not clientspath:
             try:
                 clientspath = "%s/Metadata/clients.xml" % \
@@ -269,21 +371,10 @@ class Reports(Bcfg2.Server.Admin.Mode):
             except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
                 self.errExit("Could not read bcfg2.conf; exiting")
         try:
-            clientsdata = XML(open(clientspath).read())
+            return XML(open(clientspath).read())
         except (IOError, XMLSyntaxError):
             self.errExit("StatReports: Failed to parse %s" % (clientspath))
 
-        try:
-            load_stats(clientsdata,
-                       statsdata,
-                       encoding,
-                       verb,
-                       self.log,
-                       quick=quick,
-                       location=platform.node())
-        except:
-            pass
-
     @printStats
     def purge(self, client=None, maxdate=None, state=None):
         '''Purge historical data from the database'''
@@ -347,6 +438,9 @@ class Reports(Bcfg2.Server.Admin.Mode):
         Performance.prune_orphans()
         self.log.debug("Pruning orphan Reason objects")
         Reason.prune_orphans()
+        if rnum:
+            self.log.debug("Rebuilding client summaries")
+            ClientSummary.objects.rebuild()
 
         if client and not filtered:
             '''Delete the client, ping data is automatic'''
@@ -20,11 +20,11 @@ __all__ = [
         ]
 
 import logging
-import lxml.etree
 import sys
 
 import Bcfg2.Server.Core
 import Bcfg2.Options
+import Bcfg2.Server.Plugins.Statistics
 # Compatibility import
 from Bcfg2.Bcfg2Py3k import ConfigParser
 
@@ -67,8 +67,8 @@ class Mode(object):
             self.errExit("Unable to find server section in bcfg2.conf")
 
     def load_stats(self, client):
-        stats = lxml.etree.parse("%s/etc/statistics.xml" %
-                                (self.get_repo_path()))
+        stats = Bcfg2.Server.Plugins.Statistics.load_statistics(
+            Bcfg2.Server.Plugins.Statistics.statistics_path(self.get_repo_path()))
         hostent = stats.xpath('//Node[@name="%s"]' % client)
         if not hostent:
             self.errExit("Could not find stats for client %s" % (client))
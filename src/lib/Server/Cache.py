@@ -0,0 +1,193 @@
+"""Bcfg2.Server.Cache provides caches of data built by the server."""
+__revision__ = '$Revision$'
+
+import logging
+import os.path
+import threading
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+logger = logging.getLogger('Bcfg2.Server.Cache')
+
+
+def canonical(data):
+    """Return a repr of data that does not depend on dict or set
+    ordering."""
+    if isinstance(data, dict):
+        return "{%s}" % ", ".join(sorted(["%s: %s" % (canonical(key),
+                                                     canonical(val))
+                                          for key, val in data.items()]))
+    elif isinstance(data, (set, frozenset)):
+        return "set(%s)" % ", ".join(sorted([canonical(item)
+                                            for item in data]))
+    elif isinstance(data, (list, tuple)):
+        return "[%s]" % ", ".join([canonical(item) for item in data])
+    return repr(data)
+
+
+def metadata_fingerprint(metadata):
+    """Return a digest of everything in a ClientMetadata object that
+    plugins can base a configuration on, including connector data."""
+    data = [metadata.hostname, metadata.profile, metadata.groups,
+            metadata.bundles, metadata.categories, metadata.aliases,
+            metadata.addresses, metadata.uuid, metadata.password]
+    for source in metadata.connectors:
+        data.append((source, getattr(metadata, source, None)))
+    return md5(canonical(data).encode('utf-8')).hexdigest()
+
+
+class ClientConfigCache(object):
+    """Cache of serialized client configurations.
+
+    Each configuration is stored with the fingerprint of the client
+    metadata it was built for and the files and directories it was
+    built from.  It is served until the client's metadata changes or a
+    FAM event touches one of those paths.
+    """
+
+    def __init__(self):
+        object.__init__(self)
+        self.lock = threading.Lock()
+        # client -> (fingerprint, paths, data)
+        self.configs = {}
+        # path -> set of clients whose configuration used it
+        self.clients_by_path = {}
+        self.hits = 0
+        self.misses = 0
+        # bumped by every expire; see set
+        self.generation = 0
+
+    def get(self, client, fingerprint):
+        """Return the cached configuration for client, or None."""
+        self.lock.acquire()
+        try:
+            if (client in self.configs and
+                self.configs[client][0] == fingerprint):
+                self.hits += 1
+                return self.configs[client][2]
+            self.misses += 1
+            return None
+        finally:
+            self.lock.release()
+
+    def set(self, client, fingerprint, paths, data, generation=None):
+        """Cache data for client, built from paths.  If generation is
+        given, data is only cached if nothing was expired since
+        generation was read, since data may have been built from
+        files that changed meanwhile."""
+        self.lock.acquire()
+        try:
+            if generation is not None and generation != self.generation:
+                return
+            self._expire_client(client)
+            paths = frozenset([os.path.normpath(path) for path in paths])
+            self.configs[client] = (fingerprint, paths, data)
+            for path in paths:
+                try:
+                    self.clients_by_path[path].add(client)
+                except KeyError:
+                    self.clients_by_path[path] = set([client])
+        finally:
+            self.lock.release()
+
+    def _expire_client(self, client):
+        """Drop the configuration of client; the lock must be held."""
+        if client not in self.configs:
+            return
+        for path in self.configs[client][1]:
+            self.clients_by_path[path].discard(client)
+            if not self.clients_by_path[path]:
+                del self.clients_by_path[path]
+        del self.configs[client]
+
+    def expire(self, client=None):
+        """Drop the configuration of client, or of all clients."""
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            if client is None:
+                self.configs = {}
+                self.clients_by_path = {}
+            else:
+                self._expire_client(client)
+        finally:
+            self.lock.release()
+
+    def expire_path(self, path):
+        """Drop every configuration built from path, or from a
+        directory that contains path."""
+        path = os.path.normpath(path)
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            while True:
+                for client in list(self.clients_by_path.get(path, [])):
+                    logger.debug("Expiring cached config for %s: %s changed"
+                                 % (client, path))
+                    self._expire_client(client)
+                parent = os.path.dirname(path)
+                if parent == path:
+                    break
+                path = parent
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return cache size and hit/miss counts."""
+        return dict(clients=len(self.configs), hits=self.hits,
+                    misses=self.misses)
+
+
+class LRUCache(object):
+    """A thread-safe mapping that holds at most size items, evicting
+    the least recently used one when it is full."""
+
+    def __init__(self, size=128):
+        object.__init__(self)
+        self.size = size
+        self.lock = threading.Lock()
+        self.data = {}
+        # key -> tick of last use
+        self.used = {}
+        self.tick = 0
+
+    def get(self, key, default=None):
+        """Return the item stored under key, or default."""
+        self.lock.acquire()
+        try:
+            if key not in self.data:
+                return default
+            self.tick += 1
+            self.used[key] = self.tick
+            return self.data[key]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        """Store value under key, evicting old items if needed."""
+        self.lock.acquire()
+        try:
+            self.tick += 1
+            self.data[key] = value
+            self.used[key] = self.tick
+            while len(self.data) > self.size:
+                oldest = min(self.used, key=self.used.get)
+                del self.data[oldest]
+                del self.used[oldest]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Drop all items."""
+        self.lock.acquire()
+        try:
+            self.data = {}
+            self.used = {}
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.data)
@@ -2,6 +2,8 @@
 __revision__ = '$Revision$'
 
 import atexit
+import binascii
+import copy
 import logging
 import select
 import sys
@@ -13,8 +15,20 @@ except ImportError:
     print("Failed to import lxml dependency. Shutting down server.")
     raise SystemExit(1)
 
+try:
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    ThreadPool = None
+
+# FIXME: Remove when server python dep is 2.5 or greater
+if sys.version_info >= (2, 5):
+    from hashlib import sha1
+else:
+    from sha import sha as sha1
+
 from Bcfg2.Component import Component, exposed
 from Bcfg2.Server.Plugin import PluginInitError, PluginExecutionError
+import Bcfg2.Server.Cache
 import Bcfg2.Server.FileMonitor
 import Bcfg2.Server.Plugins.Metadata
 # Compatibility imports
@@ -51,8 +65,16 @@ class Core(Component):
 
     def __init__(self, repo, plugins, password, encoding,
                  cfile='/etc/bcfg2.conf', ca=None,
-                 filemonitor='default', start_fam_thread=False):
+                 filemonitor='default', start_fam_thread=False,
+                 config_cache=False, bind_threads=0, path_digests=False,
+                 worker=None, workers=None):
         Component.__init__(self)
+        # the slot of this process if the server runs several worker
+        # processes, or None
+        self.worker = worker
+        # the number of worker processes of bcfg2-server, or None in
+        # other programs that build a Core
+        self.workers = workers
         self.datastore = repo
         if filemonitor not in Bcfg2.Server.FileMonitor.available:
             logger.error("File monitor driver %s not available; "
@@ -76,6 +98,21 @@ class Core(Component):
         atexit.register(self.shutdown)
         # Create an event to signal worker threads to shutdown
         self.terminate = threading.Event()
+        if config_cache:
+            self.config_cache = Bcfg2.Server.Cache.ClientConfigCache()
+            self.fam.add_listener(self.expire_config_cache_path)
+        else:
+            self.config_cache = None
+        # client name -> ClientMetadata; see build_metadata
+        self.metadata_cache = {}
+        if bind_threads > 1 and ThreadPool is not None:
+            self.bind_pool = ThreadPool(bind_threads)
+        else:
+            if bind_threads > 1:
+                logger.error("Parallel binding needs multiprocessing; "
+                             "binding entries serially")
+            self.bind_pool = None
+        self.path_digests = path_digests
 
         if '' in plugins:
             plugins.remove('')
@@ -115,6 +152,24 @@ class Core(Component):
         self.generators = self.plugins_by_type(Bcfg2.Server.Plugin.Generator)
         self.structures = self.plugins_by_type(Bcfg2.Server.Plugin.Structure)
         self.connectors = self.plugins_by_type(Bcfg2.Server.Plugin.Connector)
+        # (tag, name) -> generators whose Entries table has that
+        # entry, and (tag, name) -> generators that may handle it
+        # through HandlesEntry; both are rebuilt lazily after FAM
+        # events, since that is when generators change their Entries
+        self.dispatch_index = None
+        self.handlers_cache = {}
+        # bumped by every expire, so that an index built from
+        # generators that changed meanwhile is not kept
+        self.dispatch_generation = 0
+        self.dispatch_lock = threading.Lock()
+        self.fam.add_listener(self.expire_dispatch_index)
+        self.metadata_cache_enabled = \
+            not [conn for conn in self.connectors if conn.volatile]
+        if not self.metadata_cache_enabled:
+            logger.info("Metadata caching disabled by volatile connector(s) "
+                        "%s" % " ".join([conn.name for conn in self.connectors
+                                         if conn.volatile]))
+        self.fam.add_listener(self.expire_metadata_cache_event)
         self.ca = ca
         self.fam_thread = threading.Thread(target=self._file_monitor_thread)
         if start_fam_thread:
@@ -179,6 +234,8 @@ class Core(Component):
         """Shutting down the plugins."""
         if not self.terminate.isSet():
             self.terminate.set()
+            if self.bind_pool is not None:
+                self.bind_pool.terminate()
             for plugin in list(self.plugins.values()):
                 plugin.shutdown()
 
@@ -222,26 +279,108 @@ class Core(Component):
                          % (metadata.hostname, ':'.join(missing)))
         return structures
 
-    def BindStructure(self, structure, metadata):
-        """Bind a complete structure."""
-        for entry in structure.getchildren():
-            if entry.tag.startswith("Bound"):
-                entry.tag = entry.tag[5:]
-                continue
+    def BindStructure(self, structure, metadata, deps=None):
+        """Bind a complete structure.  If deps is a set, the files
+        that the bound entries were built from are added to it."""
+        self.BindStructures([structure], metadata, deps=deps)
+
+    def BindStructures(self, structures, metadata, deps=None):
+        """Bind all entries of a list of structures.  With a bind pool
+        configured, entries of thread_safe generators are bound as
+        detached copies by pool threads, and the copies replace the
+        originals in order once all of them are done.  Other entries
+        are bound first, one at a time."""
+        entries = []
+        for structure in structures:
+            for entry in structure.getchildren():
+                if entry.tag.startswith("Bound"):
+                    entry.tag = entry.tag[5:]
+                    continue
+                entries.append(entry)
+        if self.bind_pool is None or len(entries) < 2:
+            for entry in entries:
+                self.bind_entry(entry, metadata, deps)
+            return
+        parallel = []
+        for entry in entries:
+            if self.bind_concurrently(entry, metadata):
+                parallel.append(entry)
+            else:
+                self.bind_entry(entry, metadata, deps)
+        if len(parallel) < 2:
+            for entry in parallel:
+                self.bind_entry(entry, metadata, deps)
+            return
+        # lxml trees must not be modified from several threads, so
+        # every thread gets an entry that is a document of its own
+        copies = [copy.deepcopy(entry) for entry in parallel]
+        self.bind_pool.map(lambda entry: self.bind_entry(entry, metadata,
+                                                         deps),
+                           copies)
+        for entry, bound in zip(parallel, copies):
+            entry.getparent().replace(entry, bound)
+
+    def bind_concurrently(self, entry, metadata):
+        """Return True if every generator that may bind entry is
+        thread_safe, so that it can be bound on the bind pool."""
+        names = [entry.get('name')]
+        if 'altsrc' in entry.attrib:
+            names.append(entry.get('altsrc'))
+        index = self.dispatch_index
+        if index is None:
+            index = self.get_dispatch_index()
+        for name in names:
+            gens = index.get((entry.tag, name), []) + \
+                   self.get_handlers(lxml.etree.Element(entry.tag, name=name),
+                                     metadata)
+            if [gen for gen in gens if not gen.thread_safe]:
+                return False
+        return True
+
+    def bind_entry(self, entry, metadata, deps=None):
+        """Bind one entry, recording any failure on the entry."""
+        start = time.time()
+        try:
+            self.Bind(entry, metadata, deps=deps)
+        except PluginExecutionError:
+            exc = sys.exc_info()[1]
+            if 'failure' not in entry.attrib:
+                entry.set('failure', 'bind error: %s' % exc)
+            logger.error("Failed to bind entry: %s %s" % \
+                         (entry.tag, entry.get('name')))
+        except Exception:
+            exc = sys.exc_info()[1]
+            if 'failure' not in entry.attrib:
+                entry.set('failure', 'bind error: %s' % exc)
+            logger.error("Unexpected failure in BindStructure: %s %s" \
+                         % (entry.tag, entry.get('name')), exc_info=1)
+        if self.path_digests:
+            self.set_digest(entry)
+        logger.debug("Bound %s %s for %s in %.03f seconds" % \
+                     (entry.tag, entry.get('name'), metadata.hostname,
+                      time.time() - start))
+
+    def set_digest(self, entry):
+        """Set the sha1 attribute of a bound Path type='file' entry to
+        the digest of its content, so that clients can verify unchanged
+        files without comparing their content."""
+        if (entry.tag != 'Path' or entry.get('type') != 'file' or
+            'failure' in entry.attrib):
+            return
+        if entry.get('encoding', 'ascii') == 'base64':
+            data = binascii.a2b_base64(entry.text or '')
+        elif entry.get('empty', 'false') == 'true':
+            data = ''
+        elif entry.text is None:
+            return
+        else:
             try:
-                self.Bind(entry, metadata)
-            except PluginExecutionError, exc:
-                if 'failure' not in entry.attrib:
-                    entry.set('failure', 'bind error: %s' % exc)
-                logger.error("Failed to bind entry: %s %s" % \
-                             (entry.tag, entry.get('name')))
-            except Exception, exc:
-                if 'failure' not in entry.attrib:
-                    entry.set('failure', 'bind error: %s' % exc)
-                logger.error("Unexpected failure in BindStructure: %s %s" \
-                             % (entry.tag, entry.get('name')), exc_info=1)
-
-    def Bind(self, entry, metadata):
+                data = entry.text.encode(self.encoding)
+            except UnicodeError:
+                return
+        entry.set('sha1', sha1(data).hexdigest())
+
+    def Bind(self, entry, metadata, deps=None):
         """Bind an entry using the appropriate generator."""
         if 'altsrc' in entry.attrib:
             oldname = entry.get('name')
@@ -249,7 +388,7 @@ class Core(Component):
             entry.set('realname', oldname)
             del entry.attrib['altsrc']
             try:
-                ret = self.Bind(entry, metadata)
+                ret = self.Bind(entry, metadata, deps=deps)
                 entry.set('name', oldname)
                 del entry.attrib['realname']
                 return ret
@@ -261,32 +400,113 @@ class Core(Component):
                 logger.error("Falling back to %s:%s" % (entry.tag,
                                                         entry.get('name')))
 
-        glist = [gen for gen in self.generators if
-                 entry.get('name') in gen.Entries.get(entry.tag, {})]
+        index = self.dispatch_index
+        if index is None:
+            index = self.get_dispatch_index()
+        glist = index.get((entry.tag, entry.get('name')), [])
         if len(glist) == 1:
+            if deps is not None:
+                deps.update(glist[0].get_dependencies(metadata, entry))
             return glist[0].Entries[entry.tag][entry.get('name')](entry,
                                                                   metadata)
         elif len(glist) > 1:
             generators = ", ".join([gen.name for gen in glist])
             logger.error("%s %s served by multiple generators: %s" % \
                          (entry.tag, entry.get('name'), generators))
-        g2list = [gen for gen in self.generators if
-                  gen.HandlesEntry(entry, metadata)]
+        g2list = [gen for gen in self.get_handlers(entry, metadata)
+                  if gen.HandlesEntry(entry, metadata)]
         if len(g2list) == 1:
+            if deps is not None:
+                deps.update(g2list[0].get_dependencies(metadata, entry))
             return g2list[0].HandleEntry(entry, metadata)
         entry.set('failure', 'no matching generator')
         raise PluginExecutionError(entry.tag, entry.get('name'))
 
-    def BuildConfiguration(self, client):
-        """Build configuration for clients."""
+    def expire_dispatch_index(self, _=None, dummy=None):
+        """Drop the generator dispatch index and cached HandlesEntry
+        answers.  Generators that change their Entries outside of FAM
+        event handling must call this."""
+        self.dispatch_lock.acquire()
+        try:
+            self.dispatch_generation += 1
+            self.dispatch_index = None
+            self.handlers_cache = {}
+        finally:
+            self.dispatch_lock.release()
+
+    def get_dispatch_index(self):
+        """Build the dispatch index, and keep it unless it was expired
+        while it was built."""
+        generation = self.dispatch_generation
+        index = self.build_dispatch_index()
+        self.dispatch_lock.acquire()
+        try:
+            if self.dispatch_generation == generation:
+                self.dispatch_index = index
+        finally:
+            self.dispatch_lock.release()
+        return index
+
+    def build_dispatch_index(self):
+        """Map (tag, name) to the generators that list it in Entries."""
+        index = {}
+        for gen in self.generators:
+            for tag, names in list(gen.Entries.items()):
+                for name in names:
+                    try:
+                        index[(tag, name)].append(gen)
+                    except KeyError:
+                        index[(tag, name)] = [gen]
+        return index
+
+    def get_handlers(self, entry, metadata):
+        """Return the generators that must be asked HandlesEntry for
+        entry.  Generators that leave HandlesEntry alone, or that set
+        handles_by_name, answer only by tag and name, so a negative
+        answer from them is cached per (tag, name)."""
+        key = (entry.tag, entry.get('name'))
+        # an expire replaces the dict, so answers computed from
+        # generators that changed meanwhile go to the discarded one
+        cache = self.handlers_cache
+        handlers = cache.get(key)
+        if handlers is None:
+            handlers = []
+            for gen in self.generators:
+                if (gen.handles_by_name or
+                    type(gen).HandlesEntry == \
+                    Bcfg2.Server.Plugin.Generator.HandlesEntry):
+                    if not gen.HandlesEntry(entry, metadata):
+                        continue
+                handlers.append(gen)
+            cache[key] = handlers
+        return handlers
+
+    def expire_config_cache(self, client=None):
+        """Drop the cached configuration of client, or of all clients.
+        Plugins whose data changes outside of FAM event handling must
+        call this."""
+        if self.config_cache is not None:
+            self.config_cache.expire(client)
+
+    def expire_config_cache_path(self, _, path):
+        """Drop cached configurations that were built from path."""
+        self.config_cache.expire_path(path)
+
+    def BuildConfiguration(self, client, metadata=None, deps=None):
+        """Build configuration for clients.  If deps is a set, the
+        files and directories that the configuration was built from
+        are added to it."""
         start = time.time()
         config = lxml.etree.Element("Configuration", version='2.0', \
                                     revision=self.revision)
-        try:
-            meta = self.build_metadata(client)
-        except Bcfg2.Server.Plugins.Metadata.MetadataConsistencyError:
-            logger.error("Metadata consistency error for client %s" % client)
-            return lxml.etree.Element("error", type='metadata error')
+        if metadata is not None:
+            meta = metadata
+        else:
+            try:
+                meta = self.build_metadata(client)
+            except Bcfg2.Server.Plugins.Metadata.MetadataConsistencyError:
+                logger.error("Metadata consistency error for client %s" % client)
+                return lxml.etree.Element("error", type='metadata error')
 
         try:
             structures = self.GetStructures(meta)
@@ -295,6 +515,16 @@ class Core(Component):
             return lxml.etree.Element("error", type='structure error')
 
         self.validate_structures(meta, structures)
+        if deps is not None:
+            # templates and generators such as SSHbase read the
+            # metadata of other clients, so every configuration
+            # depends on clients.xml and groups.xml
+            deps.update(self.metadata.get_dependencies(meta))
+            for plugin in self.structures + \
+                    self.connectors + \
+                    self.plugins_by_type(Bcfg2.Server.Plugin.StructureValidator) + \
+                    self.plugins_by_type(Bcfg2.Server.Plugin.GoalValidator):
+                deps.update(plugin.get_dependencies(meta))
 
         # Perform altsrc consistency checking
         esrcs = {}
@@ -308,12 +538,12 @@ class Core(Component):
                     esrcs[key] = entry.get('altsrc', None)
         del esrcs
 
+        try:
+            self.BindStructures(structures, meta, deps=deps)
+        except:
+            logger.error("error in BindStructures", exc_info=1)
         for astruct in structures:
-            try:
-                self.BindStructure(astruct, meta)
-                config.append(astruct)
-            except:
-                logger.error("error in BindStructure", exc_info=1)
+            config.append(astruct)
         self.validate_goals(meta, config)
         logger.info("Generated config for %s in %.03f seconds" % \
                     (client, time.time() - start))
@@ -335,15 +565,49 @@ class Core(Component):
         if not hasattr(self, 'metadata'):
             # some threads start before metadata is even loaded
             raise Bcfg2.Server.Plugins.Metadata.MetadataRuntimeError
-        imd = self.metadata.get_initial_metadata(client_name)
-        for conn in self.connectors:
-            grps = conn.get_additional_groups(imd)
-            self.metadata.merge_additional_groups(imd, grps)
-        for conn in self.connectors:
-            data = conn.get_additional_data(imd)
-            self.metadata.merge_additional_data(imd, conn.name, data)
-        imd.query.by_name = self.build_metadata
-        return imd
+        imd = self.metadata_cache.get(client_name)
+        if imd is None:
+            imd = self.metadata.get_initial_metadata(client_name)
+            for conn in self.connectors:
+                grps = conn.get_additional_groups(imd)
+                self.metadata.merge_additional_groups(imd, grps)
+            for conn in self.connectors:
+                data = conn.get_additional_data(imd)
+                self.metadata.merge_additional_data(imd, conn.name, data)
+            imd.query.by_name = self.build_metadata
+            if not self.metadata_cache_enabled:
+                return imd
+            self.metadata_cache[client_name] = imd
+        # callers are free to modify what they get, so hand out a copy
+        # of the sets that plugins are known to change
+        meta = copy.copy(imd)
+        meta.groups = set(imd.groups)
+        meta.bundles = set(imd.bundles)
+        meta.categories = dict(imd.categories)
+        meta.connectors = list(imd.connectors)
+        return meta
+
+    def expire_metadata_cache(self, client=None, group_index=True):
+        """Drop the cached metadata of client, or of all clients.
+        Plugins whose metadata or connector data changes outside of
+        FAM event handling must call this.  With group_index False,
+        the Metadata group index is kept; Metadata updates it itself
+        after its files change."""
+        if group_index and hasattr(self, 'metadata'):
+            self.metadata.expire_group_index(client)
+        if client is None:
+            self.metadata_cache = {}
+            return
+        for name, imd in list(self.metadata_cache.items()):
+            if name == client or imd.hostname == client:
+                self.metadata_cache.pop(name, None)
+
+    def expire_metadata_cache_event(self, _, path):
+        """Drop all cached metadata after a FAM event on a file of
+        a connector.  Metadata expires the cache itself when
+        clients.xml or groups.xml change."""
+        if [conn for conn in self.connectors if conn.expires_metadata(path)]:
+            self.expire_metadata_cache()
 
     def process_statistics(self, client_name, statistics):
         """Proceed statistics for client."""
@@ -408,16 +672,22 @@ class Core(Component):
         sources = []
         [sources.append(data.get('source')) for data in xpdata
          if data.get('source') not in sources]
+        changed = False
         for source in sources:
             if source not in self.plugins:
                 self.logger.warning("Failed to locate plugin %s" % (source))
                 continue
             dl = [data for data in xpdata if data.get('source') == source]
             try:
-                self.plugins[source].ReceiveData(meta, dl)
+                # plugins return False if the data did not change
+                if self.plugins[source].ReceiveData(meta, dl) is not False:
+                    changed = True
             except:
                 logger.error("Failed to process probe data from client %s" % \
                              (address[0]), exc_info=1)
+                changed = True
+        if changed:
+            self.expire_metadata_cache(meta.hostname)
         return True
 
     @exposed
@@ -438,6 +708,8 @@ class Core(Component):
         """Build config for a client."""
         try:
             client = self.metadata.resolve_client(address)
+            if self.config_cache is not None:
+                return self.get_cached_config(client)
             config = self.BuildConfiguration(client)
             return lxml.etree.tostring(config, encoding='UTF-8',
                                        xml_declaration=True)
@@ -445,6 +717,32 @@ class Core(Component):
             self.logger.warning("Metadata consistency failure for %s" % (address))
             raise xmlrpclib.Fault(6, "Metadata consistency failure")
 
+    def get_cached_config(self, client):
+        """Return the serialized configuration for client from the
+        config cache, building and caching it if it is missing or
+        stale.  Configurations with bind failures are not cached."""
+        try:
+            meta = self.build_metadata(client)
+        except Bcfg2.Server.Plugins.Metadata.MetadataConsistencyError:
+            logger.error("Metadata consistency error for client %s" % client)
+            return lxml.etree.tostring(lxml.etree.Element("error",
+                                                          type='metadata error'),
+                                       encoding='UTF-8', xml_declaration=True)
+        fingerprint = Bcfg2.Server.Cache.metadata_fingerprint(meta)
+        data = self.config_cache.get(client, fingerprint)
+        if data is not None:
+            logger.info("Served cached config for %s" % client)
+            return data
+        generation = self.config_cache.generation
+        deps = set()
+        config = self.BuildConfiguration(client, metadata=meta, deps=deps)
+        data = lxml.etree.tostring(config, encoding='UTF-8',
+                                   xml_declaration=True)
+        if config.tag == 'Configuration' and not config.xpath('//*[@failure]'):
+            self.config_cache.set(client, fingerprint, deps, data,
+                                  generation=generation)
+        return data
+
     @exposed
     def RecvStats(self, address, stats):
         """Act on statistics upload."""
@@ -39,6 +39,29 @@ class FileMonitor(object):
         object.__init__(self)
         self.debug = debug
         self.handles = dict()
+        self.paths = dict()
+        self.listeners = []
+
+    def add_listener(self, callback):
+        """Call callback(event, path) after each event has been
+        dispatched, where path is the absolute path of the file the
+        event refers to."""
+        self.listeners.append(callback)
+
+    def event_path(self, event):
+        """Return the absolute path of the file event refers to."""
+        if (os.path.isabs(event.filename) or
+            event.requestID not in self.paths):
+            return event.filename
+        return os.path.join(self.paths[event.requestID], event.filename)
+
+    def notify_listeners(self, event, path):
+        for callback in self.listeners:
+            try:
+                callback(event, path)
+            except:
+                logger.error("error in event listener for %s" % path,
+                             exc_info=1)
 
     def get_event(self):
         return None
@@ -56,6 +79,8 @@ class FileMonitor(object):
             logger.info("Got event for unexpected id %s, file %s" %
                         (event.requestID, event.filename))
             return
+        # handlers may rewrite event.filename
+        path = self.event_path(event)
         if self.debug:
             logger.info("Dispatching event %s %s to obj %s" \
                         % (event.code2str(), event.filename,
@@ -65,6 +90,7 @@ class FileMonitor(object):
         except:
             logger.error("error in handling of gamin event for %s" % \
                          (event.filename), exc_info=1)
+        self.notify_listeners(event, path)
 
     def handle_event_set(self, lock=None):
         count = 1
@@ -104,12 +130,35 @@ class FamFam(object):
         self.fm = _fam.open()
         self.users = {}
         self.handles = {}
+        self.paths = {}
+        self.listeners = []
         self.debug = False
 
     def fileno(self):
         """Return fam file handle number."""
         return self.fm.fileno()
 
+    def add_listener(self, callback):
+        """Call callback(event, path) after each event has been
+        dispatched, where path is the absolute path of the file the
+        event refers to."""
+        self.listeners.append(callback)
+
+    def event_path(self, event):
+        """Return the absolute path of the file event refers to."""
+        if (os.path.isabs(event.filename) or
+            event.requestID not in self.paths):
+            return event.filename
+        return os.path.join(self.paths[event.requestID], event.filename)
+
+    def notify_listeners(self, event, path):
+        for callback in self.listeners:
+            try:
+                callback(event, path)
+            except:
+                logger.error("error in event listener for %s" % path,
+                             exc_info=1)
+
     def handle_event_set(self, _):
         self.Service()
 
@@ -127,6 +176,7 @@ class FamFam(object):
         else:
             handle = self.fm.monitorFile(path, None)
         self.handles[handle.requestID()] = handle
+        self.paths[handle.requestID()] = path
         if obj != None:
             self.users[handle.requestID()] = obj
         return handle.requestID()
@@ -160,10 +210,13 @@ class FamFam(object):
                     collapsed += 1
         for event in unique:
             if event.requestID in self.users:
+                # handlers may rewrite event.filename
+                path = self.event_path(event)
                 try:
                     self.users[event.requestID].HandleEvent(event)
                 except:
                     logger.error("handling event for file %s" % (event.filename), exc_info=1)
+                self.notify_listeners(event, path)
         end = time()
         logger.info("Processed %s fam events in %03.03f seconds. %s coalesced" %
                     (count, (end - start), collapsed))
@@ -190,6 +243,7 @@ class Fam(FileMonitor):
             handle = self.fm.monitorDirectory(path, None)
         else:
             handle = self.fm.monitorFile(path, None)
+        self.paths[handle.requestID()] = path
         if obj != None:
             self.handles[handle.requestID()] = obj
         return handle.requestID()
@@ -232,6 +286,7 @@ class Pseudo(FileMonitor):
             self.pending_events.append(Event(handleID, path, 'endExist'))
         else:
             self.pending_events.append(Event(handleID, path, 'exists'))
+        self.paths[handleID] = path
         if obj != None:
             self.handles[handleID] = obj
         return handleID
@@ -286,6 +341,7 @@ try:
                 self.mon.watch_directory(path, self.queue, handle)
             else:
                 self.mon.watch_file(path, self.queue, handle)
+            self.paths[handle] = path
             self.handles[handle] = obj
             return handle
 
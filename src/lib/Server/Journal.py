@@ -0,0 +1,280 @@
+"""Bcfg2.Server.Journal provides a persistent queue kept in
+append-only files."""
+__revision__ = '$Revision$'
+
+import logging
+import os
+import stat
+import struct
+import threading
+import time
+import zlib
+
+from Bcfg2.Bcfg2Py3k import Empty
+
+logger = logging.getLogger('Bcfg2.Server.Journal')
+
+# every record starts with its length and crc32
+HEADER = struct.Struct('!II')
+
+
+def checksum(data):
+    """Return the crc32 of data as an unsigned integer."""
+    return zlib.crc32(data) & 0xffffffff
+
+
+class JournalQueue(object):
+    """A FIFO queue of byte strings stored in a directory of
+    append-only segment files.
+
+    Any number of threads can put records; a single consumer gets
+    them in order and acknowledges them once they are handled.  Only
+    the acknowledged position is persisted, so after a crash or
+    restart the consumer starts again with the first record it had not
+    acknowledged.  Appends are fsynced at most every sync_interval
+    seconds, and a torn record at the end of the journal is discarded
+    when it is opened.  Positions are (segment, offset) tuples.  Only
+    one process at a time may use a journal directory.
+    """
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024,
+                 sync_interval=1.0):
+        object.__init__(self)
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.readable = threading.Condition(self.lock)
+        self.sync_timer = None
+        self.unsynced = False
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        segments = self.segments()
+        self.ack_pos = self.read_ack()
+        for segment in segments:
+            if segment < self.ack_pos[0]:
+                # consumed, but not removed before a crash
+                os.unlink(self.segment_path(segment))
+        segments = [s for s in segments if s >= self.ack_pos[0]]
+        if not segments:
+            segments = [self.ack_pos[0]]
+        elif segments[0] > self.ack_pos[0]:
+            self.ack_pos = (segments[0], 0)
+        self.write_segment = segments[-1]
+        self.write_fd = self.open_segment(self.write_segment)
+        self.write_pos = self.recover(self.write_segment)
+        if (self.ack_pos[0] == self.write_segment and
+            self.ack_pos[1] > self.write_pos):
+            self.ack_pos = (self.write_segment, self.write_pos)
+        self.read_pos = self.ack_pos
+        self.read_segment = None
+        self.read_file = None
+
+    def segments(self):
+        """Return the numbers of the segments on disk, in order."""
+        rv = []
+        for fname in os.listdir(self.path):
+            if fname.endswith('.journal'):
+                try:
+                    rv.append(int(fname[:-8]))
+                except ValueError:
+                    pass
+        return sorted(rv)
+
+    def segment_path(self, segment):
+        """Return the path of a segment file."""
+        return os.path.join(self.path, "%08d.journal" % segment)
+
+    def open_segment(self, segment):
+        """Open a segment file for appending."""
+        return os.open(self.segment_path(segment),
+                       os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                       stat.S_IRUSR | stat.S_IWUSR)
+
+    def read_ack(self):
+        """Return the acknowledged position saved on disk."""
+        try:
+            segment, offset = open(os.path.join(self.path, 'ack')).read().split()
+            return (int(segment), int(offset))
+        except (IOError, ValueError):
+            return (0, 0)
+
+    def recover(self, segment):
+        """Truncate a segment after its last complete record and
+        return its length."""
+        fname = self.segment_path(segment)
+        size = os.path.getsize(fname)
+        sfile = open(fname, 'rb')
+        offset = 0
+        try:
+            while offset < size:
+                record = self.read_record(sfile, offset)
+                if record is None:
+                    break
+                offset += HEADER.size + len(record)
+        finally:
+            sfile.close()
+        if offset < size:
+            logger.error("Discarding %d bytes of incomplete records in %s" %
+                         (size - offset, fname))
+            os.ftruncate(self.write_fd, offset)
+        return offset
+
+    def read_record(self, sfile, offset):
+        """Return the record at offset of a segment file, or None if
+        it is incomplete or corrupt."""
+        sfile.seek(offset)
+        header = sfile.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        length, crc = HEADER.unpack(header)
+        data = sfile.read(length)
+        if len(data) < length or checksum(data) != crc:
+            return None
+        return data
+
+    def put(self, data):
+        """Append a record to the journal."""
+        record = HEADER.pack(len(data), checksum(data)) + data
+        self.lock.acquire()
+        try:
+            if (self.write_pos and
+                self.write_pos + len(record) > self.segment_size):
+                # start a new segment
+                os.fsync(self.write_fd)
+                os.close(self.write_fd)
+                self.write_segment += 1
+                self.write_fd = self.open_segment(self.write_segment)
+                self.write_pos = 0
+            written = 0
+            while written < len(record):
+                written += os.write(self.write_fd, record[written:])
+            self.write_pos += len(record)
+            if self.sync_interval <= 0:
+                # sync() would take the lock again
+                os.fsync(self.write_fd)
+            else:
+                self.unsynced = True
+                if self.sync_timer is None:
+                    self.sync_timer = threading.Timer(self.sync_interval,
+                                                      self.sync)
+                    self.sync_timer.setDaemon(True)
+                    self.sync_timer.start()
+            self.readable.notify()
+        finally:
+            self.lock.release()
+
+    def sync(self):
+        """Flush appended records to disk."""
+        self.lock.acquire()
+        try:
+            self.sync_timer = None
+            if self.unsynced:
+                os.fsync(self.write_fd)
+                self.unsynced = False
+        finally:
+            self.lock.release()
+
+    def empty(self):
+        """Return True if every record has been read."""
+        return self.read_pos == (self.write_segment, self.write_pos)
+
+    def get(self, block=True, timeout=None):
+        """Return the position after the next record and the record.
+        Raises Empty if there is none."""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            self.lock.acquire()
+            try:
+                while self.empty():
+                    if not block:
+                        raise Empty
+                    if timeout is None:
+                        self.readable.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise Empty
+                        self.readable.wait(remaining)
+                (segment, offset) = self.read_pos
+                last = segment == self.write_segment
+            finally:
+                self.lock.release()
+
+            # only the consumer moves read_pos, and records before
+            # write_pos are complete, so the rest needs no lock
+            if self.read_segment != segment:
+                if self.read_file is not None:
+                    self.read_file.close()
+                self.read_file = None
+                self.read_segment = segment
+                try:
+                    self.read_file = open(self.segment_path(segment), 'rb')
+                except IOError:
+                    pass
+            if self.read_file is None:
+                logger.error("Journal segment %s is missing" %
+                             self.segment_path(segment))
+                self.read_pos = (segment + 1, 0)
+                continue
+            if (not last and
+                offset >= os.fstat(self.read_file.fileno()).st_size):
+                self.read_pos = (segment + 1, 0)
+                continue
+            data = self.read_record(self.read_file, offset)
+            if data is None:
+                logger.error("Skipping corrupt records in %s after offset %s"
+                             % (self.segment_path(segment), offset))
+                if last:
+                    self.read_pos = (segment, self.write_pos)
+                else:
+                    self.read_pos = (segment + 1, 0)
+                continue
+            self.read_pos = (segment, offset + HEADER.size + len(data))
+            return (self.read_pos, data)
+
+    def get_nowait(self):
+        """Return the next record if there is one; raise Empty
+        otherwise."""
+        return self.get(block=False)
+
+    def ack(self, position):
+        """Record that every record before position has been handled,
+        and remove the segments that are no longer needed."""
+        self.lock.acquire()
+        try:
+            first = self.ack_pos[0]
+            self.ack_pos = position
+            fname = os.path.join(self.path, 'ack')
+            afile = open(fname + '.new', 'w')
+            afile.write("%d %d\n" % position)
+            afile.flush()
+            # the segments removed below must not be needed again
+            # after a crash
+            os.fsync(afile.fileno())
+            afile.close()
+            os.rename(fname + '.new', fname)
+            for segment in range(first, min(position[0], self.write_segment)):
+                try:
+                    os.unlink(self.segment_path(segment))
+                except OSError:
+                    pass
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Flush the journal to disk and close it."""
+        self.lock.acquire()
+        try:
+            if self.sync_timer is not None:
+                self.sync_timer.cancel()
+                self.sync_timer = None
+            os.fsync(self.write_fd)
+            os.close(self.write_fd)
+            if self.read_file is not None:
+                self.read_file.close()
+                self.read_file = None
+        finally:
+            self.lock.release()
@@ -2,6 +2,7 @@
 __revision__ = '$Revision$'
 
 import copy
+import glob
 import logging
 import lxml.etree
 import os
@@ -9,12 +10,16 @@ import os.path
 import pickle
 import posixpath
 import re
+import shutil
 import sys
 import threading
+import time
 
 from lxml.etree import XML, XMLSyntaxError
 
 import Bcfg2.Options
+import Bcfg2.Server.Cache
+import Bcfg2.Server.Journal
 
 # py3k compatibility
 if sys.hexversion >= 0x03000000:
@@ -22,9 +27,7 @@ if sys.hexversion >= 0x03000000:
     from io import FileIO as BUILTIN_FILE_TYPE
 else:
     BUILTIN_FILE_TYPE = file
-from Bcfg2.Bcfg2Py3k import Queue
 from Bcfg2.Bcfg2Py3k import Empty
-from Bcfg2.Bcfg2Py3k import Full
 
 # grab default metadata info from bcfg2.conf
 opts = {'owner': Bcfg2.Options.MDATA_OWNER,
@@ -113,12 +116,28 @@ class Plugin(object):
         path = "%s/%s" % (repo, cls.name)
         os.makedirs(path)
 
+    def get_dependencies(self, metadata, entry=None):
+        """Return the files and directories that this plugin's
+        contribution to a client configuration was built from; entry
+        is given for entries bound by a Generator.  A FAM event on any
+        of these expires cached configurations that used them."""
+        return [self.data]
+
     def shutdown(self):
         self.running = False
 
 
 class Generator(object):
     """Generator plugins contribute to literal client configurations."""
+    # set to True if HandlesEntry depends only on the tag and name of
+    # the entry, never on client metadata; the core then caches
+    # negative answers until the next FAM event
+    handles_by_name = False
+    # set to True if entries can be bound by several threads at once
+    # (see [server] bind_threads); entries of other generators are
+    # bound one at a time
+    thread_safe = False
+
     def HandlesEntry(self, entry, metadata):
         """This is the slow path method for routing configuration binding requests."""
         return False
@@ -155,9 +174,32 @@ class Metadata(object):
     def merge_additional_data(self, imd, source, groups, data):
         raise PluginExecutionError
 
+    def expire_group_index(self, client=None):
+        """Forget the group memberships of client, or of all clients,
+        because their metadata may have changed."""
+        pass
+
 
 class Connector(object):
     """Connector Plugins augment client metadata instances."""
+    # Client metadata is cached until a FAM event, new probe data or
+    # a profile change.  Connectors whose groups or data can change
+    # without any of those (e.g. because they query an external
+    # service) set this, which turns the metadata cache off.
+    volatile = False
+
+    def expires_metadata(self, path):
+        """Return True if a FAM event on path may change the groups
+        or data this connector adds, so that cached metadata must be
+        dropped.  Connectors that expire the cache themselves for
+        some of their files leave them out."""
+        data = getattr(self, 'data', None)
+        if data is None:
+            return False
+        data = os.path.normpath(data)
+        path = os.path.normpath(path)
+        return path == data or path.startswith(data + os.sep)
+
     def get_additional_groups(self, metadata):
         """Determine additional groups for metadata."""
         return list()
@@ -174,7 +216,8 @@ class Probing(object):
         return []
 
     def ReceiveData(self, _, dummy):
-        """Receive probe results pertaining to client."""
+        """Receive probe results pertaining to client.  Return False
+        if they did not change anything."""
         pass
 
 
@@ -187,40 +230,94 @@ class Statistics(object):
 class ThreadedStatistics(Statistics,
                          threading.Thread):
     """Threaded statistics handling capability."""
+    # maximum number of queued interactions passed to
+    # handle_statistics_batch at once
+    batch_size = 1
+    # seconds to wait for more interactions once one was taken from
+    # the queue, so that they are handled in one batch
+    batch_wait = 0
+    # a batch that fails is retried this many times, after retry_delay
+    # seconds, doubling each time, before it is moved to the failed
+    # journal
+    max_retries = 5
+    retry_delay = 1
+
     def __init__(self, core, datastore):
         Statistics.__init__(self)
         threading.Thread.__init__(self)
         # Event from the core signaling an exit
         self.terminate = core.terminate
-        self.work_queue = Queue(100000)
-        self.pending_file = "%s/etc/%s.pending" % (datastore, self.__class__.__name__)
+        # workers share no state, so each one has a journal of its
+        # own.  the first worker uses the journal of a single server
+        # process, so nothing queued is lost when switching modes.
+        self.journal_prefix = "%s/etc/%s" % (datastore,
+                                             self.__class__.__name__)
+        if core.worker:
+            journal = "%s-%d.journal" % (self.journal_prefix, core.worker)
+        else:
+            journal = "%s.journal" % self.journal_prefix
+        self.failed_journal = "%s.failed" % journal
+        # the first worker of bcfg2-server takes over the journals of
+        # slots that are gone because the number of workers was lowered
+        if not core.worker and core.workers is not None:
+            self.first_stray_slot = max(core.workers, 1)
+        else:
+            self.first_stray_slot = None
+        try:
+            self.work_queue = Bcfg2.Server.Journal.JournalQueue(journal)
+        except (IOError, OSError):
+            e = sys.exc_info()[1]
+            self.logger.error("Failed to open %s: %s" % (journal, e))
+            raise PluginInitError
+        # written by earlier versions on shutdown; only read by one
+        # process
+        if core.worker:
+            self.pending_file = None
+        else:
+            self.pending_file = "%s/etc/%s.pending" % \
+                (datastore, self.__class__.__name__)
         self.daemon = True
         self.start()
 
-    def save(self):
-        """Save any pending data to a file."""
-        pending_data = []
-        try:
-            while not self.work_queue.empty():
-                (metadata, data) = self.work_queue.get_nowait()
-                try:
-                    pending_data.append((metadata.hostname, lxml.etree.tostring(data)))
-                except:
-                    self.logger.warning("Dropping interaction for %s" % metadata.hostname)
-        except Empty:
-            pass
-
-        try:
-            savefile = open(self.pending_file, 'w')
-            pickle.dump(pending_data, savefile)
-            savefile.close()
-            self.logger.info("Saved pending %s data" % self.__class__.__name__)
-        except:
-            self.logger.warning("Failed to save pending data")
+    def load_stray_journals(self):
+        """Move the records of the journals of worker slots that no
+        longer exist to the journal."""
+        if self.first_stray_slot is None:
+            return
+        for path in glob.glob("%s-*.journal" % self.journal_prefix):
+            try:
+                slot = int(path[len(self.journal_prefix) + 1:
+                                -len('.journal')])
+            except ValueError:
+                continue
+            if slot < self.first_stray_slot:
+                continue
+            count = 0
+            try:
+                stray = Bcfg2.Server.Journal.JournalQueue(path)
+                while True:
+                    try:
+                        self.work_queue.put(stray.get_nowait()[1])
+                    except Empty:
+                        break
+                    count += 1
+                self.work_queue.sync()
+                stray.close()
+                shutil.rmtree(path)
+            except (IOError, OSError):
+                e = sys.exc_info()[1]
+                self.logger.error("Failed to move queued interactions "
+                                  "from %s: %s" % (path, e))
+                continue
+            self.logger.info("Moved %d queued interactions from %s" %
+                             (count, path))
 
     def load(self):
-        """Load any pending data to a file."""
-        if not os.path.exists(self.pending_file):
+        """Move pending data saved by earlier versions, and the
+        journals of worker slots that no longer exist, to the
+        journal."""
+        self.load_stray_journals()
+        if self.pending_file is None or not os.path.exists(self.pending_file):
             return True
         pending_data = []
         try:
@@ -231,31 +328,7 @@ class ThreadedStatistics(Statistics,
             e = sys.exc_info()[1]
             self.logger.warning("Failed to load pending data: %s" % e)
         for (pmetadata, pdata) in pending_data:
-            # check that shutdown wasnt called early
-            if self.terminate.isSet():
-                return False
-
-            try:
-                while True:
-                    try:
-                        metadata = self.core.build_metadata(pmetadata)
-                        break
-                    except Bcfg2.Server.Plugins.Metadata.MetadataRuntimeError:
-                        pass
-
-                    self.terminate.wait(5)
-                    if self.terminate.isSet():
-                        return False
-
-                self.work_queue.put_nowait((metadata, lxml.etree.fromstring(pdata)))
-            except Full:
-                self.logger.warning("Queue.Full: Failed to load queue data")
-                break
-            except lxml.etree.LxmlError:
-                lxml_error = sys.exc_info()[1]
-                self.logger.error("Unable to load save interaction: %s" % lxml_error)
-            except Bcfg2.Server.Plugins.Metadata.MetadataConsistencyError:
-                self.logger.error("Unable to load metadata for save interaction: %s" % pmetadata)
+            self.work_queue.put(pickle.dumps((pmetadata, pdata)))
         try:
             os.unlink(self.pending_file)
         except:
@@ -263,36 +336,125 @@ class ThreadedStatistics(Statistics,
         self.logger.info("Loaded pending %s data" % self.__class__.__name__)
         return True
 
+    def build_metadata(self, hostname):
+        """Build client metadata for a queued interaction, waiting
+        while metadata is unavailable.  Returns None on shutdown."""
+        while not self.terminate.isSet():
+            try:
+                return self.core.build_metadata(hostname)
+            except Bcfg2.Server.Plugins.Metadata.MetadataRuntimeError:
+                self.terminate.wait(5)
+        return None
+
     def run(self):
         if not self.load():
             return
         while not self.terminate.isSet():
             try:
-                (xdata, client) = self.work_queue.get(block=True, timeout=2)
+                records = [self.work_queue.get(block=True, timeout=2)]
             except Empty:
                 continue
             except Exception:
                 e = sys.exc_info()[1]
                 self.logger.error("ThreadedStatistics: %s" % e)
                 continue
-            self.handle_statistic(xdata, client)
-        if not self.work_queue.empty():
-            self.save()
+            deadline = time.time() + self.batch_wait
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.work_queue.get(
+                        block=True, timeout=max(deadline - time.time(), 0)))
+                except Empty:
+                    break
+            batch = []
+            for (position, record) in records:
+                try:
+                    (hostname, pdata) = pickle.loads(record)
+                    data = lxml.etree.fromstring(pdata)
+                except Exception:
+                    e = sys.exc_info()[1]
+                    self.logger.error("Unable to load queued interaction: %s" % e)
+                    continue
+                try:
+                    metadata = self.build_metadata(hostname)
+                except Bcfg2.Server.Plugins.Metadata.MetadataConsistencyError:
+                    self.logger.error("Unable to load metadata for queued interaction: %s" % hostname)
+                    continue
+                if metadata is None:
+                    # shutting down; the journal keeps the batch
+                    self.work_queue.close()
+                    return
+                batch.append((metadata, data))
+            if not self.handle_batch(batch, records):
+                # shutting down; the journal keeps the batch
+                self.work_queue.close()
+                return
+            self.work_queue.ack(records[-1][0])
+        self.work_queue.close()
+
+    def handle_batch(self, batch, records):
+        """Handle a batch, retrying it while it fails.  The journal
+        records of a batch that still fails after max_retries are
+        moved to the failed journal, so that it does not hold up the
+        queue.  Returns False if the server is shutting down before
+        the batch was handled."""
+        retries = 0
+        while True:
+            try:
+                self.handle_statistics_batch(batch)
+                return True
+            except:
+                self.logger.error("%s: Failed to handle interactions" %
+                                  self.__class__.__name__, exc_info=1)
+            if retries >= self.max_retries:
+                if self.save_failed(records):
+                    return True
+                # keep the batch until it can be saved
+                retries = self.max_retries - 1
+            self.terminate.wait(self.retry_delay * 2 ** retries)
+            if self.terminate.isSet():
+                return False
+            retries += 1
+
+    def save_failed(self, records):
+        """Append journal records to the failed journal.  Returns
+        False if they could not be saved."""
+        try:
+            failed = Bcfg2.Server.Journal.JournalQueue(self.failed_journal,
+                                                       sync_interval=0)
+            for (_, record) in records:
+                failed.put(record)
+            failed.close()
+        except (IOError, OSError):
+            e = sys.exc_info()[1]
+            self.logger.error("%s: Failed to save %d interactions to %s: %s"
+                              % (self.__class__.__name__, len(records),
+                                 self.failed_journal, e))
+            return False
+        self.logger.error("%s: Moved %d interactions to %s" %
+                          (self.__class__.__name__, len(records),
+                           self.failed_journal))
+        return True
 
     def process_statistics(self, metadata, data):
-        warned = False
         try:
-            self.work_queue.put_nowait((metadata, copy.deepcopy(data)))
-            warned = False
-        except Full:
-            if not warned:
-                self.logger.warning("%s: Queue is full.  Dropping interactions." % self.__class__.__name__)
-            warned = True
+            self.work_queue.put(pickle.dumps((metadata.hostname,
+                                              lxml.etree.tostring(data))))
+        except (IOError, OSError):
+            e = sys.exc_info()[1]
+            self.logger.error("%s: Failed to queue interaction for %s: %s" %
+                              (self.__class__.__name__, metadata.hostname, e))
 
     def handle_statistics(self, metadata, data):
         """Handle stats here."""
         pass
 
+    def handle_statistics_batch(self, batch):
+        """Handle a list of (metadata, data) tuples taken from the
+        queue together.  Plugins that set batch_size can override this
+        to process them at once."""
+        for (metadata, data) in batch:
+            self.handle_statistic(metadata, data)
+
 
 class PullSource(object):
     def GetExtra(self, client):
@@ -656,30 +818,30 @@ class INode:
     LNodes provide lists of things available at a particular
     group intersection.
     """
-    raw = {'Client': "lambda m, e:'%(name)s' == m.hostname and predicate(m, e)",
-           'Group': "lambda m, e:'%(name)s' in m.groups and predicate(m, e)"}
-    nraw = {'Client': "lambda m, e:'%(name)s' != m.hostname and predicate(m, e)",
-            'Group': "lambda m, e:'%(name)s' not in m.groups and predicate(m, e)"}
+    # container tag -> function that, given the name attribute of a
+    # container, returns the test it applies to (metadata, entry)
+    tests = {'Client': lambda name: lambda m, e: name == m.hostname,
+             'Group': lambda name: lambda m, e: name in m.groups}
+    ntests = {'Client': lambda name: lambda m, e: name != m.hostname,
+              'Group': lambda name: lambda m, e: name not in m.groups}
     containers = ['Group', 'Client']
     ignore = []
+    # the type of the per-tag dicts that Match fills in
+    mapping = dict
 
     def __init__(self, data, idict, parent=None):
         self.data = data
         self.contents = {}
+        # only this node's own test; Match never visits a node whose
+        # parent did not match, so the parent's tests need not be
+        # repeated
+        self.test = self.compile(data, parent)
         if parent == None:
-            self.predicate = lambda m, d: True
+            self.predicate = lambda m, e: True
         else:
+            test = self.test
             predicate = parent.predicate
-            if data.get('negate', 'false') in ['true', 'True']:
-                psrc = self.nraw
-            else:
-                psrc = self.raw
-            if data.tag in list(psrc.keys()):
-                self.predicate = eval(psrc[data.tag] %
-                                      {'name': data.get('name')},
-                                      {'predicate': predicate})
-            else:
-                raise Exception
+            self.predicate = lambda m, e: test(m, e) and predicate(m, e)
         mytype = self.__class__
         self.children = []
         for item in data.getchildren():
@@ -699,27 +861,42 @@ class INode:
                 except KeyError:
                     idict[item.tag] = [item.get('name')]
 
+    def compile(self, data, parent):
+        """Return the test that the container data applies, or None
+        for the root node."""
+        if parent == None:
+            return None
+        if data.get('negate', 'false') in ['true', 'True']:
+            tests = self.ntests
+        else:
+            tests = self.tests
+        if data.tag not in tests:
+            raise Exception
+        return tests[data.tag](data.get('name'))
+
     def Match(self, metadata, data, entry=lxml.etree.Element("None")):
         """Return a dictionary of package mappings."""
-        if self.predicate(metadata, entry):
-            for key in self.contents:
-                try:
-                    data[key].update(self.contents[key])
-                except:
-                    data[key] = {}
-                    data[key].update(self.contents[key])
-            for child in self.children:
-                child.Match(metadata, data, entry=entry)
+        if self.test is not None and not self.test(metadata, entry):
+            return
+        for key, contents in list(self.contents.items()):
+            try:
+                data[key].update(contents)
+            except KeyError:
+                data[key] = self.mapping(contents)
+        for child in self.children:
+            child.Match(metadata, data, entry)
 
 
 class InfoNode (INode):
     """ INode implementation that includes <Path> tags """
-    raw = {'Client': "lambda m, e:'%(name)s' == m.hostname and predicate(m, e)",
-           'Group': "lambda m, e:'%(name)s' in m.groups and predicate(m, e)",
-           'Path': "lambda m, e:('%(name)s' == e.get('name') or '%(name)s' == e.get('realname')) and predicate(m, e)"}
-    nraw = {'Client': "lambda m, e:'%(name)s' != m.hostname and predicate(m, e)",
-            'Group': "lambda m, e:'%(name)s' not in m.groups and predicate(m, e)",
-            'Path': "lambda m, e:('%(name)s' != e.get('name') and '%(name)s' != e.get('realname')) and predicate(m, e)"}
+    tests = {'Client': INode.tests['Client'],
+             'Group': INode.tests['Group'],
+             'Path': lambda name: lambda m, e: (name == e.get('name') or
+                                                name == e.get('realname'))}
+    ntests = {'Client': INode.ntests['Client'],
+              'Group': INode.ntests['Group'],
+              'Path': lambda name: lambda m, e: (name != e.get('name') and
+                                                 name != e.get('realname'))}
     containers = ['Group', 'Client', 'Path']
 
 
@@ -727,11 +904,18 @@ class XMLSrc(XMLFileBacked):
     """XMLSrc files contain a LNode hierarchy that returns matching entries."""
     __node__ = INode
     __cacheobj__ = dict
+    # the number of distinct match results kept per file
+    cache_size = 128
 
     def __init__(self, filename, noprio=False):
         XMLFileBacked.__init__(self, filename)
         self.items = {}
         self.cache = None
+        self.matches = Bcfg2.Server.Cache.LRUCache(self.cache_size)
+        # the groups that the node tree tests, and whether it tests
+        # the hostname; a match depends on nothing else
+        self.node_groups = set()
+        self.node_clients = False
         self.pnode = None
         self.priority = -1
         self.noprio = noprio
@@ -751,6 +935,17 @@ class XMLSrc(XMLFileBacked):
             return
         self.pnode = self.__node__(xdata, self.items)
         self.cache = None
+        self.matches.clear()
+        self.node_groups = set()
+        self.node_clients = False
+        nodes = [self.pnode]
+        while nodes:
+            node = nodes.pop()
+            if node.data.tag == 'Group':
+                self.node_groups.add(node.data.get('name'))
+            elif node.data.tag == 'Client':
+                self.node_clients = True
+            nodes.extend(node.children)
         try:
             self.priority = int(xdata.get('priority'))
         except (ValueError, TypeError):
@@ -759,16 +954,33 @@ class XMLSrc(XMLFileBacked):
                              (xdata.get('priority'), self.name))
         del xdata, data
 
+    def signature(self, metadata):
+        """Return the parts of metadata that the node tree tests."""
+        if self.node_clients:
+            hostname = metadata.hostname
+        else:
+            hostname = None
+        return (hostname,
+                frozenset([grp for grp in metadata.groups
+                           if grp in self.node_groups]))
+
     def Cache(self, metadata):
-        """Build a package dict for a given host."""
-        if self.cache == None or self.cache[0] != metadata:
-            cache = (metadata, self.__cacheobj__())
-            if self.pnode == None:
-                logger.error("Cache method called early for %s; forcing data load" % (self.name))
-                self.HandleEvent()
-                return
-            self.pnode.Match(metadata, cache[1])
-            self.cache = cache
+        """Build a package dict for a given host and return it.
+        Results are shared by all clients that the file cannot tell
+        apart, and must not be modified."""
+        if self.pnode == None:
+            logger.error("Cache method called early for %s; forcing data load" % (self.name))
+            self.HandleEvent()
+            return None
+        key = self.signature(metadata)
+        data = self.matches.get(key)
+        if data is None:
+            data = self.__cacheobj__()
+            self.pnode.Match(metadata, data)
+            self.matches.set(key, data)
+        # kept for plugins that still look at the last match
+        self.cache = (metadata, data)
+        return data
 
 
 class InfoXML (XMLSrc):
@@ -784,6 +996,9 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
     """This is a generator that handles package assignments."""
     name = 'PrioDir'
     __child__ = XMLSrc
+    # binding only reads the sources; XMLSrc.Cache shares its
+    # matches through a locked LRUCache
+    thread_safe = True
 
     def __init__(self, core, datastore):
         Plugin.__init__(self, core, datastore)
@@ -798,6 +1013,8 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
         """Handle events and update dispatch table."""
         XMLDirectoryBacked.HandleEvent(self, event)
         self.Entries = {}
+        # (tag, name) -> the sources that may supply that entry
+        self.source_index = {}
         for src in list(self.entries.values()):
             for itype, children in list(src.items.items()):
                 for child in children:
@@ -814,37 +1031,49 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
         for key, val in list(attrs.items()):
             entry.attrib[key] = val
         
+    def get_sources(self, entry, metadata):
+        """ get the sources that list entry for any client """
+        key = (entry.tag, entry.get('name'))
+        try:
+            return self.source_index[key]
+        except AttributeError:
+            self.source_index = {}
+        except KeyError:
+            pass
+        sources = [src for src in list(self.entries.values())
+                   if (entry.tag in src.items and
+                       self._matches(entry, metadata, src.items[entry.tag]))]
+        self.source_index[key] = sources
+        return sources
+
     def get_attrs(self, entry, metadata):
         """ get a list of attributes to add to the entry during the bind """
-        for src in list(self.entries.values()):
+        matching = []
+        for src in self.get_sources(entry, metadata):
             cached = src.Cache(metadata)
-            if cached == False:
-                self.logger.error("Called before data loaded")
-                raise PluginExecutionError
-        matching = [src for src in list(self.entries.values())
-                    if (src.cache and
-                        entry.tag in src.cache[1] and
-                        self._matches(entry, metadata,
-                                      src.cache[1][entry.tag]))]
+            if (cached and entry.tag in cached and
+                self._matches(entry, metadata, cached[entry.tag])):
+                matching.append((src, cached))
         if len(matching) == 0:
             raise PluginExecutionError
         elif len(matching) == 1:
             index = 0
         else:
-            prio = [int(src.priority) for src in matching]
+            prio = [int(src.priority) for src, _ in matching]
             if prio.count(max(prio)) > 1:
                 self.logger.error("Found conflicting sources with "
                                   "same priority for %s, %s %s" %
                                   (metadata.hostname,
                                    entry.tag.lower(), entry.get('name')))
-                self.logger.error([item.name for item in matching])
+                self.logger.error([item.name for item, _ in matching])
                 self.logger.error("Priority was %s" % max(prio))
                 raise PluginExecutionError
             index = prio.index(max(prio))
 
-        for rname in list(matching[index].cache[1][entry.tag].keys()):
+        cached = matching[index][1]
+        for rname in list(cached[entry.tag].keys()):
             if self._matches(entry, metadata, [rname]):
-                data = matching[index].cache[1][entry.tag][rname]
+                data = cached[entry.tag][rname]
                 break
         if '__text__' in data:
             entry.text = data['__text__']
@@ -933,29 +1162,54 @@ class EntrySet:
         pattern = '(.*/)?%s(\.((H_(?P<hostname>\S+))|' % basename
         pattern += '(G(?P<prio>\d+)_(?P<group>\S+))))?$'
         self.specific = re.compile(pattern)
+        # (hostname -> entries, group entries, entries for all),
+        # rebuilt when entries change
+        self.index = None
+
+    def get_index(self):
+        """Return the entries indexed by specificity.  Entries of the
+        same specificity are ordered by name, deltas first; group
+        entries are ordered by priority, highest first."""
+        index = self.index
+        if index is None:
+            hosts = {}
+            groups = []
+            alls = []
+            names = list(self.entries.keys())
+            names.sort()
+            names.sort(key=lambda name: not self.entries[name].specific.delta)
+            for name in names:
+                ent = self.entries[name]
+                if ent.specific.hostname:
+                    hosts.setdefault(ent.specific.hostname, []).append(ent)
+                elif ent.specific.group:
+                    groups.append(ent)
+                elif ent.specific.all:
+                    alls.append(ent)
+            groups.sort(key=lambda ent: -ent.specific.prio)
+            index = self.index = (hosts, groups, alls)
+        return index
 
     def get_matching(self, metadata):
-        return [item for item in list(self.entries.values())
-                if item.specific.matches(metadata)]
+        """Return the entries that apply to a client, most specific
+        first."""
+        hosts, groups, alls = self.get_index()
+        return (hosts.get(metadata.hostname, []) +
+                [ent for ent in groups
+                 if ent.specific.group in metadata.groups] +
+                alls)
 
     def best_matching(self, metadata):
         """ Return the appropriate interpreted template from the set of
         available templates. """
-        matching = self.get_matching(metadata)
-
-        hspec = [ent for ent in matching if ent.specific.hostname]
-        if hspec:
-            return hspec[0]
-
-        gspec = [ent for ent in matching if ent.specific.group]
-        if gspec:
-            gspec.sort(self.group_sortfunc)
-            return gspec[-1]
-
-        aspec = [ent for ent in matching if ent.specific.all]
-        if aspec:
-            return aspec[0]
-
+        hosts, groups, alls = self.get_index()
+        if metadata.hostname in hosts:
+            return hosts[metadata.hostname][0]
+        for ent in groups:
+            if ent.specific.group in metadata.groups:
+                return ent
+        if alls:
+            return alls[0]
         raise PluginExecutionError
 
     def handle_event(self, event):
@@ -971,6 +1225,7 @@ class EntrySet:
 
         if action in ['exists', 'created']:
             self.entry_init(event)
+            self.index = None
         else:
             if event.filename not in self.entries:
                 return
@@ -978,6 +1233,7 @@ class EntrySet:
                 self.entries[event.filename].handle_event(event)
             elif action == 'deleted':
                 del self.entries[event.filename]
+                self.index = None
 
     def entry_init(self, event):
         """Handle template and info file creation."""
@@ -1122,6 +1378,11 @@ class GroupSpool(Plugin, Generator):
             else:
                 self.entries[ident].handle_event(event)
 
+    def get_dependencies(self, metadata, entry=None):
+        if entry is None:
+            return [self.data]
+        return ["".join([self.data, entry.get('name')])]
+
     def AddDirectoryMonitor(self, relative):
         """Add new directory to FAM structures."""
         if not relative.endswith('/'):
@@ -72,6 +72,18 @@ class Bundler(Bcfg2.Server.Plugin.Plugin,
                                                                         spec,
                                                                         self.encoding)
 
+    def get_dependencies(self, metadata, entry=None):
+        """Bundles are only affected by their own files, or by the
+        creation of a file for a bundle that is missing."""
+        deps = []
+        for bundlename in metadata.bundles:
+            deps.extend([os.path.join(self.data, "%s.%s" % (bundlename, ext))
+                         for ext in ['xml', 'genshi']])
+        deps.extend([item.name for (key, item) in self.entries.items()
+                     if self.patterns.match(os.path.basename(key)).group('name')
+                     in metadata.bundles])
+        return deps
+
     def BuildStructures(self, metadata):
         """Build all structures for client (metadata)."""
         bundleset = []
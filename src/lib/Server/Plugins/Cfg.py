@@ -4,18 +4,23 @@ __revision__ = '$Revision$'
 import binascii
 import logging
 import lxml
-import operator
 import os
 import os.path
 import re
 import stat
 import sys
-import tempfile
-from subprocess import Popen, PIPE
-from Bcfg2.Bcfg2Py3k import u_str
+import threading
+from collections import deque
+from Bcfg2.Bcfg2Py3k import ConfigParser, u_str
 
+import Bcfg2.Server.Cache
 import Bcfg2.Server.Plugin
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
 try:
     import genshi.core
     import genshi.input
@@ -33,6 +38,21 @@ except:
 
 logger = logging.getLogger('Bcfg2.Plugins.Cfg')
 
+try:
+    PLAIN_TYPES = (type(None), bool, int, long, float, str, unicode)
+except NameError:
+    PLAIN_TYPES = (type(None), bool, int, float, str, bytes)
+
+# compiled templates, by file name
+template_cache = {}
+# metadata attributes read by each template, by file name; None if
+# its output cannot be cached
+template_reads = {}
+# rendered templates; set up by the Cfg plugin if enabled in bcfg2.conf
+output_cache = None
+cache_generation = 0
+cache_lock = threading.Lock()
+
 
 # snipped from TGenshi
 def removecomment(stream):
@@ -43,37 +63,272 @@ def removecomment(stream):
         yield kind, data, pos
 
 
+def is_plain(value):
+    """Return True if value is built only of basic types, so that
+    it can be compared with the value seen by another client."""
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return all([is_plain(item) for item in value])
+    elif isinstance(value, dict):
+        return all([is_plain(key) and is_plain(val)
+                    for key, val in value.items()])
+    return isinstance(value, PLAIN_TYPES)
+
+
+class TemplateMetadata(object):
+    """Wraps a ClientMetadata object and records which of its
+    attributes a template reads."""
+
+    def __init__(self, metadata):
+        self._metadata = metadata
+        self._reads = set()
+        self._cacheable = True
+
+    def __getattr__(self, attr):
+        value = getattr(self._metadata, attr)
+        if attr == 'inGroup':
+            self._reads.add('groups')
+        elif attr == 'group_in_category':
+            self._reads.update(['groups', 'categories'])
+        elif attr.startswith('_') or not is_plain(value):
+            # query, connector objects and the like
+            self._cacheable = False
+        else:
+            self._reads.add(attr)
+        return value
+
+
+def load_template(fname, encoding):
+    """Return the compiled genshi template or cheetah template class
+    for fname, compiling it if it is not cached yet."""
+    template = template_cache.get(fname)
+    if template is None:
+        if fname.endswith(".genshi"):
+            template = TemplateLoader().load(fname, cls=NewTextTemplate,
+                                             encoding=encoding)
+        else:
+            s = {'useStackFrames': False}
+            template = Cheetah.Template.Template.compile(open(fname).read(),
+                                                         compilerSettings=s)
+        template_cache[fname] = template
+    return template
+
+
+def expire_templates(path):
+    """Drop compiled templates in directory path and all rendered
+    templates."""
+    global cache_generation
+    cache_lock.acquire()
+    try:
+        for fname in list(template_cache.keys()):
+            if os.path.dirname(fname) == path:
+                del template_cache[fname]
+        for fname in list(template_reads.keys()):
+            if os.path.dirname(fname) == path:
+                del template_reads[fname]
+        cache_generation += 1
+        if output_cache is not None:
+            output_cache.clear()
+    finally:
+        cache_lock.release()
+
+
+def output_key(fname, name, metadata, reads, generation):
+    """Return the output cache key of template fname rendered for
+    entry name and client metadata."""
+    return (fname, name, generation,
+            tuple([(attr, Bcfg2.Server.Cache.canonical(getattr(metadata,
+                                                               attr)))
+                   for attr in sorted(reads)]))
+
+
+HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+class PatchError(Exception):
+    """A diff could not be applied."""
+    pass
+
+
+def parse_hunks(diff):
+    """Parse a unified diff into a list of (old start, lines) hunks,
+    where lines is a list of (' ', '-' or '+', text) pairs.  Text
+    keeps its newline unless the diff says there is none."""
+    hunks = []
+    lines = diff.split('\n')
+    i = 0
+    while i < len(lines):
+        match = HUNK_RE.match(lines[i])
+        i += 1
+        if not match:
+            continue
+        start = int(match.group(1))
+        oldcount = int(match.group(2) or 1)
+        newcount = int(match.group(4) or 1)
+        if oldcount == 0:
+            # insertion after line start
+            start += 1
+        hunk = []
+        old = new = 0
+        while i < len(lines) and (old < oldcount or new < newcount or
+                                  lines[i].startswith('\\')):
+            line = lines[i]
+            i += 1
+            if line.startswith('\\'):
+                # "\ No newline at end of file"
+                if hunk:
+                    hunk[-1] = (hunk[-1][0], hunk[-1][1][:-1])
+                continue
+            if line == '':
+                # context line whose whitespace was stripped
+                line = ' '
+            if line[0] not in ' -+':
+                raise PatchError("malformed hunk at line %d" % i)
+            if line[0] != '+':
+                old += 1
+            if line[0] != '-':
+                new += 1
+            hunk.append((line[0], line[1:] + '\n'))
+        if old != oldcount or new != newcount:
+            raise PatchError("truncated hunk at line %d" % i)
+        hunks.append((start, hunk))
+    if not hunks:
+        raise PatchError("no hunks found")
+    return hunks
+
+
+def locate_hunk(lines, frozen, first, in_offset, pattern, prefix_context,
+                suffix_context, fuzz):
+    """Find where the pattern of a hunk that starts at line first
+    matches lines, searching outward from first plus in_offset and
+    ignoring up to fuzz lines of context at either end.  Returns a
+    tuple of the 1-based line and the number of leading and trailing
+    lines ignored, or None.  This follows the search done by GNU
+    patch, including its rule that a hunk with less context at one
+    end than the other must match at the start or end of the file;
+    frozen is the number of lines consumed by earlier hunks."""
+    first_guess = first + in_offset
+    context = max(prefix_context, suffix_context)
+    prefix_fuzz = fuzz + prefix_context - context
+    suffix_fuzz = fuzz + suffix_context - context
+
+    def matches(where, pfuzz, sfuzz):
+        """Check pattern against lines at where."""
+        for idx in range(pfuzz, len(pattern) - sfuzz):
+            line = where + idx - 1
+            if line < 0 or line >= len(lines) or lines[line] != pattern[idx]:
+                return False
+        return True
+
+    if not pattern:
+        return (first_guess, 0, 0)
+    if prefix_fuzz < 0 and first <= 1:
+        # can only match the start of the file
+        if frozen == 0 and matches(1, 0, suffix_fuzz):
+            return (1, 0, suffix_fuzz)
+        return None
+    elif prefix_fuzz < 0:
+        prefix_fuzz = 0
+    min_where = frozen + 1
+    if suffix_fuzz < 0:
+        # can only match the end of the file
+        where = len(lines) - len(pattern) + 1
+        if where >= min_where and matches(where, prefix_fuzz, 0):
+            return (where, prefix_fuzz, 0)
+        return None
+    # ignored trailing context may run past the end of the file
+    max_where = len(lines) - len(pattern) + suffix_fuzz + 1
+    for offset in range(max(max_where - first_guess,
+                            first_guess - min_where) + 1):
+        for where in [first_guess + offset, first_guess - offset]:
+            if (min_where <= where <= max_where and
+                matches(where, prefix_fuzz, suffix_fuzz)):
+                return (where, prefix_fuzz, suffix_fuzz)
+    return None
+
+
+def apply_diff(data, diff, maxfuzz=2):
+    """Apply unified diff to data like patch -u -f does, and return
+    the result.  Raises PatchError if any hunk fails."""
+    lines = data.splitlines(True)
+    output = []
+    frozen = 0
+    in_offset = 0
+    for start, hunk in parse_hunks(diff):
+        pattern = [text for kind, text in hunk if kind != '+']
+        prefix_context = 0
+        while (prefix_context < len(hunk) and
+               hunk[prefix_context][0] == ' '):
+            prefix_context += 1
+        suffix_context = 0
+        while (suffix_context < len(hunk) - prefix_context and
+               hunk[-suffix_context - 1][0] == ' '):
+            suffix_context += 1
+        found = None
+        for fuzz in range(min(maxfuzz, max(prefix_context,
+                                           suffix_context)) + 1):
+            found = locate_hunk(lines, frozen, start, in_offset, pattern,
+                                prefix_context, suffix_context, fuzz)
+            if found:
+                break
+        if not found:
+            raise PatchError("hunk at line %d failed" % start)
+        where, prefix_fuzz, suffix_fuzz = found
+        in_offset = where - start
+        # ignored context lines are left to the file
+        hunk = hunk[prefix_fuzz:len(hunk) - suffix_fuzz]
+        output.extend(lines[frozen:where - 1 + prefix_fuzz])
+        frozen = where - 1 + prefix_fuzz
+        for kind, text in hunk:
+            if kind == ' ':
+                output.append(lines[frozen])
+            if kind != '+':
+                frozen += 1
+            else:
+                output.append(text)
+    output.extend(lines[frozen:])
+    # a line without a newline that is no longer at the end of the
+    # file gets one, as patch does
+    for idx in range(len(output) - 1):
+        if not output[idx].endswith('\n'):
+            output[idx] += '\n'
+    return ''.join(output)
+
+
+def process_cat(data, delta):
+    """Apply a .cat delta: append each + line, and remove the first
+    remaining occurrence of each - line."""
+    datalines = data.strip().split('\n')
+    positions = {}
+    for idx, line in enumerate(datalines):
+        positions.setdefault(line, deque()).append(idx)
+    removed = set()
+    for line in delta.data.split('\n'):
+        if not line:
+            continue
+        if line[0] == '+':
+            positions.setdefault(line[1:], deque()).append(len(datalines))
+            datalines.append(line[1:])
+        elif line[0] == '-':
+            if positions.get(line[1:]):
+                removed.add(positions[line[1:]].popleft())
+    return "\n".join([line for idx, line in enumerate(datalines)
+                      if idx not in removed]) + "\n"
+
+
 def process_delta(data, delta):
     if not delta.specific.delta:
         return data
     if delta.specific.delta == 'cat':
-        datalines = data.strip().split('\n')
-        for line in delta.data.split('\n'):
-            if not line:
-                continue
-            if line[0] == '+':
-                datalines.append(line[1:])
-            elif line[0] == '-':
-                if line[1:] in datalines:
-                    datalines.remove(line[1:])
-        return "\n".join(datalines) + "\n"
+        return process_cat(data, delta)
     elif delta.specific.delta == 'diff':
-        basehandle, basename = tempfile.mkstemp()
-        basefile = open(basename, 'w')
-        basefile.write(data)
-        basefile.close()
-        os.close(basehandle)
-        
-        cmd = ["patch", "-u", "-f", basefile.name]
-        patch = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        stderr = patch.communicate(input=delta.data)[1]
-        ret = patch.wait()
-        output = open(basefile.name, 'r').read()
-        os.unlink(basefile.name)
-        if ret >> 8 != 0:
-            logger.error("Error applying diff %s: %s" % (delta.name, stderr))
+        # unlike the old patch(1) pipeline, which never noticed a
+        # failed patch, a diff that does not apply fails the entry
+        try:
+            return apply_diff(data, delta.data)
+        except PatchError:
+            e = sys.exc_info()[1]
+            logger.error("Error applying diff %s: %s" % (delta.name, e))
             raise Bcfg2.Server.Plugin.PluginExecutionError('delta', delta)
-        return output
 
 
 class CfgMatcher:
@@ -99,6 +354,22 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
                                               entry_type, encoding)
         self.specific = CfgMatcher(path.split('/')[-1])
         path = path
+        # file name -> md5 of its content
+        self.digests = {}
+        # digests of base file and deltas -> patched data
+        self.deltas = {}
+
+    def handle_event(self, event):
+        Bcfg2.Server.Plugin.EntrySet.handle_event(self, event)
+        # expire only once the new data is loaded, so that a bind
+        # running meanwhile cannot cache results of the old data
+        if event.filename not in ['info', 'info.xml', ':info']:
+            self.digests.pop(event.filename, None)
+            self.deltas = {}
+        if (event.filename.endswith(".genshi") or
+            event.filename.endswith(".cheetah") or
+            event.filename.endswith(".genshi_include")):
+            expire_templates(self.path)
 
     def sort_by_specific(self, one, other):
         return cmp(one.specific, other.specific)
@@ -107,13 +378,11 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
         """return a list of all entries pertinent
         to a client => [base, delta1, delta2]
         """
-        matching = [ent for ent in list(self.entries.values()) if \
-                    ent.specific.matches(metadata)]
-        matching.sort(key=operator.attrgetter('specific'))
+        matching = self.get_matching(metadata)
         # base entries which apply to a client
         # (e.g. foo, foo.G##_groupname, foo.H_hostname)
-        base_files = [matching.index(m) for m in matching
-                      if not m.specific.delta]
+        base_files = [idx for idx, ent in enumerate(matching)
+                      if not ent.specific.delta]
         if not base_files:
             logger.error("No base file found for %s" % entry.get('name'))
             raise Bcfg2.Server.Plugin.PluginExecutionError
@@ -137,49 +406,18 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
             if not have_genshi:
                 logger.error("Cfg: Genshi is not available")
                 raise Bcfg2.Server.Plugin.PluginExecutionError
-            try:
-                template_cls = NewTextTemplate
-                loader = TemplateLoader()
-                template = loader.load(basefile.name, cls=template_cls,
-                                       encoding=self.encoding)
-                fname = entry.get('realname', entry.get('name'))
-                stream = template.generate(name=fname,
-                                           metadata=metadata,
-                                           path=basefile.name).filter(removecomment)
-                try:
-                    data = stream.render('text', encoding=self.encoding,
-                                         strip_whitespace=False)
-                except TypeError:
-                    data = stream.render('text', encoding=self.encoding)
-                if data == '':
-                    entry.set('empty', 'true')
-            except Exception:
-                e = sys.exc_info()[1]
-                logger.error("Cfg: genshi exception: %s" % e)
-                raise Bcfg2.Server.Plugin.PluginExecutionError
+            data = self.render_template(basefile, entry, metadata)
+            if data == '':
+                entry.set('empty', 'true')
         elif basefile.name.endswith(".cheetah"):
             if not have_cheetah:
                 logger.error("Cfg: Cheetah is not available")
                 raise Bcfg2.Server.Plugin.PluginExecutionError
-            try:
-                fname = entry.get('realname', entry.get('name'))
-                s = {'useStackFrames': False}
-                template = Cheetah.Template.Template(open(basefile.name).read(),
-                                                       compilerSettings=s)
-                template.metadata = metadata
-                template.path = fname
-                template.source_path = basefile.name
-                data = template.respond()
-                if data == '':
-                    entry.set('empty', 'true')
-            except Exception:
-                e = sys.exc_info()[1]
-                logger.error("Cfg: cheetah exception: %s" % e)
-                raise Bcfg2.Server.Plugin.PluginExecutionError
+            data = self.render_template(basefile, entry, metadata)
+            if data == '':
+                entry.set('empty', 'true')
         else:
-            data = basefile.data
-            for delta in used:
-                data = process_delta(data, delta)
+            data = self.apply_deltas(basefile, used)
         if entry.get('encoding') == 'base64':
             entry.text = binascii.b2a_base64(data)
         else:
@@ -200,6 +438,97 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
         if entry.text in ['', None]:
             entry.set('empty', 'true')
 
+    def digest(self, ent):
+        """Return the md5 digest of the content of ent."""
+        name = os.path.basename(ent.name)
+        digest = self.digests.get(name)
+        if digest is None:
+            digest = md5(ent.data).hexdigest()
+            self.digests[name] = digest
+        return digest
+
+    def apply_deltas(self, basefile, deltas):
+        """Apply deltas to basefile, reusing the result of an earlier
+        bind from the same files."""
+        if not deltas:
+            return basefile.data
+        key = tuple([(ent.specific.delta, self.digest(ent))
+                     for ent in [basefile] + deltas])
+        # handle_event may replace self.deltas meanwhile
+        data = self.deltas.get(key)
+        if data is None:
+            data = basefile.data
+            for delta in deltas:
+                data = process_delta(data, delta)
+            self.deltas[key] = data
+        return data
+
+    def render_template(self, basefile, entry, metadata):
+        """Render a genshi or cheetah base file.  If the output cache
+        is enabled, output rendered for another client is reused when
+        the template read the same metadata for both clients."""
+        fname = entry.get('realname', entry.get('name'))
+        if output_cache is None:
+            return self.render(basefile.name, fname, metadata)
+        generation = cache_generation
+        reads = template_reads.get(basefile.name, set())
+        if reads is None:
+            return self.render(basefile.name, fname, metadata)
+        data = output_cache.get(output_key(basefile.name, fname, metadata,
+                                           reads, generation))
+        if data is not None:
+            return data
+        proxy = TemplateMetadata(metadata)
+        data = self.render(basefile.name, fname, proxy)
+        cache_lock.acquire()
+        try:
+            if generation != cache_generation:
+                # the template changed while it was rendered
+                return data
+            if not proxy._cacheable:
+                logger.debug("Cfg: Not caching output of %s" % basefile.name)
+                template_reads[basefile.name] = None
+                return data
+            reads = template_reads.get(basefile.name, set())
+            if reads is None:
+                return data
+            reads = reads | proxy._reads
+            template_reads[basefile.name] = reads
+        finally:
+            cache_lock.release()
+        output_cache.set(output_key(basefile.name, fname, metadata, reads,
+                                    generation), data)
+        return data
+
+    def render(self, tname, fname, metadata):
+        """Render template file tname for entry fname."""
+        if tname.endswith(".genshi"):
+            try:
+                template = load_template(tname, self.encoding)
+                stream = template.generate(name=fname,
+                                           metadata=metadata,
+                                           path=tname).filter(removecomment)
+                try:
+                    return stream.render('text', encoding=self.encoding,
+                                         strip_whitespace=False)
+                except TypeError:
+                    return stream.render('text', encoding=self.encoding)
+            except Exception:
+                e = sys.exc_info()[1]
+                logger.error("Cfg: genshi exception: %s" % e)
+                raise Bcfg2.Server.Plugin.PluginExecutionError
+        else:
+            try:
+                template = load_template(tname, self.encoding)()
+                template.metadata = metadata
+                template.path = fname
+                template.source_path = tname
+                return template.respond()
+            except Exception:
+                e = sys.exc_info()[1]
+                logger.error("Cfg: cheetah exception: %s" % e)
+                raise Bcfg2.Server.Plugin.PluginExecutionError
+
     def list_accept_choices(self, entry, metadata):
         '''return a list of candidate pull locations'''
         used = self.get_pertinent_entries(entry, metadata)
@@ -262,6 +591,26 @@ class Cfg(Bcfg2.Server.Plugin.GroupSpool,
     __author__ = 'bcfg-dev@mcs.anl.gov'
     es_cls = CfgEntrySet
     es_child_cls = Bcfg2.Server.Plugin.SpecificData
+    # the delta and template caches are safe to share between threads
+    thread_safe = True
+
+    def __init__(self, core, datastore):
+        global output_cache
+        cp = ConfigParser.ConfigParser()
+        cp.read(core.cfile)
+        try:
+            enabled = cp.getboolean("cfg", "output_cache")
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            enabled = False
+        if enabled:
+            try:
+                size = cp.getint("cfg", "output_cache_size")
+            except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+                size = 1024
+            output_cache = Bcfg2.Server.Cache.LRUCache(size=size)
+        else:
+            output_cache = None
+        Bcfg2.Server.Plugin.GroupSpool.__init__(self, core, datastore)
 
     def AcceptChoices(self, entry, metadata):
         return self.entries[entry.get('name')].list_accept_choices(entry, metadata)
@@ -3,6 +3,7 @@ import difflib
 import logging
 import lxml.etree
 import platform
+import sys
 import time
 
 try:
@@ -12,6 +13,7 @@ except ImportError:
 
 import Bcfg2.Server.Plugin
 import Bcfg2.Server.Reports.importscript
+from Bcfg2.Bcfg2Py3k import ConfigParser
 from Bcfg2.Server.Reports.reports.models import Client
 import Bcfg2.Server.Reports.settings
 from Bcfg2.Server.Reports.updatefix import update_database
@@ -26,6 +28,13 @@ class DBStats(Bcfg2.Server.Plugin.Plugin,
 
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
+        cp = ConfigParser.ConfigParser()
+        cp.read(core.cfile)
+        try:
+            self.batch_size = cp.getint("statistics", "batch_size")
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            self.batch_size = Bcfg2.Server.Reports.importscript.BATCH_SIZE
+        # the batch size must be set before the thread starts
         Bcfg2.Server.Plugin.ThreadedStatistics.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.PullSource.__init__(self)
         self.cpath = "%s/Metadata/clients.xml" % datastore
@@ -39,41 +48,59 @@ class DBStats(Bcfg2.Server.Plugin.Plugin,
             logger.debug(str(type(inst)))
 
     def handle_statistic(self, metadata, data):
-        newstats = data.find("Statistics")
-        newstats.set('time', time.asctime(time.localtime()))
-        # ick
-        data = lxml.etree.tostring(newstats)
-        ndx = lxml.etree.XML(data)
-        e = lxml.etree.Element('Node', name=metadata.hostname)
-        e.append(ndx)
+        self.handle_statistics_batch([(metadata, data)])
+
+    def handle_statistics_batch(self, batch):
+        nodes = []
+        for (metadata, data) in batch:
+            newstats = data.find("Statistics")
+            newstats.set('time', time.asctime(time.localtime()))
+            node = lxml.etree.Element('Node', name=metadata.hostname)
+            node.append(newstats)
+            nodes.append(node)
+        if not self.import_nodes(nodes) and len(nodes) > 1:
+            # find the interactions that cannot be imported
+            logger.error("DBStats: Importing %s interactions one at a time" %
+                         len(nodes))
+            for node in nodes:
+                self.import_nodes([node])
+
+    def import_nodes(self, nodes):
+        """Import a list of Node elements in one transaction.  Returns
+        True on success."""
         container = lxml.etree.Element("ConfigStatistics")
-        container.append(e)
+        container.extend(nodes)
+        hostnames = ", ".join([node.get('name') for node in nodes])
 
         # FIXME need to build a metadata interface to expose a list of clients
         start = time.time()
         for i in [1, 2, 3]:
             try:
-                Bcfg2.Server.Reports.importscript.load_stats(self.core.metadata.clients_xml.xdata,
-                                                             container,
-                                                             self.core.encoding,
-                                                             0,
-                                                             logger,
-                                                             True,
-                                                             platform.node())
-                logger.info("Imported data for %s in %s seconds" \
-                            % (metadata.hostname, time.time() - start))
-                return
+                count = Bcfg2.Server.Reports.importscript.load_stats(self.core.metadata.clients_xml.xdata,
+                                                                     container,
+                                                                     self.core.encoding,
+                                                                     0,
+                                                                     logger,
+                                                                     True,
+                                                                     platform.node(),
+                                                                     batch_size=len(nodes))
+                elapsed = time.time() - start
+                logger.info("Imported %s interactions in %.2f seconds "
+                            "(%.1f interactions/sec)" %
+                            (count, elapsed, count / max(elapsed, 0.001)))
+                return True
             except MultipleObjectsReturned:
                 e = sys.exc_info()[1]
                 logger.error("DBStats: MultipleObjectsReturned while handling %s: %s" % \
-                    (metadata.hostname, e))
+                    (hostnames, e))
                 logger.error("DBStats: Data is inconsistent")
                 break
             except:
                 logger.error("DBStats: Failed to write to db (lock); retrying",
                              exc_info=1)
         logger.error("DBStats: Retry limit failed for %s; aborting operation" \
-                    % metadata.hostname)
+                    % hostnames)
+        return False
 
     def GetExtra(self, client):
         c_inst = Client.objects.filter(name=client)[0]
@@ -27,6 +27,7 @@ class Defaults(Bcfg2.Server.Plugins.Rules.Rules,
 
     def HandleEvent(self, event):
         Bcfg2.Server.Plugin.XMLDirectoryBacked.HandleEvent(self, event)
+        self.source_index = {}
 
     def validate_structures(self, metadata, structures):
         """ Apply defaults """
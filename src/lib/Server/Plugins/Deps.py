@@ -8,22 +8,21 @@ import Bcfg2.Server.Plugin
 
 class DNode(Bcfg2.Server.Plugin.INode):
     """DNode provides supports for single predicate types for dependencies."""
-    raw = {'Group': "lambda m, e:'%(name)s' in m.groups and predicate(m, e)"}
+    tests = {'Group': Bcfg2.Server.Plugin.INode.tests['Group']}
+    # Deps does not support negated groups
+    ntests = tests
     containers = ['Group']
 
     def __init__(self, data, idict, parent=None):
         self.data = data
         self.contents = {}
+        self.test = self.compile(data, parent)
         if parent == None:
             self.predicate = lambda x, d: True
         else:
+            test = self.test
             predicate = parent.predicate
-            if data.tag in list(self.raw.keys()):
-                self.predicate = eval(self.raw[data.tag] %
-                                      {'name': data.get('name')},
-                                      {'predicate': predicate})
-            else:
-                raise Exception
+            self.predicate = lambda m, e: test(m, e) and predicate(m, e)
         mytype = self.__class__
         self.children = []
         for item in data.getchildren():
@@ -104,16 +103,17 @@ class Deps(Bcfg2.Server.Plugin.PrioDir,
         set of entries.
         """
         prereqs = []
-        [src.Cache(metadata) for src in self.entries.values()]
+        cached = [(src, src.Cache(metadata))
+                  for src in list(self.entries.values())]
+        cached = [(src, data) for src, data in cached if data]
 
         toexamine = list(entries[:])
         while toexamine:
             entry = toexamine.pop()
-            matching = [src for src in list(self.entries.values())
-                        if src.cache and entry[0] in src.cache[1]
-                        and entry[1] in src.cache[1][entry[0]]]
+            matching = [(src, data) for src, data in cached
+                        if entry[0] in data and entry[1] in data[entry[0]]]
             if len(matching) > 1:
-                prio = [int(src.priority) for src in matching]
+                prio = [int(src.priority) for src, _ in matching]
                 if prio.count(max(prio)) > 1:
                     self.logger.error("Found conflicting %s sources with same priority for %s, pkg %s" %
                                       (entry[0].lower(), metadata.hostname, entry[1]))
@@ -121,7 +121,7 @@ class Deps(Bcfg2.Server.Plugin.PrioDir,
                 index = prio.index(max(prio))
                 matching = [matching[index]]
             elif len(matching) == 1:
-                for prq in matching[0].cache[1][entry[0]][entry[1]]:
+                for prq in matching[0][1][entry[0]][entry[1]]:
                     # XML comments seem to show up in the cache as a
                     # tuple with item 0 being callable. The logic
                     # below filters them out. Would be better to
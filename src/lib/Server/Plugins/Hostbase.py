@@ -95,6 +95,9 @@ class Hostbase(Bcfg2.Server.Plugin.Plugin,
         self.buildHostsLPD()
         self.buildPrinters()
         self.buildNetgroups()
+        # Entries changed outside of FAM event handling
+        self.core.expire_dispatch_index()
+        self.core.expire_config_cache()
         return True
 
     def buildZones(self):
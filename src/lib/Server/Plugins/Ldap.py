@@ -66,6 +66,8 @@ class Ldap(Bcfg2.Server.Plugin.Plugin, Bcfg2.Server.Plugin.Connector):
     version = "$Revision: $"
     experimental = True
     debug_flag = False
+    # query results can change at any time
+    volatile = True
     
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
@@ -11,6 +11,7 @@ import os
 import os.path
 import socket
 import sys
+import threading
 import time
 
 import Bcfg2.Server.FileMonitor
@@ -256,10 +257,19 @@ class Metadata(Bcfg2.Server.Plugin.Plugin,
         self.categories = {}
         self.bad_clients = {}
         self.uuid = {}
+        # client -> uuid, the reverse of self.uuid
+        self.ruuid = {}
         self.secure = []
         self.floating = []
         self.passwords = {}
         self.session_cache = {}
+        # group -> clients, built from client metadata as it is
+        # needed, and client -> the groups it is indexed under
+        self.clients_by_group = {}
+        self.client_groups = {}
+        self.group_index_lock = threading.Lock()
+        # profile -> clients, rebuilt whenever self.clients changes
+        self.clients_by_profile = None
         self.default = None
         self.pdirty = False
         self.extra = {'groups.xml': [],
@@ -425,6 +435,8 @@ class Metadata(Bcfg2.Server.Plugin.Plugin,
 
     def HandleEvent(self, event):
         """Handle update events for data files."""
+        old = (dict(self.clients), self.groups, self.categories,
+               set(self.private))
         if self.clients_xml.HandleEvent(event):
             xdata = self.clients_xml.xdata
             self.clients = {}
@@ -435,6 +447,8 @@ class Metadata(Bcfg2.Server.Plugin.Plugin,
             self.floating = []
             self.addresses = {}
             self.raddresses = {}
+            self.uuid = {}
+            self.ruuid = {}
             for client in xdata.findall('.//Client'):
                 clname = client.get('name').lower()
                 if 'address' in client.attrib:
@@ -451,6 +465,7 @@ class Metadata(Bcfg2.Server.Plugin.Plugin,
                                                                'cert+password')
                 if 'uuid' in client.attrib:
                     self.uuid[client.get('uuid')] = clname
+                    self.ruuid[clname] = client.get('uuid')
                 if client.get('secure', 'false') == 'true':
                     self.secure.append(clname)
                 if client.get('location', 'fixed') == 'floating':
@@ -539,6 +554,9 @@ class Metadata(Bcfg2.Server.Plugin.Plugin,
                     self.logger.info("Restored profile mapping for client %s" % bclient)
                     self.clients[bclient] = self.bad_clients[bclient]
                     del self.bad_clients[bclient]
+        self.clients_by_profile = None
+        self.update_group_index(*old)
+        self.core.expire_metadata_cache(group_index=False)
 
     def set_profile(self, client, profile, addresspair):
         """Set group parameter for provided client."""
@@ -571,7 +589,9 @@ class Metadata(Bcfg2.Server.Plugin.Plugin,
                                       'Client', name=client,
                                       profile=profile)
         self.clients[client] = profile
+        self.clients_by_profile = None
         self.clients_xml.write()
+        self.core.expire_metadata_cache(client)
 
     def resolve_client(self, addresspair, cleanup_cache=False):
         """Lookup address locally or in DNS to get a hostname."""
@@ -635,11 +655,7 @@ class Metadata(Bcfg2.Server.Plugin.Plugin,
             password = self.passwords[client]
         else:
             password = None
-        uuids = [item for item, value in list(self.uuid.items()) if value == client]
-        if uuids:
-            uuid = uuids[0]
-        else:
-            uuid = None
+        uuid = self.ruuid.get(client)
         for group in self.cgroups.get(client, []):
             if group in self.groups:
                 nbundles, ngroups, ncategories = self.groups[group]
@@ -663,13 +679,90 @@ class Metadata(Bcfg2.Server.Plugin.Plugin,
         return all_groups
 
     def get_client_names_by_profiles(self, profiles):
-        return [client for client, profile in list(self.clients.items()) \
-                if profile in profiles]
+        index = self.clients_by_profile
+        if index is None:
+            index = dict()
+            for client, profile in list(self.clients.items()):
+                index.setdefault(profile, []).append(client)
+            self.clients_by_profile = index
+        return sum([index.get(profile, []) for profile in set(profiles)], [])
 
     def get_client_names_by_groups(self, groups):
-        mdata = [self.core.build_metadata(client)
-                 for client in list(self.clients.keys())]
-        return [md.hostname for md in mdata if md.groups.issuperset(groups)]
+        if not self.core.metadata_cache_enabled:
+            # group memberships may change at any time
+            mdata = [self.core.build_metadata(client)
+                     for client in list(self.clients.keys())]
+            return [md.hostname for md in mdata if md.groups.issuperset(groups)]
+        for client in list(self.clients.keys()):
+            if client not in self.client_groups:
+                self.index_client_groups(client,
+                                         self.core.build_metadata(client).groups)
+        self.group_index_lock.acquire()
+        try:
+            members = [self.clients_by_group.get(group, set())
+                       for group in groups]
+            if not members:
+                return [client for client in list(self.client_groups.keys())
+                        if client in self.clients]
+            members.sort(key=len)
+            return [client for client in members[0]
+                    if client in self.clients and
+                    not [grp for grp in members[1:] if client not in grp]]
+        finally:
+            self.group_index_lock.release()
+
+    def index_client_groups(self, client, groups):
+        """Record that client is a member of groups."""
+        self.group_index_lock.acquire()
+        try:
+            self._unindex_client(client)
+            self.client_groups[client] = frozenset(groups)
+            for group in groups:
+                try:
+                    self.clients_by_group[group].add(client)
+                except KeyError:
+                    self.clients_by_group[group] = set([client])
+        finally:
+            self.group_index_lock.release()
+
+    def _unindex_client(self, client):
+        """Remove client from the group index; the lock must be held."""
+        for group in self.client_groups.pop(client, []):
+            self.clients_by_group[group].discard(client)
+            if not self.clients_by_group[group]:
+                del self.clients_by_group[group]
+
+    def update_group_index(self, old_clients, old_groups, old_categories,
+                           old_private):
+        """Forget the group memberships of the clients whose profile
+        changed, or that are members of a group whose definition
+        changed, after clients.xml or groups.xml was read."""
+        if (old_categories != self.categories or
+            old_private != set(self.private)):
+            self.expire_group_index()
+            return
+        changed = set([group for group in set(old_groups) | set(self.groups)
+                       if old_groups.get(group) != self.groups.get(group)])
+        self.group_index_lock.acquire()
+        try:
+            for client, groups in list(self.client_groups.items()):
+                if (old_clients.get(client) != self.clients.get(client) or
+                    groups & changed):
+                    self._unindex_client(client)
+        finally:
+            self.group_index_lock.release()
+
+    def expire_group_index(self, client=None):
+        """Forget the group memberships of client, or of all clients."""
+        self.group_index_lock.acquire()
+        try:
+            if client is None:
+                self.clients_by_group = {}
+                self.client_groups = {}
+            else:
+                self._unindex_client(client)
+        finally:
+            self.group_index_lock.release()
 
     def merge_additional_groups(self, imd, groups):
         for group in groups:
@@ -740,6 +833,8 @@ class Metadata(Bcfg2.Server.Plugin.Plugin,
             if user not in self.uuid:
                 client = user
                 self.uuid[user] = user
+                self.ruuid[user] = user
+                self.core.expire_metadata_cache(client)
             else:
                 client = self.uuid[user]
 
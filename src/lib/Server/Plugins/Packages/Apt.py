@@ -134,6 +134,7 @@ class AptSource(Source):
             else:
                 for barch in bprov:
                     self.provides[barch][prov] = bprov[barch].get(prov, ())
+        self.compact()
         self.save_state()
 
     def is_package(self, _, pkg):
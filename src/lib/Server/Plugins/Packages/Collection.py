@@ -1,6 +1,8 @@
 import copy
 import logging
 
+import Bcfg2.Server.Cache
+
 try:
     from hashlib import md5
 except ImportError:
@@ -20,6 +22,59 @@ logger = logging.getLogger("Packages")
 # sources to that client.)
 collections = dict()
 
+
+class ClosureCache(Bcfg2.Server.Cache.LRUCache):
+    """ LRU cache of dependency closures computed by
+    Collection.complete().  A closure depends only on the sources
+    that apply to a client, the client groups those sources care
+    about, and the initial package list, so clients that agree on
+    those share a closure.  The generation is bumped whenever the
+    source data is reloaded. """
+
+    def __init__(self, size=256):
+        Bcfg2.Server.Cache.LRUCache.__init__(self, size)
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = Bcfg2.Server.Cache.LRUCache.get(self, key)
+        self.lock.acquire()
+        try:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self.lock.release()
+        return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        Bcfg2.Server.Cache.LRUCache.set(self, key, value)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+        finally:
+            self.lock.release()
+        Bcfg2.Server.Cache.LRUCache.clear(self)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        else:
+            hit_rate = 0.0
+        return dict(size=len(self), maxsize=self.size,
+                    generation=self.generation, hits=self.hits,
+                    misses=self.misses, hit_rate=hit_rate)
+
+closure_cache = ClosureCache()
+
+
 class Collection(object):
     def __init__(self, metadata, sources, basepath):
         """ don't call this directly; use the Factory method """
@@ -137,6 +192,29 @@ class Collection(object):
         pass
 
     def complete(self, packagelist):
+        '''Build the transitive closure of all package dependencies,
+        or look it up in the closure cache
+
+        Arguments:
+        packageslist - set of package names
+        returns => (set(packages), set(unsatisfied requirements))
+        '''
+        key = (self.__class__.__name__,
+               tuple([source.cachekey for source in self.sources]),
+               tuple(self.get_relevant_groups()),
+               frozenset(packagelist),
+               closure_cache.generation)
+        closure = closure_cache.get(key)
+        if closure is None:
+            packages, unknown = self.resolve(packagelist)
+            closure = (frozenset(packages), frozenset(unknown))
+            closure_cache.set(key, closure)
+        else:
+            self.logger.debug("Packages: Using cached dependency closure "
+                              "for %s" % self.metadata.hostname)
+        return set(closure[0]), set(closure[1])
+
+    def resolve(self, packagelist):
         '''Build the transitive closure of all package dependencies
 
         Arguments:
@@ -286,6 +364,7 @@ class Collection(object):
 def clear_cache():
     global collections
     collections = dict()
+    closure_cache.clear()
 
 def factory(metadata, sources, basepath):
     global collections
@@ -114,6 +114,7 @@ class PacSource(Source):
             else:
                 for barch in bprov:
                     self.provides[barch][prov] = bprov[barch].get(prov, ())
+        self.compact()
         self.save_state()
 
     def is_package(self, _, pkg):
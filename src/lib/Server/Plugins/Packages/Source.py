@@ -3,18 +3,47 @@ import re
 import sys
 import base64
 import logging
+import threading
+from array import array
 from Bcfg2.Bcfg2Py3k import HTTPError, HTTPBasicAuthHandler, \
      HTTPPasswordMgrWithDefaultRealm, install_opener, build_opener, \
-     urlopen, file, cPickle
+     urlopen, Request, file, cPickle
+
+try:
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    ThreadPool = None
 
 try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
 
+try:
+    from sys import intern
+except ImportError:
+    # python 2 has intern() as a builtin
+    pass
+
 logger = logging.getLogger('Packages')
 
-def fetch_url(url):
+# the number of repository files that may be downloaded at once,
+# across all sources; see set_download_threads()
+download_threads = 4
+download_slots = threading.BoundedSemaphore(download_threads)
+
+
+def set_download_threads(threads):
+    global download_threads, download_slots
+    if threads != download_threads:
+        download_threads = max(threads, 1)
+        download_slots = threading.BoundedSemaphore(download_threads)
+
+
+def open_url(url, headers=None):
+    """ open url, which may contain a username and password, sending
+    the given extra request headers """
+    opener = None
     if '@' in url:
         mobj = re.match('(\w+://)([^:]+):([^@]+)@(.*)$', url)
         if not mobj:
@@ -24,14 +53,139 @@ def fetch_url(url):
         url = mobj.group(1) + mobj.group(4)
         auth = HTTPBasicAuthHandler(HTTPPasswordMgrWithDefaultRealm())
         auth.add_password(None, url, user, passwd)
-        install_opener(build_opener(auth))
-    return urlopen(url).read()
+        opener = build_opener(auth)
+        install_opener(opener)
+    request = Request(url, headers=headers or dict())
+    if opener is not None:
+        return opener.open(request)
+    return urlopen(request)
+
+
+def fetch_url(url):
+    return open_url(url).read()
 
 
 class SourceInitError(Exception):
     pass
 
 
+def _intern(string):
+    try:
+        return intern(string)
+    except TypeError:
+        # non-ascii unicode strings cannot be interned on python 2
+        return string
+
+
+class StringTable(object):
+    """ a list of the distinct package, dependency and provide names
+    of a source.  DependencyTables refer to names by their index in
+    it, so each name is stored only once no matter how many packages
+    mention it. """
+
+    def __init__(self):
+        self.strings = []
+        self.ids = dict()
+
+    def add(self, string):
+        """ return the id of string, adding it if necessary """
+        if self.ids is None:
+            self.ids = dict([(name, sid)
+                             for sid, name in enumerate(self.strings)])
+        try:
+            return self.ids[string]
+        except KeyError:
+            self.ids[string] = len(self.strings)
+            self.strings.append(_intern(string))
+            return self.ids[string]
+
+    def __getstate__(self):
+        # the reverse index is only needed while tables are built
+        return self.strings
+
+    def __setstate__(self, state):
+        self.strings = [_intern(string) for string in state]
+        self.ids = None
+
+
+def _tobytes(arr):
+    try:
+        return arr.tobytes()
+    except AttributeError:
+        return arr.tostring()
+
+
+def _frombytes(arr, data):
+    try:
+        arr.frombytes(data)
+    except AttributeError:
+        arr.fromstring(data)
+    return arr
+
+
+class DependencyTable(object):
+    """ a read-only replacement for the dicts of name -> list of
+    names used for the deps and provides of a source.  the value
+    lists of all keys are stored back to back as string ids in a
+    single array, with a second array holding the offset at which
+    each key's list starts. """
+
+    def __init__(self, data=None, strings=None):
+        if strings is None:
+            strings = StringTable()
+        self.strings = strings
+        # key -> slot; the values of slot n are
+        # targets[offsets[n]:offsets[n + 1]]
+        self.slots = dict()
+        self.offsets = array('i', [0])
+        self.targets = array('i')
+        if data:
+            for key, values in list(data.items()):
+                self.slots[_intern(key)] = len(self.offsets) - 1
+                self.targets.extend([strings.add(val) for val in values])
+                self.offsets.append(len(self.targets))
+
+    def __getitem__(self, key):
+        slot = self.slots[key]
+        strings = self.strings.strings
+        return tuple([strings[sid] for sid in
+                      self.targets[self.offsets[slot]:self.offsets[slot + 1]]])
+
+    def get(self, key, default=None):
+        if key in self.slots:
+            return self[key]
+        return default
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def keys(self):
+        return list(self.slots.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.slots]
+
+    def __getstate__(self):
+        keys = [None] * len(self.slots)
+        for key, slot in list(self.slots.items()):
+            keys[slot] = key
+        return (self.strings, keys, _tobytes(self.offsets),
+                _tobytes(self.targets))
+
+    def __setstate__(self, state):
+        self.strings, keys, offsets, targets = state
+        self.slots = dict([(_intern(key), slot)
+                           for slot, key in enumerate(keys)])
+        self.offsets = _frombytes(array('i'), offsets)
+        self.targets = _frombytes(array('i'), targets)
+
+
 class Source(object):
     reponame_re = re.compile(r'.*/(?:RPMS\.)?([^/]+)')
     basegroups = []
@@ -105,12 +259,26 @@ class Source(object):
     def load_state(self):
         pass
 
+    def compact(self):
+        """ convert deps and provides to DependencyTables that share
+        one StringTable.  subclasses call this once read_files() has
+        filled them in, before save_state(). """
+        strings = StringTable()
+        for table in [self.deps, self.provides]:
+            for arch, data in list(table.items()):
+                if isinstance(data, DependencyTable):
+                    strings = data.strings
+                else:
+                    table[arch] = DependencyTable(data, strings)
+
     def setup_data(self, force_update=False):
         should_read = True
         should_download = False
         if os.path.exists(self.cachefile):
             try:
                 self.load_state()
+                # cache files written by older versions hold plain dicts
+                self.compact()
                 should_read = False 
             except:
                 logger.error("Packages: Cachefile %s load failed; "
@@ -125,8 +293,14 @@ class Source(object):
 
         if should_download or force_update:
             try:
-                self.update()
-                self.read_files()
+                # the files on disk could not be read, so they must be
+                # downloaded even if the server says they are unchanged
+                if self.update(conditional=not should_download) or \
+                        should_download:
+                    self.read_files()
+                else:
+                    logger.info("Packages: %s is unchanged; not rereading "
+                                "its files" % self)
             except:
                 logger.error("Packages: Failed to load data for Source of %s. "
                              "Some Packages will be missing."
@@ -192,21 +366,67 @@ class Source(object):
     def filter_unknown(self, unknown):
         pass
 
-    def update(self):
-        for url in self.urls:
-            logger.info("Packages: Updating %s" % url)
-            fname = self.escape_url(url)
+    def update(self, conditional=True):
+        """ download the files of this source that have changed since
+        they were last downloaded, or all of them if conditional is
+        False, several at a time.  returns True if any file was
+        downloaded. """
+        urls = self.urls
+        if ThreadPool is None or download_threads < 2 or len(urls) < 2:
+            return True in [self.update_url(url, conditional)
+                            for url in urls]
+        pool = ThreadPool(min(download_threads, len(urls)))
+        try:
+            return True in pool.map(lambda url: self.update_url(url,
+                                                                conditional),
+                                    urls)
+        finally:
+            pool.terminate()
+
+    def update_url(self, url, conditional=True):
+        """ download url if it has changed since the last download,
+        judged by the ETag and Last-Modified headers the server sent
+        with it, or unconditionally if conditional is False.  returns
+        True if it was downloaded. """
+        fname = self.escape_url(url)
+        vfile = "%s.validators" % fname
+        headers = dict()
+        if conditional and os.path.exists(fname) and os.path.exists(vfile):
+            for line in open(vfile).readlines():
+                (header, value) = line.rstrip("\n").split(": ", 1)
+                if header == "ETag":
+                    headers['If-None-Match'] = value
+                elif header == "Last-Modified":
+                    headers['If-Modified-Since'] = value
+        download_slots.acquire()
+        try:
             try:
-                data = fetch_url(url)
-                file(fname, 'w').write(data)
+                response = open_url(url, headers=headers)
+                data = response.read()
             except ValueError:
                 logger.error("Packages: Bad url string %s" % url)
                 raise
             except HTTPError:
                 err = sys.exc_info()[1]
+                if err.code == 304:
+                    logger.info("Packages: %s is unchanged" % url)
+                    return False
                 logger.error("Packages: Failed to fetch url %s. HTTP response code=%s" %
                              (url, err.code))
                 raise
+        finally:
+            download_slots.release()
+        logger.info("Packages: Updated %s" % url)
+        if os.path.exists(vfile):
+            os.unlink(vfile)
+        file(fname, 'wb').write(data)
+        validators = open(vfile, 'w')
+        for header in ["ETag", "Last-Modified"]:
+            value = response.info().get(header)
+            if value:
+                validators.write("%s: %s\n" % (header, value))
+        validators.close()
+        return True
 
     def applies(self, metadata):
         # check base groups
@@ -3,6 +3,7 @@ import sys
 import time
 import copy
 import glob
+import gzip
 import socket
 import random
 import logging
@@ -329,9 +330,9 @@ class YumCollection(Collection):
         pkgs = self.call_helper("get_group", dict(group=group, type=ptype))
         return pkgs
 
-    def complete(self, packagelist):
+    def resolve(self, packagelist):
         if not self.use_yum:
-            return Collection.complete(self, packagelist)
+            return Collection.resolve(self, packagelist)
 
         packages = set()
         unknown = set(packagelist)
@@ -533,6 +534,14 @@ class YumSource(Source):
         return urls
 
     def read_files(self):
+        # start over; after compact() deps and provides are read-only
+        self.packages = dict()
+        self.deps = dict([('global', dict())])
+        self.provides = dict([('global', dict())])
+        self.filemap = dict([(x, dict())
+                             for x in ['global'] + self.arches])
+        self.needed_paths = set()
+
         # we have to read primary.xml first, and filelists.xml afterwards;
         primaries = list()
         filelists = list()
@@ -544,12 +553,18 @@ class YumSource(Source):
 
         for fname in primaries:
             farch = self.file_to_arch[fname]
-            fdata = lxml.etree.parse(fname).getroot()
-            self.parse_primary(fdata, farch)
+            fdata = self.open_metadata(fname)
+            try:
+                self.parse_primary(fdata, farch)
+            finally:
+                fdata.close()
         for fname in filelists:
             farch = self.file_to_arch[fname]
-            fdata = lxml.etree.parse(fname).getroot()
-            self.parse_filelist(fdata, farch)
+            fdata = self.open_metadata(fname)
+            try:
+                self.parse_filelist(fdata, farch)
+            finally:
+                fdata.close()
 
         # merge data
         sdata = list(self.packages.values())
@@ -566,13 +581,34 @@ class YumSource(Source):
                 continue
             self.packages[key] = \
                 self.packages[key].difference(self.packages['global'])
+        self.compact()
         self.save_state()
 
+    def open_metadata(self, fname):
+        """ open a downloaded metadata file, decompressing it on the
+        fly if necessary """
+        if fname.endswith('.gz'):
+            return gzip.open(fname, 'rb')
+        return open(fname, 'rb')
+
+    def iter_packages(self, data, tag):
+        """ parse the file object data incrementally, yielding each
+        package element as soon as it is complete.  each package is
+        freed once the caller is done with it, so only one package is
+        ever held in memory, not the whole (often huge) tree """
+        for _, pkg in lxml.etree.iterparse(data, tag=tag):
+            yield pkg
+            pkg.clear()
+            while pkg.getprevious() is not None:
+                del pkg.getparent()[0]
+
     def parse_filelist(self, data, arch):
+        """ read the files needed to satisfy path requirements from the
+        filelists.xml file object data """
         if arch not in self.filemap:
             self.filemap[arch] = dict()
-        for pkg in data.findall(FL + 'package'):
-            for fentry in pkg.findall(FL + 'file'):
+        for pkg in self.iter_packages(data, FL + 'package'):
+            for fentry in pkg.iterchildren(FL + 'file'):
                 if fentry.text in self.needed_paths:
                     if fentry.text in self.filemap[arch]:
                         self.filemap[arch][fentry.text].add(pkg.get('name'))
@@ -581,28 +617,29 @@ class YumSource(Source):
                             set([pkg.get('name')])
 
     def parse_primary(self, data, arch):
+        """ read package names, requirements and provides from the
+        primary.xml file object data """
         if arch not in self.packages:
             self.packages[arch] = set()
         if arch not in self.deps:
             self.deps[arch] = dict()
         if arch not in self.provides:
             self.provides[arch] = dict()
-        for pkg in data.getchildren():
-            if not pkg.tag.endswith('package'):
-                continue
+        for pkg in self.iter_packages(data, XP + 'package'):
             pkgname = pkg.find(XP + 'name').text
             self.packages[arch].add(pkgname)
 
             pdata = pkg.find(XP + 'format')
-            pre = pdata.find(RP + 'requires')
             self.deps[arch][pkgname] = set()
-            for entry in pre.getchildren():
-                self.deps[arch][pkgname].add(entry.get('name'))
-                if entry.get('name').startswith('/'):
-                    self.needed_paths.add(entry.get('name'))
+            pre = pdata.find(RP + 'requires')
+            if pre is not None:
+                for entry in pre.iterchildren():
+                    self.deps[arch][pkgname].add(entry.get('name'))
+                    if entry.get('name').startswith('/'):
+                        self.needed_paths.add(entry.get('name'))
             pro = pdata.find(RP + 'provides')
-            if pro != None:
-                for entry in pro.getchildren():
+            if pro is not None:
+                for entry in pro.iterchildren():
                     prov = entry.get('name')
                     if prov not in self.provides[arch]:
                         self.provides[arch][prov] = list()
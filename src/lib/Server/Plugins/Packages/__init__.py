@@ -9,7 +9,7 @@ import lxml.etree
 import Bcfg2.Logger
 import Bcfg2.Server.Plugin
 from Bcfg2.Bcfg2Py3k import ConfigParser, urlopen
-from Bcfg2.Server.Plugins.Packages import Collection
+from Bcfg2.Server.Plugins.Packages import Collection, Source
 from Bcfg2.Server.Plugins.Packages.PackagesSources import PackagesSources
 from Bcfg2.Server.Plugins.Packages.PackagesConfig import PackagesConfig
 
@@ -22,7 +22,8 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
     name = 'Packages'
     conflicts = ['Pkgmgr']
     experimental = True
-    __rmi__ = Bcfg2.Server.Plugin.Plugin.__rmi__ + ['Refresh', 'Reload']
+    __rmi__ = Bcfg2.Server.Plugin.Plugin.__rmi__ + ['Refresh', 'Reload',
+                                                    'ClosureCacheStats']
 
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
@@ -173,14 +174,29 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         '''Packages.Refresh() => True|False\nReload configuration
         specification and download sources\n'''
         self._load_config(force_update=True)
+        self._warn_workers()
         return True
 
     def Reload(self):
         '''Packages.Refresh() => True|False\nReload configuration
         specification and sources\n'''
         self._load_config()
+        self._warn_workers()
         return True
 
+    def _warn_workers(self):
+        """Remind the admin that other worker processes still have
+        the old data."""
+        if self.core.worker is not None:
+            self.logger.warning("Packages: Only worker %s was reloaded; "
+                                "send SIGHUP to bcfg2-server to reload "
+                                "all workers" % self.core.worker)
+
+    def ClosureCacheStats(self):
+        '''Packages.ClosureCacheStats() => dict\nReturn the size and
+        hit rate of the dependency closure cache\n'''
+        return Collection.closure_cache.stats()
+
     def _load_config(self, force_update=False):
         '''
         Load the configuration data and setup sources
@@ -188,8 +204,26 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         Keyword args:
             force_update    Force downloading repo data
         '''
+        try:
+            Collection.closure_cache.size = \
+                self.config.getint("global", "closure_cache_size")
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            Collection.closure_cache.size = 256
+        except ValueError:
+            self.logger.error("Packages: closure_cache_size must be an "
+                              "integer")
+        try:
+            Source.set_download_threads(self.config.getint("global",
+                                                           "download_threads"))
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            Source.set_download_threads(4)
+        except ValueError:
+            self.logger.error("Packages: download_threads must be an integer")
         self._load_sources(force_update)
         self._load_gpg_keys(force_update)
+        # package lists may have changed without any FAM event
+        self.core.expire_metadata_cache()
+        self.core.expire_config_cache()
 
     def _load_sources(self, force_update):
         """ Load sources from the config """
@@ -206,8 +240,22 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
 
         for source in self.sources:
             cachefiles.add(source.cachefile)
-            if not self.disableMetaData:
-                source.setup_data(force_update)
+        if not self.disableMetaData:
+            if (force_update and Source.ThreadPool is not None and
+                Source.download_threads > 1 and len(self.sources.entries) > 1):
+                # downloads dominate a refresh, so set up several
+                # sources at once; Source limits the total number of
+                # concurrent downloads
+                pool = Source.ThreadPool(min(Source.download_threads,
+                                             len(self.sources.entries)))
+                try:
+                    pool.map(lambda source: source.setup_data(force_update),
+                             self.sources.entries)
+                finally:
+                    pool.terminate()
+            else:
+                for source in self.sources:
+                    source.setup_data(force_update)
 
         for cfile in glob.glob(os.path.join(self.cachepath, "cache-*")):
             if cfile not in cachefiles:
@@ -45,18 +45,7 @@ class PNode(Bcfg2.Server.Plugin.INode):
                                   '(?P<version>[\w\d\.]+-([\w\d\.]+))\.(?P<arch>\S+)\.rpm$'),
                  'encap': re.compile('^(?P<name>[\w-]+)-(?P<version>[\w\d\.+-]+).encap.*$')}
     ignore = ['Package']
-
-    def Match(self, metadata, data, entry=lxml.etree.Element("None")):
-        """Return a dictionary of package mappings."""
-        if self.predicate(metadata, entry):
-            for key in self.contents:
-                try:
-                    data[key].update(self.contents[key])
-                except:
-                    data[key] = FuzzyDict()
-                    data[key].update(self.contents[key])
-            for child in self.children:
-                child.Match(metadata, data)
+    mapping = FuzzyDict
 
     def __init__(self, data, pdict, parent=None):
         # copy local attributes to all child nodes if no local attribute exists
@@ -135,10 +124,12 @@ class Pkgmgr(Bcfg2.Server.Plugin.PrioDir):
     __author__ = 'bcfg-dev@mcs.anl.gov'
     __child__ = PkgSrc
     __element__ = 'Package'
+    handles_by_name = True
 
     def HandleEvent(self, event):
         '''Handle events and update dispatch table'''
         Bcfg2.Server.Plugin.XMLDirectoryBacked.HandleEvent(self, event)
+        self.source_index = {}
         for src in list(self.entries.values()):
             for itype, children in list(src.items.items()):
                 for child in children:
@@ -1,7 +1,12 @@
+import fcntl
+import logging
+import os
+import re
+import sys
+import threading
 import time
 import lxml.etree
-import operator
-import re
+from Bcfg2.Bcfg2Py3k import ConfigParser
 
 try:
     import json
@@ -24,8 +29,21 @@ except ImportError:
     except ImportError:
         has_yaml = False
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+try:
+    import sqlite3
+    has_sqlite = True
+except ImportError:
+    has_sqlite = False
+
 import Bcfg2.Server.Plugin
 
+logger = logging.getLogger('Bcfg2.Plugins.Probes')
+
 specific_probe_matcher = re.compile("(.*/)?(?P<basename>\S+)(.(?P<mode>[GH](\d\d)?)_\S+)")
 probe_matcher = re.compile("(.*/)?(?P<basename>\S+)")
 
@@ -36,6 +54,8 @@ class ClientProbeDataSet(dict):
             self.timestamp = kwargs.pop("timestamp")
         else:
             self.timestamp = time.time()
+        # probe -> hash of the output the client sent
+        self.hashes = kwargs.pop("hashes", {})
         dict.__init__(self, *args, **kwargs)
 
 
@@ -123,12 +143,343 @@ class ProbeData(object):
         return self._yaml
 
 
+class ProbeStore(object):
+    """Base class for the backends that keep probe data between
+    server runs.  Data is passed around as a dict of client name ->
+    (ClientProbeDataSet, list of groups).
+
+    Backends provide load(client=None), which returns the data of
+    client or of all clients, and save(data), which stores the data
+    of the clients in data and keeps the data of other clients."""
+    # file or directory in the Probes directory that holds the data
+    filename = None
+    # load clients one at a time as they are needed
+    lazy = False
+
+    def __init__(self, path):
+        self.path = os.path.join(path, self.filename)
+
+    def exists(self):
+        """Return True if the store holds any data."""
+        return os.path.exists(self.path)
+
+    def changed(self, filename):
+        """Called after a FAM event on filename.  Return a list of
+        clients whose data was changed by another process, or None if
+        any client may have changed."""
+        return []
+
+    def monitor(self, fam, callback):
+        """Watch the store for changes made by other processes, if
+        the Probes directory monitor does not already see them."""
+        pass
+
+
+class XMLProbeStore(ProbeStore):
+    """Keep probe data of all clients in probed.xml.  Each save merges
+    the clients it is given into the file as another server process
+    may have left it, and replaces the file atomically."""
+    filename = 'probed.xml'
+
+    def __init__(self, path):
+        ProbeStore.__init__(self, path)
+        # the contents of probed.xml as last written by this process
+        self.written = None
+
+    def load(self, client=None):
+        try:
+            xdata = lxml.etree.parse(self.path).getroot()
+        except:
+            logger.error("Failed to read file probed.xml")
+            return {}
+        rv = {}
+        for cdata in xdata.getchildren():
+            if client is None or cdata.get('name') == client:
+                rv[cdata.get('name')] = client_from_xml(cdata)
+        return rv
+
+    def save(self, data):
+        try:
+            lockfile = open("%s.lock" % self.path, 'w')
+        except IOError:
+            err = sys.exc_info()[1]
+            logger.error("Failed to lock probed.xml: %s" % err)
+            return
+        try:
+            # serialize with the other server processes
+            fcntl.lockf(lockfile, fcntl.LOCK_EX)
+            clients = {}
+            if os.path.exists(self.path):
+                try:
+                    for cdata in lxml.etree.parse(self.path).getroot():
+                        clients[cdata.get('name')] = cdata
+                except:
+                    logger.error("Failed to read file probed.xml")
+            for client, (probed, groups) in data.items():
+                clients[client] = client_to_xml(client, probed, groups)
+            top = lxml.etree.Element("Probed")
+            for client in sorted(clients.keys()):
+                top.append(clients[client])
+            xdata = lxml.etree.tostring(top, encoding='UTF-8',
+                                        xml_declaration=True,
+                                        pretty_print='true')
+            try:
+                datafile = open("%s.new" % self.path, 'w')
+                datafile.write(xdata.decode('utf-8'))
+                datafile.close()
+                os.rename("%s.new" % self.path, self.path)
+                self.written = xdata.decode('utf-8')
+            except (IOError, OSError):
+                err = sys.exc_info()[1]
+                logger.error("Failed to write probed.xml: %s" % err)
+        finally:
+            lockfile.close()
+
+    def changed(self, filename):
+        if filename != self.filename:
+            return []
+        try:
+            data = open(self.path).read()
+        except IOError:
+            return []
+        if data != self.written:
+            return None
+        return []
+
+
+class FileProbeStore(ProbeStore):
+    """Keep the probe data of each client in its own file in
+    probed.d, in the format of probed.xml."""
+    filename = 'probed.d'
+    lazy = True
+
+    def __init__(self, path):
+        ProbeStore.__init__(self, path)
+        # client -> contents of its file as last written by this
+        # process
+        self.written = {}
+        self.callback = None
+
+    def exists(self):
+        return os.path.isdir(self.path) and len(os.listdir(self.path)) > 0
+
+    def load(self, client=None):
+        if client is None:
+            try:
+                clients = [fname[:-4] for fname in os.listdir(self.path)
+                           if fname.endswith('.xml')]
+            except OSError:
+                return {}
+        else:
+            clients = [client]
+        rv = {}
+        for name in clients:
+            fname = os.path.join(self.path, "%s.xml" % name)
+            if not os.path.exists(fname):
+                continue
+            try:
+                rv[name] = client_from_xml(lxml.etree.parse(fname).getroot())
+            except:
+                logger.error("Failed to read file %s" % fname)
+        return rv
+
+    def save(self, data):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for client, (probed, groups) in data.items():
+            fname = os.path.join(self.path, "%s.xml" % client)
+            xdata = lxml.etree.tostring(client_to_xml(client, probed, groups),
+                                        encoding='UTF-8',
+                                        xml_declaration=True,
+                                        pretty_print='true')
+            try:
+                datafile = open("%s.new" % fname, 'w')
+                datafile.write(xdata)
+                datafile.close()
+                os.rename("%s.new" % fname, fname)
+                self.written[client] = xdata
+            except (IOError, OSError):
+                err = sys.exc_info()[1]
+                logger.error("Failed to write %s: %s" % (fname, err))
+
+    def changed(self, filename):
+        if not filename.endswith('.xml'):
+            return []
+        client = filename[:-4]
+        try:
+            data = open(os.path.join(self.path, filename)).read()
+        except IOError:
+            data = None
+        if data != self.written.get(client):
+            return [client]
+        return []
+
+    def monitor(self, fam, callback):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.callback = callback
+        fam.AddMonitor(self.path, self)
+
+    def HandleEvent(self, event):
+        if (event.filename != self.path and
+            event.code2str() in ['created', 'changed', 'deleted']):
+            self.callback(event.filename)
+
+
+class SqliteProbeStore(ProbeStore):
+    """Keep probe data in an sqlite database, probed.sqlite."""
+    filename = 'probed.sqlite'
+    lazy = True
+    schema = ["CREATE TABLE IF NOT EXISTS clients "
+              "(name TEXT PRIMARY KEY, timestamp REAL)",
+              "CREATE TABLE IF NOT EXISTS probes "
+              "(client TEXT, name TEXT, value TEXT, hash TEXT, "
+              "PRIMARY KEY (client, name))",
+              "CREATE TABLE IF NOT EXISTS groups (client TEXT, name TEXT)",
+              "CREATE INDEX IF NOT EXISTS groups_client ON groups (client)"]
+
+    def __init__(self, path):
+        ProbeStore.__init__(self, path)
+        # (mtime, size) of the database after the last write by this
+        # process
+        self.written = None
+
+    def connect(self):
+        """Return a new connection to the database; connections
+        cannot be shared between threads."""
+        conn = sqlite3.connect(self.path)
+        conn.text_factory = str
+        for stmt in self.schema:
+            conn.execute(stmt)
+        return conn
+
+    def exists(self):
+        if not os.path.exists(self.path):
+            return False
+        conn = self.connect()
+        try:
+            count = conn.execute("SELECT COUNT(*) FROM clients").fetchone()
+            return count[0] > 0
+        finally:
+            conn.close()
+
+    def load(self, client=None):
+        if client is None:
+            cwhere = where = ""
+            args = ()
+        else:
+            cwhere = " WHERE name = ?"
+            where = " WHERE client = ?"
+            args = (client,)
+        conn = self.connect()
+        try:
+            rv = {}
+            for name, timestamp in conn.execute("SELECT name, timestamp "
+                                                "FROM clients" + cwhere,
+                                                args):
+                rv[name] = (ClientProbeDataSet(timestamp=timestamp), [])
+            for name, probe, value, phash in \
+                    conn.execute("SELECT client, name, value, hash "
+                                 "FROM probes" + where, args):
+                rv[name][0][probe] = ProbeData(value)
+                if phash:
+                    rv[name][0].hashes[probe] = phash
+            for name, group in conn.execute("SELECT client, name FROM "
+                                            "groups" + where +
+                                            " ORDER BY rowid", args):
+                rv[name][1].append(group)
+            return rv
+        finally:
+            conn.close()
+
+    def save(self, data):
+        conn = self.connect()
+        try:
+            for client, (probed, groups) in data.items():
+                conn.execute("DELETE FROM probes WHERE client = ?", (client,))
+                conn.execute("DELETE FROM groups WHERE client = ?", (client,))
+                conn.execute("INSERT OR REPLACE INTO clients VALUES (?, ?)",
+                             (client, float(probed.timestamp)))
+                conn.executemany("INSERT INTO probes VALUES (?, ?, ?, ?)",
+                                 [(client, probe, str(value),
+                                   probed.hashes.get(probe))
+                                  for probe, value in probed.items()])
+                conn.executemany("INSERT INTO groups VALUES (?, ?)",
+                                 [(client, group) for group in groups])
+            conn.commit()
+        finally:
+            conn.close()
+        self.written = self.stat()
+
+    def stat(self):
+        """Return the modification time and size of the database."""
+        try:
+            fstat = os.stat(self.path)
+            return (fstat.st_mtime, fstat.st_size)
+        except OSError:
+            return None
+
+    def changed(self, filename):
+        if filename != self.filename or self.stat() == self.written:
+            return []
+        return None
+
+
+def probe_hash(text):
+    """Return the hash of the output of a probe, as computed by the
+    client."""
+    if text is None:
+        text = ''
+    if sys.hexversion >= 0x03000000 or not isinstance(text, str):
+        text = text.encode('utf-8')
+    return md5(text).hexdigest()
+
+
+def client_from_xml(cdata):
+    """Return the probe data and groups in a Client element of
+    probed.xml."""
+    probed = ClientProbeDataSet(timestamp=cdata.get("timestamp"))
+    groups = []
+    for pdata in cdata:
+        if (pdata.tag == 'Probe'):
+            probed[pdata.get('name')] = ProbeData(pdata.get('value'))
+            if pdata.get('hash'):
+                probed.hashes[pdata.get('name')] = pdata.get('hash')
+        elif (pdata.tag == 'Group'):
+            groups.append(pdata.get('name'))
+    return (probed, groups)
+
+
+def client_to_xml(client, probed, groups):
+    """Return a Client element of probed.xml."""
+    cx = lxml.etree.Element('Client', name=client,
+                            timestamp=str(int(float(probed.timestamp))))
+    for probe in sorted(probed):
+        pdata = lxml.etree.SubElement(cx, 'Probe', name=probe,
+                                      value=str(probed[probe]))
+        if probe in probed.hashes:
+            pdata.set('hash', probed.hashes[probe])
+    for group in sorted(groups):
+        lxml.etree.SubElement(cx, "Group", name=group)
+    return cx
+
+
+stores = dict(xml=XMLProbeStore, files=FileProbeStore)
+if has_sqlite:
+    stores['sqlite'] = SqliteProbeStore
+
+
 class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
-    ignore = re.compile("^(\.#.*|.*~|\\..*\\.(tmp|sw[px])|probed\\.xml)$")
+    ignore = re.compile("^(\.#.*|.*~|\\..*\\.(tmp|sw[px])|"
+                        "probed\\.(xml(\\.new|\\.lock)?|sqlite(-journal)?|d))$")
+    # probe data kept in the Probes directory
+    data_files = ['probed.xml', 'probed.xml.new', 'probed.xml.lock',
+                  'probed.sqlite', 'probed.sqlite-journal', 'probed.d']
 
-    def __init__(self, path, fam, encoding, plugin_name):
+    def __init__(self, path, fam, encoding, plugin_name, data_changed=None):
         fpattern = '[0-9A-Za-z_\-]+'
         self.plugin_name = plugin_name
+        self.data_changed = data_changed
         Bcfg2.Server.Plugin.EntrySet.__init__(self, fpattern, path,
                                               Bcfg2.Server.Plugin.SpecificData,
                                               encoding)
@@ -136,15 +487,18 @@ class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
         self.bangline = re.compile('^#!(?P<interpreter>.*)$')
 
     def HandleEvent(self, event):
+        if event.filename in self.data_files:
+            if (self.data_changed is not None and
+                event.code2str() in ['created', 'changed']):
+                self.data_changed(event.filename)
+            return
         if event.filename != self.path:
             return self.handle_event(event)
 
     def get_probe_data(self, metadata):
         ret = []
         build = dict()
-        candidates = self.get_matching(metadata)
-        candidates.sort(key=operator.attrgetter('specific'))
-        for entry in candidates:
+        for entry in self.get_matching(metadata):
             rem = specific_probe_matcher.match(entry.name)
             if not rem:
                 rem = probe_matcher.match(entry.name)
@@ -179,70 +533,215 @@ class Probes(Bcfg2.Server.Plugin.Plugin,
         Bcfg2.Server.Plugin.Connector.__init__(self)
         Bcfg2.Server.Plugin.Probing.__init__(self)
 
+        cp = ConfigParser.ConfigParser()
+        cp.read(core.cfile)
         try:
-            self.probes = ProbeSet(self.data, core.fam, core.encoding,
-                                   self.name)
-        except:
+            backend = cp.get("probes", "backend")
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            backend = "xml"
+        if backend not in stores:
+            self.logger.error("Unknown probe data backend %s" % backend)
             raise Bcfg2.Server.Plugin.PluginInitError
+        try:
+            self.write_delay = cp.getfloat("probes", "write_delay")
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            self.write_delay = 5.0
 
         self.probedata = dict()
         self.cgroups = dict()
-        self.load_data()
+        self.lock = threading.RLock()
+        # clients whose data has not been written yet
+        self.dirty = set()
+        self.write_timer = None
+        self.store = stores[backend](self.data)
+        if not isinstance(self.store, XMLProbeStore):
+            self.migrate()
+
+        try:
+            self.probes = ProbeSet(self.data, core.fam, core.encoding,
+                                   self.name, self.data_changed)
+            self.store.monitor(core.fam, self.data_changed)
+        except:
+            raise Bcfg2.Server.Plugin.PluginInitError
+
+        if not self.store.lazy:
+            self.load_data()
+
+    def migrate(self):
+        """Copy probed.xml into a new store."""
+        old = XMLProbeStore(self.data)
+        if self.store.exists() or not old.exists():
+            return
+        data = old.load()
+        self.store.save(data)
+        self.logger.info("Migrated probe data of %d clients from probed.xml "
+                         "to %s" % (len(data), self.store.filename))
 
     def write_data(self):
-        """Write probe data out for use with bcfg2-info."""
-        top = lxml.etree.Element("Probed")
-        for client, probed in sorted(self.probedata.items()):
-            cx = lxml.etree.SubElement(top, 'Client', name=client,
-                                       timestamp=str(int(probed.timestamp)))
-            for probe in sorted(probed):
-                lxml.etree.SubElement(cx, 'Probe', name=probe,
-                                      value=str(self.probedata[client][probe]))
-            for group in sorted(self.cgroups[client]):
-                lxml.etree.SubElement(cx, "Group", name=group)
-        data = lxml.etree.tostring(top, encoding='UTF-8',
-                                   xml_declaration=True,
-                                   pretty_print='true')
+        """Write probe data out for use with bcfg2-info, now or after
+        write_delay seconds."""
+        self.lock.acquire()
         try:
-            datafile = open("%s/%s" % (self.data, 'probed.xml'), 'w')
-        except IOError:
-            self.logger.error("Failed to write probed.xml")
-        datafile.write(data.decode('utf-8'))
+            if self.write_delay <= 0:
+                self.flush()
+            elif self.write_timer is None:
+                self.write_timer = threading.Timer(self.write_delay,
+                                                   self.flush)
+                self.write_timer.setDaemon(True)
+                self.write_timer.start()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """Write the data of all clients that changed."""
+        self.lock.acquire()
+        try:
+            self.write_timer = None
+            if not self.dirty:
+                return
+            # other server processes may have written other clients
+            # meanwhile, so only the changed clients are saved
+            self.store.save(dict([(client, (self.probedata[client],
+                                            self.cgroups[client]))
+                                  for client in self.dirty]))
+            self.dirty = set()
+        finally:
+            self.lock.release()
+
+    def expires_metadata(self, path):
+        # data_changed expires the metadata of the clients whose
+        # probe data another process changed
+        if os.path.basename(path) in ProbeSet.data_files or \
+                os.path.basename(os.path.dirname(path)) == 'probed.d':
+            return False
+        return Bcfg2.Server.Plugin.Connector.expires_metadata(self, path)
+
+    def data_changed(self, filename):
+        """Reload probe data written by another server process."""
+        changed = self.store.changed(filename)
+        self.lock.acquire()
+        try:
+            if changed is None and not self.store.lazy:
+                self.load_data()
+            else:
+                if changed is None:
+                    clients = list(self.probedata.keys())
+                else:
+                    clients = changed
+                for client in clients:
+                    if client not in self.dirty:
+                        self.probedata.pop(client, None)
+                        self.cgroups.pop(client, None)
+        finally:
+            self.lock.release()
+        if changed is None:
+            self.core.expire_metadata_cache()
+        else:
+            for client in changed:
+                self.core.expire_metadata_cache(client)
 
-    def load_data(self):
+    def load_data(self, client=None):
+        """Load the data of client, or of all clients, from the store.
+        Data that has not been written yet is kept."""
+        self.lock.acquire()
         try:
-            data = lxml.etree.parse(self.data + '/probed.xml').getroot()
-        except:
-            self.logger.error("Failed to read file probed.xml")
-            return
-        self.probedata = {}
-        self.cgroups = {}
-        for client in data.getchildren():
-            self.probedata[client.get('name')] = \
-                ClientProbeDataSet(timestamp=client.get("timestamp"))
-            self.cgroups[client.get('name')] = []
-            for pdata in client:
-                if (pdata.tag == 'Probe'):
-                    self.probedata[client.get('name')][pdata.get('name')] = \
-                        ProbeData(pdata.get('value'))
-                elif (pdata.tag == 'Group'):
-                    self.cgroups[client.get('name')].append(pdata.get('name'))
+            if client is None and not self.store.lazy:
+                self.probedata = {}
+                self.cgroups = {}
+            for name, (probed, groups) in self.store.load(client).items():
+                if name not in self.dirty:
+                    self.probedata[name] = probed
+                    self.cgroups[name] = groups
+        finally:
+            self.lock.release()
+
+    def load_client(self, client):
+        """Make sure the data of client is loaded."""
+        if self.store.lazy and client not in self.probedata:
+            self.load_data(client)
+            if client not in self.probedata:
+                # remember that there is no data
+                self.lock.acquire()
+                try:
+                    self.probedata.setdefault(client, ClientProbeDataSet())
+                    self.cgroups.setdefault(client, [])
+                finally:
+                    self.lock.release()
+
+    def get_client_groups(self):
+        """Return a dict of client -> probed groups for all clients."""
+        if self.store.lazy:
+            self.load_data()
+        return self.cgroups
+
+    def shutdown(self):
+        if self.write_timer is not None:
+            self.write_timer.cancel()
+        self.flush()
+        Bcfg2.Server.Plugin.Plugin.shutdown(self)
+
+    def get_dependencies(self, metadata, entry=None):
+        # probe data reaches configurations only through client
+        # metadata, and probe scripts not at all
+        return []
 
     def GetProbes(self, meta, force=False):
-        """Return a set of probes for execution on client."""
-        return self.probes.get_probe_data(meta)
+        """Return a set of probes for execution on client.  Each
+        probe carries the hash of the output last received for it, so
+        that the client can send only the hashes if nothing
+        changed."""
+        probes = self.probes.get_probe_data(meta)
+        self.load_client(meta.hostname)
+        probed = self.probedata.get(meta.hostname, ClientProbeDataSet())
+        for probe in probes:
+            if probe.get('name') in probed.hashes:
+                probe.set('hash', probed.hashes[probe.get('name')])
+        return probes
 
     def ReceiveData(self, client, datalist):
-        self.cgroups[client.hostname] = []
-        self.probedata[client.hostname] = ClientProbeDataSet()
-        for data in datalist:
-            self.ReceiveDataItem(client, data)
+        """Receive the probe results of client.  Returns False if
+        they are the same as last time."""
+        self.load_client(client.hostname)
+        self.lock.acquire()
+        try:
+            old = self.probedata.get(client.hostname, ClientProbeDataSet())
+            oldgroups = self.cgroups.get(client.hostname, [])
+            if datalist and not [data for data in datalist
+                                 if data.get('hash') is None]:
+                # the client sends only hashes if all of them match
+                # those sent by GetProbes
+                hashes = dict([(data.get('name'), data.get('hash'))
+                               for data in datalist])
+                if hashes != old.hashes:
+                    self.logger.info("Probe data of %s changed since "
+                                     "the client ran its probes; it "
+                                     "will be updated on the next run" %
+                                     client.hostname)
+                    old.hashes = {}
+                return False
+            self.cgroups[client.hostname] = []
+            self.probedata[client.hostname] = ClientProbeDataSet()
+            for data in datalist:
+                self.ReceiveDataItem(client, data)
+            new = self.probedata[client.hostname]
+            if (new.hashes == old.hashes and new == old and
+                self.cgroups[client.hostname] == oldgroups):
+                # keep the old timestamp, which is the one stored
+                self.probedata[client.hostname] = old
+                return False
+            self.dirty.add(client.hostname)
+        finally:
+            self.lock.release()
         self.write_data()
+        return True
 
     def ReceiveDataItem(self, client, data):
         """Receive probe results pertaining to client."""
         if client.hostname not in self.cgroups:
             self.cgroups[client.hostname] = []
+        if client.hostname in self.probedata:
+            self.probedata[client.hostname].hashes[data.get('name')] = \
+                probe_hash(data.text)
         if data.text == None:
             self.logger.error("Got null response to probe %s from %s" % \
                               (data.get('name'), client.hostname))
@@ -270,7 +769,9 @@ class Probes(Bcfg2.Server.Plugin.Plugin,
                 ClientProbeDataSet([(data.get('name'), dobj)])
 
     def get_additional_groups(self, meta):
+        self.load_client(meta.hostname)
         return self.cgroups.get(meta.hostname, list())
 
     def get_additional_data(self, meta):
+        self.load_client(meta.hostname)
         return self.probedata.get(meta.hostname, ClientProbeDataSet())
@@ -9,6 +9,7 @@ class Rules(Bcfg2.Server.Plugin.PrioDir):
     name = 'Rules'
     __version__ = '$Id$'
     __author__ = 'bcfg-dev@mcs.anl.gov'
+    handles_by_name = True
 
     def HandlesEntry(self, entry, metadata):
         if entry.tag in self.Entries:
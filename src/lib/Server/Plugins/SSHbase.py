@@ -8,6 +8,7 @@ import socket
 import shutil
 import sys
 import tempfile
+import threading
 from subprocess import Popen, PIPE
 import Bcfg2.Server.Plugin
 from Bcfg2.Bcfg2Py3k import u_str
@@ -118,6 +119,9 @@ class SSHbase(Bcfg2.Server.Plugin.Plugin,
         self.ipcache = {}
         self.namecache = {}
         self.__skn = False
+        # serializes key generation, since the key and its .pub are
+        # bound separately and may be requested at the same time
+        self.keylock = threading.Lock()
 
         # keep track of which bogus keys we've warned about, and only
         # do so once
@@ -371,6 +375,18 @@ class SSHbase(Bcfg2.Server.Plugin.Plugin,
         fileloc = "%s/%s" % (self.data, hostkey)
         publoc = self.data + '/' + ".".join([hostkey.split('.')[0], 'pub',
                                              "H_%s" % client])
+        self.keylock.acquire()
+        try:
+            # another thread may have generated the pair while we
+            # waited for the lock
+            if os.path.exists(fileloc) and os.path.exists(publoc):
+                return
+            self._generate_keys(client, hostkey, keytype, fileloc, publoc)
+        finally:
+            self.keylock.release()
+
+    def _generate_keys(self, client, hostkey, keytype, fileloc, publoc):
+        """Run ssh-keygen and copy the new pair into place."""
         tempdir = tempfile.mkdtemp()
         temploc = "%s/%s" % (tempdir, hostkey)
         cmd = ["ssh-keygen", "-q", "-f", temploc, "-N", "",
@@ -2,59 +2,160 @@
 __revision__ = '$Revision$'
 
 import binascii
-import copy
 import difflib
 import logging
 from lxml.etree import XML, SubElement, Element, XMLSyntaxError
 import lxml.etree
 import os
+import sys
 from time import asctime, localtime, time, strptime, mktime
 import threading
 
 import Bcfg2.Server.Plugin
+# Compatibility import
+from Bcfg2.Bcfg2Py3k import ConfigParser
+
+logger = logging.getLogger('Bcfg2.Server.Statistics')
+
+
+def statistics_path(repository):
+    """Return the path of the statistics kept in repository: the
+    statistics.xml file, or the statistics.d directory of per-client
+    files if there is no statistics.xml."""
+    path = os.path.join(repository, 'etc', 'statistics.xml')
+    shards = os.path.join(repository, 'etc', 'statistics.d')
+    if not os.path.exists(path) and os.path.isdir(shards):
+        return shards
+    return path
+
+
+def load_statistics(path):
+    """Return a ConfigStatistics element holding the statistics in
+    path, which is a statistics file or a directory of per-client
+    files.  Raises IOError or XMLSyntaxError."""
+    if not os.path.isdir(path):
+        return XML(open(path).read())
+    element = Element('ConfigStatistics')
+    for fname in sorted(os.listdir(path)):
+        if fname.endswith('.xml'):
+            shard = XML(open(os.path.join(path, fname)).read())
+            element.extend(shard.findall('Node'))
+    return element
+
+
+def write_file(filename, element):
+    """Atomically replace filename with element."""
+    try:
+        fout = open(filename + '.new', 'wb')
+    except IOError:
+        ioerr = sys.exc_info()[1]
+        logger.error("Failed to open %s for writing: %s" % (filename + '.new', ioerr))
+        return False
+    fout.write(lxml.etree.tostring(element, encoding='UTF-8', xml_declaration=True))
+    fout.close()
+    os.rename(filename + '.new', filename)
+    return True
 
 
 class StatisticsStore(object):
     """Manages the memory and file copy of statistics collected about client runs."""
-    __min_write_delay__ = 0
 
-    def __init__(self, filename):
+    def __init__(self, filename, write_delay=0):
         self.filename = filename
-        self.element = Element('Dummy')
-        self.dirty = 0
-        self.lastwrite = 0
-        self.logger = logging.getLogger('Bcfg2.Server.Statistics')
+        self.write_delay = write_delay
+        self.element = Element('ConfigStatistics')
+        # client -> Node element
+        self.nodes = {}
+        # client -> list of (time, Statistics element), oldest first
+        self.runs = {}
+        # clients whose statistics have not been written yet
+        self.dirty = set()
+        self.write_timer = None
+        self.lock = threading.RLock()
+        self.logger = logger
         self.ReadFromFile()
 
     def WriteBack(self, force=0):
-        """Write statistics changes back to persistent store."""
-        if (self.dirty and (self.lastwrite + self.__min_write_delay__ <= time())) \
-                or force:
-            try:
-                fout = open(self.filename + '.new', 'w')
-            except IOError:
-                ioerr = sys.exc_info()[1]
-                self.logger.error("Failed to open %s for writing: %s" % (self.filename + '.new', ioerr))
-            else:
-                fout.write(lxml.etree.tostring(self.element, encoding='UTF-8', xml_declaration=True))
-                fout.close()
-                os.rename(self.filename + '.new', self.filename)
-                self.dirty = 0
-                self.lastwrite = time()
+        """Write statistics changes back to persistent store.
+        Returns False if some of them could not be written."""
+        self.lock.acquire()
+        try:
+            self.write_timer = None
+            if self.dirty or force:
+                if write_file(self.filename, self.element):
+                    self.dirty = set()
+            return not self.dirty
+        finally:
+            self.lock.release()
+
+    def QueueWriteBack(self):
+        """Write statistics changes back after write_delay seconds,
+        together with any other changes made until then."""
+        self.lock.acquire()
+        try:
+            if self.write_delay <= 0:
+                self.WriteBack()
+            elif self.write_timer is None:
+                self.write_timer = threading.Timer(self.write_delay,
+                                                   self.WriteBack)
+                self.write_timer.setDaemon(True)
+                self.write_timer.start()
+        finally:
+            self.lock.release()
+
+    def shutdown(self):
+        """Write pending changes, and write later ones immediately."""
+        self.lock.acquire()
+        try:
+            if self.write_timer is not None:
+                self.write_timer.cancel()
+            self.write_delay = 0
+            self.WriteBack()
+        finally:
+            self.lock.release()
 
     def ReadFromFile(self):
         """Reads current state regarding statistics."""
         try:
-            fin = open(self.filename, 'r')
-            data = fin.read()
-            fin.close()
-            self.element = XML(data)
-            self.dirty = 0
-        except (IOError, XMLSyntaxError):
+            self.set_element(load_statistics(self.filename))
+        except (IOError, OSError, XMLSyntaxError):
             self.logger.error("Creating new statistics file %s"%(self.filename))
-            self.element = Element('ConfigStatistics')
-            self.WriteBack()
-            self.dirty = 0
+
+    def set_element(self, element):
+        """Use the statistics in a ConfigStatistics element."""
+        self.element = element
+        self.nodes = {}
+        self.runs = {}
+        for node in element.findall('Node'):
+            client = node.get('name')
+            if client in self.nodes:
+                self.logger.error("Duplicate node entry for %s"%(client))
+                element.remove(node)
+                continue
+            self.set_node(client, node)
+
+    def set_node(self, client, node):
+        """Use the statistics in the Node element of client."""
+        self.nodes[client] = node
+        self.runs[client] = []
+        for stat in node.findall('Statistics'):
+            try:
+                stime = mktime(strptime(stat.get('time')))
+            except (TypeError, ValueError):
+                self.logger.error("Bad time in statistics for %s: %s" %
+                                  (client, stat.get('time')))
+                stime = 0
+            self.runs[client].append((stime, stat))
+        self.runs[client].sort(key=lambda run: run[0])
+
+    def refresh(self, client):
+        """Reread the statistics of client if another server process
+        may have changed them.  The lock must be held."""
+        pass
+
+    def add_node(self, client):
+        """Create the Node element for a new client."""
+        return SubElement(self.element, 'Node', name=client)
 
     def updateStats(self, xml, client):
         """Updates the statistics of a current node with new data."""
@@ -64,77 +165,216 @@ class StatisticsStore(object):
         #   - Keep latest clean run for clean nodes
         #   - Keep latest clean and dirty run for dirty nodes
         newstat = xml.find('Statistics')
+        node_dirty = newstat.get('state') != 'clean'
+        now = time()
 
-        if newstat.get('state') == 'clean':
-            node_dirty = 0
-        else:
-            node_dirty = 1
-
-        # Find correct node entry in stats data
-        # The following list comprehension should be guarenteed to return at
-        # most one result
-        nodes = [elem for elem in self.element.findall('Node') \
-                 if elem.get('name') == client]
-        nummatch = len(nodes)
-        if nummatch == 0:
-            # Create an entry for this node
-            node = SubElement(self.element, 'Node', name=client)
-        elif nummatch == 1 and not node_dirty:
-            # Delete old instance
-            node = nodes[0]
-            [node.remove(elem) for elem in node.findall('Statistics') \
-             if self.isOlderThan24h(elem.get('time'))]
-        elif nummatch == 1 and node_dirty:
-            # Delete old dirty statistics entry
-            node = nodes[0]
-            [node.remove(elem) for elem in node.findall('Statistics') \
-             if (elem.get('state') == 'dirty' \
-                 and self.isOlderThan24h(elem.get('time')))]
-        else:
-            # Shouldn't be reached
-            self.logger.error("Duplicate node entry for %s"%(client))
+        self.lock.acquire()
+        try:
+            self.refresh(client)
+            if client not in self.nodes:
+                # Create an entry for this node
+                self.nodes[client] = self.add_node(client)
+                self.runs[client] = []
+            node = self.nodes[client]
+            if [stat for (_, stat) in self.runs[client] if stat is newstat]:
+                # already added by a batch that is being retried
+                return
 
-        # Set current time for stats
-        newstat.set('time', asctime(localtime()))
+            # Delete runs more than 24 hours old; for dirty nodes,
+            # only dirty ones
+            runs = []
+            for (stime, stat) in self.runs[client]:
+                if (now - stime > 60 * 60 * 24 and
+                    (not node_dirty or stat.get('state') == 'dirty')):
+                    node.remove(stat)
+                else:
+                    runs.append((stime, stat))
 
-        # Add statistic
-        node.append(copy.deepcopy(newstat))
+            # Set current time for stats
+            newstat.set('time', asctime(localtime(now)))
 
-        # Set dirty
-        self.dirty = 1
-        self.WriteBack(force=1)
+            # Add statistic
+            node.append(newstat)
+            runs.append((now, newstat))
+            self.runs[client] = runs
+            self.dirty.add(client)
+        finally:
+            self.lock.release()
+        self.QueueWriteBack()
 
-    def isOlderThan24h(self, testTime):
-        """Helper function to determine if <time> string is older than 24 hours."""
-        now = time()
-        utime = mktime(strptime(testTime))
-        secondsPerDay = 60*60*24
+    def FindCurrent(self, client):
+        """Return the latest Statistics element of client."""
+        self.lock.acquire()
+        try:
+            self.refresh(client)
+            return max(self.runs[client], key=lambda run: run[0])[1]
+        except (KeyError, ValueError):
+            self.logger.error("No statistics for %s" % client)
+            raise Bcfg2.Server.Plugin.PluginExecutionError
+        finally:
+            self.lock.release()
+
+
+class ShardedStatisticsStore(StatisticsStore):
+    """A StatisticsStore that keeps the statistics of each client in
+    its own file in a directory, so that an upload rewrites only the
+    file of the client that sent it.  Several server processes can
+    share one store: each rereads the file of a client that another
+    one wrote before using it."""
+
+    def __init__(self, filename, write_delay=0):
+        # client -> (mtime, size) of its file when this process last
+        # read or wrote it
+        self.stamps = {}
+        StatisticsStore.__init__(self, filename, write_delay)
+
+    def client_file(self, client):
+        """Return the path of the file of client."""
+        return os.path.join(self.filename, "%s.xml" % client)
+
+    def stamp(self, client):
+        """Return the modification time and size of the file of
+        client, or None if it does not exist."""
+        try:
+            fstat = os.stat(self.client_file(client))
+            return (fstat.st_mtime, fstat.st_size)
+        except OSError:
+            return None
+
+    def refresh(self, client):
+        if client in self.dirty:
+            # written soon, replacing what another process wrote
+            return
+        stamp = self.stamp(client)
+        if stamp is None or stamp == self.stamps.get(client):
+            return
+        try:
+            node = XML(open(self.client_file(client)).read()).find('Node')
+        except (IOError, XMLSyntaxError):
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to read statistics of %s: %s" %
+                              (client, err))
+            return
+        if node is not None:
+            self.set_node(client, node)
+        self.stamps[client] = stamp
+
+    def add_node(self, client):
+        container = Element('ConfigStatistics')
+        return SubElement(container, 'Node', name=client)
+
+    def WriteBack(self, force=0):
+        self.lock.acquire()
+        try:
+            self.write_timer = None
+            if force:
+                clients = list(self.nodes.keys())
+            else:
+                clients = list(self.dirty)
+            if clients and not os.path.isdir(self.filename):
+                os.makedirs(self.filename)
+            for client in clients:
+                if write_file(self.client_file(client),
+                              self.nodes[client].getparent()):
+                    self.dirty.discard(client)
+                    self.stamps[client] = self.stamp(client)
+            return not self.dirty
+        finally:
+            self.lock.release()
 
-        return (now-utime) > secondsPerDay
+    def set_element(self, element):
+        StatisticsStore.set_element(self, element)
+        # give each client a document of its own to write
+        for client, node in self.nodes.items():
+            Element('ConfigStatistics').append(node)
+            self.stamps[client] = self.stamp(client)
 
+    def ReadFromFile(self):
+        if not os.path.isdir(self.filename):
+            self.set_element(Element('ConfigStatistics'))
+            return
+        try:
+            self.set_element(load_statistics(self.filename))
+        except (IOError, OSError, XMLSyntaxError):
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to read statistics from %s: %s" %
+                              (self.filename, err))
 
 class Statistics(Bcfg2.Server.Plugin.Plugin,
                  Bcfg2.Server.Plugin.ThreadedStatistics,
                  Bcfg2.Server.Plugin.PullSource):
     name = 'Statistics'
     __version__ = '$Id$'
+    # uploads are written in one batch, and only taken off the journal
+    # once written
+    batch_size = 100
 
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
+        cp = ConfigParser.ConfigParser()
+        cp.read(core.cfile)
+        try:
+            write_delay = cp.getfloat("statistics", "write_delay")
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            write_delay = 5.0
+        try:
+            per_client = cp.getboolean("statistics", "per_client")
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            per_client = False
+        if core.worker is not None and not per_client:
+            # workers would replace each other's statistics.xml
+            self.logger.info("Keeping statistics per client, since the "
+                             "server runs several worker processes")
+            per_client = True
+        self.batch_wait = write_delay
+        fpath = "%s/etc/statistics.xml" % datastore
+        dpath = "%s/etc/statistics.d" % datastore
+        if per_client:
+            self.data_file = ShardedStatisticsStore(dpath, write_delay)
+            self.migrate(fpath)
+        else:
+            self.data_file = StatisticsStore(fpath, write_delay)
+            if not os.path.exists(fpath):
+                self.migrate(dpath)
+        # the store must exist before the thread loads pending data
         Bcfg2.Server.Plugin.ThreadedStatistics.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.PullSource.__init__(self)
-        fpath = "%s/etc/statistics.xml" % datastore
-        self.data_file = StatisticsStore(fpath)
+
+    def migrate(self, path):
+        """Copy statistics kept in the other format at path into an
+        empty store."""
+        if self.data_file.nodes or not os.path.exists(path):
+            return
+        try:
+            self.data_file.set_element(load_statistics(path))
+        except (IOError, OSError, XMLSyntaxError):
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to migrate statistics from %s: %s" %
+                              (path, err))
+            return
+        self.data_file.WriteBack(force=1)
+        if os.path.isfile(path):
+            # statistics.xml takes precedence over statistics.d
+            os.rename(path, path + '.migrated')
+        self.logger.info("Migrated statistics from %s" % path)
 
     def handle_statistic(self, metadata, data):
         self.data_file.updateStats(data, metadata.hostname)
 
+    def handle_statistics_batch(self, batch):
+        for (metadata, data) in batch:
+            self.handle_statistic(metadata, data)
+        # the batch is acknowledged when this returns, so it must be
+        # on disk by then
+        if not self.data_file.WriteBack():
+            raise Bcfg2.Server.Plugin.PluginExecutionError
+
     def FindCurrent(self, client):
-        rt = self.data_file.element.xpath('//Node[@name="%s"]' % client)[0]
-        maxtime = max([strptime(stat.get('time')) for stat \
-                       in rt.findall('Statistics')])
-        return [stat for stat in rt.findall('Statistics') \
-                if strptime(stat.get('time')) == maxtime][0]
+        return self.data_file.FindCurrent(client)
+
+    def shutdown(self):
+        self.data_file.shutdown()
+        Bcfg2.Server.Plugin.Plugin.shutdown(self)
 
     def GetExtra(self, client):
         return [(entry.tag, entry.get('name')) for entry \
@@ -6,8 +6,11 @@ new statistics engine
 __revision__ = '$Revision$'
 
 import binascii
+import operator
 import os
 import sys
+import time
+import zlib
 try:
     import Bcfg2.Server.Reports.settings
 except Exception:
@@ -24,18 +27,44 @@ sys.path.pop()
 os.environ['DJANGO_SETTINGS_MODULE'] = '%s.settings' % project_name
 
 from Bcfg2.Server.Reports.reports.models import *
-from lxml.etree import XML, XMLSyntaxError
+from lxml.etree import XML, XMLSyntaxError, iterparse, tostring
 from getopt import getopt, GetoptError
 from datetime import datetime
 from time import strptime
-from django.db import connection
+from functools import reduce
+from django.db import connection, transaction
+from django.db.models import Q
 from Bcfg2.Server.Reports.updatefix import update_database
+from Bcfg2.Server.Cache import LRUCache
+from Bcfg2.Server.Plugins.Statistics import load_statistics, statistics_path
 import logging
 import Bcfg2.Logger
 import platform
 
 # Compatibility import
-from Bcfg2.Bcfg2Py3k import ConfigParser
+from Bcfg2.Bcfg2Py3k import ConfigParser, Empty
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+# number of clients imported in one transaction
+BATCH_SIZE = 100
+# number of reason digest -> id mappings kept between batches
+REASON_CACHE_SIZE = 10000
+REASON_CACHE = LRUCache(REASON_CACHE_SIZE)
+
+try:
+    in_transaction = transaction.atomic
+except AttributeError:
+    in_transaction = transaction.commit_on_success
+
+REASON_FIELDS = ('owner', 'current_owner', 'group', 'current_group',
+                 'perms', 'current_perms', 'status', 'current_status',
+                 'to', 'current_to', 'version', 'current_version',
+                 'current_exists', 'current_diff', 'is_binary',
+                 'is_sensitive')
 
 
 def build_reason_kwargs(r_ent, encoding, logger):
@@ -82,7 +111,246 @@ def build_reason_kwargs(r_ent, encoding, logger):
                 is_sensitive=sensitive_file)
 
 
-def load_stats(cdata, sdata, encoding, vlevel, logger, quick=False, location=''):
+def bulk_insert(model, objects):
+    """Insert objects with as few queries as the database layer allows."""
+    if not objects:
+        return
+    if hasattr(model.objects, 'bulk_create'):
+        model.objects.bulk_create(objects)
+    else:
+        for obj in objects:
+            obj.save()
+
+
+def bulk_resolve(model, fields, keys):
+    """Return a dict mapping each tuple of values for fields in keys to
+    a saved instance of model, creating the missing ones in bulk."""
+    # stay well below the sqlite limit of 999 parameters per query
+    size = max(1, 900 // len(fields))
+    found = {}
+
+    def lookup(keys):
+        for start in range(0, len(keys), size):
+            query = reduce(operator.or_,
+                           [Q(**dict(zip(fields, key)))
+                            for key in keys[start:start + size]])
+            for obj in model.objects.filter(query).order_by('id'):
+                found.setdefault(tuple([getattr(obj, field)
+                                        for field in fields]), obj)
+
+    keys = list(keys)
+    lookup(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        new = [model(**dict(zip(fields, key))) for key in missing]
+        bulk_insert(model, new)
+        lookup(missing)
+        for key, obj in zip(missing, new):
+            if key not in found:
+                # the database normalized the values we inserted
+                if obj.pk is None:
+                    obj.save()
+                found[key] = obj
+    return found, len(missing)
+
+
+def resolve_reasons(keys):
+    """Return a dict mapping each tuple of values for REASON_FIELDS in
+    keys to the id of a Reason, creating the missing ones in bulk.
+    Reasons are found by digest, in REASON_CACHE or with an indexed
+    lookup.  Also returns the number of reasons created."""
+    digests = dict()
+    for key in keys:
+        digests[key] = Reason.make_digest(dict(zip(REASON_FIELDS, key)))
+    ids = dict()
+    for digest in set(digests.values()):
+        rid = REASON_CACHE.get(digest)
+        if rid is not None:
+            ids[digest] = rid
+
+    def lookup(wanted):
+        for start in range(0, len(wanted), 500):
+            ids.update(Reason.objects
+                       .filter(digest__in=wanted[start:start + 500])
+                       .values_list('digest', 'id'))
+
+    missing = [digest for digest in set(digests.values())
+               if digest not in ids]
+    lookup(missing)
+    new = dict()
+    for (key, digest) in digests.items():
+        if digest not in ids and digest not in new:
+            new[digest] = Reason(digest=digest,
+                                 **dict(zip(REASON_FIELDS, key)))
+    bulk_insert(Reason, list(new.values()))
+    lookup(list(new.keys()))
+    for (digest, rid) in ids.items():
+        REASON_CACHE.set(digest, rid)
+    return dict([(key, ids[digest]) for (key, digest) in digests.items()]), \
+           len(new)
+
+
+def resolve_reason(key, name, logger):
+    """Return the id of the Reason with the values for REASON_FIELDS
+    in key, creating it if needed.  A reason that cannot be stored is
+    replaced by a minimal one, so that the interaction is still
+    imported."""
+    kargs = dict(zip(REASON_FIELDS, key))
+    sid = transaction.savepoint()
+    try:
+        rr = Reason(**kargs)
+        found = Reason.objects.filter(digest=Reason.make_digest(kargs)) \
+                .values_list('id', flat=True)
+        if found:
+            rid = found[0]
+        else:
+            rr.save()
+            rid = rr.id
+        transaction.savepoint_commit(sid)
+        return rid
+    except Exception:
+        transaction.savepoint_rollback(sid)
+        ex = sys.exc_info()[1]
+        logger.error("Failed to create reason for %s: %s" % (name, ex))
+    rr = Reason(current_exists=kargs['current_exists'])
+    found = Reason.objects.filter(digest=Reason.make_digest(rr.__dict__)) \
+            .values_list('id', flat=True)
+    if found:
+        return found[0]
+    rr.save()
+    return rr.id
+
+
+@in_transaction
+def import_batch(nodes, encoding, vlevel, logger, quick=False, location=''):
+    """Import the interactions in a list of Node elements in a single
+    transaction.  Returns the number of interactions imported."""
+    names = set([node.get('name') for node in nodes])
+    clients = {}
+    for client in Client.objects.filter(name__in=list(names)):
+        clients[client.name] = client
+    for name in names:
+        if name not in clients:
+            clients[name] = Client(name=name)
+            clients[name].save()
+            if vlevel > 0:
+                logger.info("Client %s added to db" % name)
+
+    interactions = []
+    for node in nodes:
+        c_inst = clients[node.get('name')]
+        for statistics in node.findall('Statistics'):
+            timestamp = datetime(*strptime(statistics.get('time'))[0:6])
+            interactions.append((c_inst, timestamp, statistics))
+    if not interactions:
+        return 0
+
+    existing = set(Interaction.objects.filter(
+            client__in=list(clients.values()),
+            timestamp__in=list(set([i[1] for i in interactions])))
+                   .values_list('client', 'timestamp'))
+
+    pattern = [('Bad/*', TYPE_CHOICES[0]),
+               ('Extra/*', TYPE_CHOICES[2]),
+               ('Modified/*', TYPE_CHOICES[1])]
+    pending = []
+    entry_keys = set()
+    # reason -> name of an entry that has it, for error messages
+    reason_keys = dict()
+    for (c_inst, timestamp, statistics) in interactions:
+        if (c_inst.id, timestamp) in existing:
+            if vlevel > 0:
+                logger.info("Interaction for %s at %s already exists" %
+                            (c_inst.id, timestamp))
+            continue
+        existing.add((c_inst.id, timestamp))
+        items = []
+        for (xpath, type) in pattern:
+            for x in statistics.findall(xpath):
+                kargs = build_reason_kwargs(x, encoding, logger)
+                reason = tuple([kargs[field] for field in REASON_FIELDS])
+                entry = (x.get('name'), x.tag)
+                reason_keys.setdefault(reason, x.get('name'))
+                entry_keys.add(entry)
+                items.append((type, entry, reason))
+        pending.append((c_inst, timestamp, statistics, items))
+
+    sid = transaction.savepoint()
+    try:
+        reasons, created = resolve_reasons(list(reason_keys.keys()))
+        transaction.savepoint_commit(sid)
+        if vlevel > 0:
+            logger.info("Created %d of %d reasons" % (created, len(reasons)))
+    except Exception:
+        # find the reasons that cannot be stored
+        transaction.savepoint_rollback(sid)
+        reasons = dict()
+        for (key, name) in reason_keys.items():
+            reasons[key] = resolve_reason(key, name, logger)
+    entries, created = bulk_resolve(Entries, ('name', 'kind'), entry_keys)
+    if vlevel > 0:
+        logger.info("Created %d of %d entries" % (created, len(entries)))
+
+    links = []
+    # the latest new interaction of each client
+    latest = {}
+    for (c_inst, timestamp, statistics, items) in pending:
+        counter_fields = {TYPE_CHOICES[0]: 0,
+                          TYPE_CHOICES[1]: 0,
+                          TYPE_CHOICES[2]: 0}
+        for (type, entry, reason) in items:
+            counter_fields[type] = counter_fields[type] + 1
+        newint = Interaction(client=c_inst,
+                             timestamp=timestamp,
+                             state=statistics.get('state',
+                                                  default="unknown"),
+                             repo_rev_code=statistics.get('revision',
+                                                          default="unknown"),
+                             client_version=statistics.get('client_version',
+                                                           default="unknown"),
+                             goodcount=statistics.get('good',
+                                                      default="0"),
+                             totalcount=statistics.get('total',
+                                                       default="0"),
+                             server=location,
+                             bad_entries=counter_fields[TYPE_CHOICES[0]],
+                             modified_entries=counter_fields[TYPE_CHOICES[1]],
+                             extra_entries=counter_fields[TYPE_CHOICES[2]])
+        newint.save()
+        if (c_inst.id not in latest or
+            latest[c_inst.id].timestamp < timestamp):
+            latest[c_inst.id] = newint
+        if vlevel > 0:
+            logger.info("Interaction for %s at %s with id %s INSERTED in to db" % (c_inst.id,
+                timestamp, newint.id))
+
+        for (type, entry, reason) in items:
+            links.append(Entries_interactions(entry=entries[entry],
+                                              reason_id=reasons[reason],
+                                              interaction=newint,
+                                              type=type[0]))
+
+        mperfs = []
+        for times in statistics.findall('OpStamps'):
+            for metric, value in list(times.items()):
+                mmatch = []
+                if not quick:
+                    mmatch = Performance.objects.filter(metric=metric, value=value)
+
+                if mmatch:
+                    mperf = mmatch[0]
+                else:
+                    mperf = Performance(metric=metric, value=value)
+                    mperf.save()
+                mperfs.append(mperf)
+        newint.performance_items.add(*mperfs)
+    bulk_insert(Entries_interactions, links)
+    ClientSummary.objects.record(list(latest.values()))
+    return len(pending)
+
+
+def sync_pings(cdata, names, vlevel, logger):
+    """Record the pingability of every known client."""
     clients = {}
     [clients.__setitem__(c.name, c) \
         for c in Client.objects.all()]
@@ -90,103 +358,8 @@ def load_stats(cdata, sdata, encoding, vlevel, logger, quick=False, location='')
     pingability = {}
     [pingability.__setitem__(n.get('name'), n.get('pingable', default='N')) \
         for n in cdata.findall('Client')]
-
-    for node in sdata.findall('Node'):
-        name = node.get('name')
-        c_inst, created = Client.objects.get_or_create(name=name)
-        if vlevel > 0:
-            logger.info("Client %s added to db" % name)
-        clients[name] = c_inst
-        try:
-            pingability[name]
-        except KeyError:
-            pingability[name] = 'N'
-        for statistics in node.findall('Statistics'):
-            timestamp = datetime(*strptime(statistics.get('time'))[0:6])
-            ilist = Interaction.objects.filter(client=c_inst,
-                                               timestamp=timestamp)
-            if ilist:
-                current_interaction = ilist[0]
-                if vlevel > 0:
-                    logger.info("Interaction for %s at %s with id %s already exists" % \
-                        (c_inst.id, timestamp, current_interaction.id))
-                continue
-            else:
-                newint = Interaction(client=c_inst,
-                                     timestamp=timestamp,
-                                     state=statistics.get('state',
-                                                          default="unknown"),
-                                     repo_rev_code=statistics.get('revision',
-                                                                  default="unknown"),
-                                     client_version=statistics.get('client_version',
-                                                                   default="unknown"),
-                                     goodcount=statistics.get('good',
-                                                              default="0"),
-                                     totalcount=statistics.get('total',
-                                                               default="0"),
-                                     server=location)
-                newint.save()
-                current_interaction = newint
-                if vlevel > 0:
-                    logger.info("Interaction for %s at %s with id %s INSERTED in to db" % (c_inst.id,
-                        timestamp, current_interaction.id))
-
-            counter_fields = {TYPE_CHOICES[0]: 0,
-                              TYPE_CHOICES[1]: 0,
-                              TYPE_CHOICES[2]: 0}
-            pattern = [('Bad/*', TYPE_CHOICES[0]),
-                       ('Extra/*', TYPE_CHOICES[2]),
-                       ('Modified/*', TYPE_CHOICES[1])]
-            for (xpath, type) in pattern:
-                for x in statistics.findall(xpath):
-                    counter_fields[type] = counter_fields[type] + 1
-                    kargs = build_reason_kwargs(x, encoding, logger)
-
-                    try:
-                        rr = None
-                        try:
-                            rr = Reason.objects.filter(**kargs)[0]
-                        except IndexError:
-                            rr = Reason(**kargs)
-                            rr.save()
-                            if vlevel > 0:
-                                logger.info("Created reason: %s" % rr.id)
-                    except Exception:
-                        ex = sys.exc_info()[1]
-                        logger.error("Failed to create reason for %s: %s" % (x.get('name'), ex))
-                        rr = Reason(current_exists=x.get('current_exists',
-                                                         default="True").capitalize() == "True")
-                        rr.save()
-
-                    entry, created = Entries.objects.get_or_create(\
-                        name=x.get('name'), kind=x.tag)
-
-                    Entries_interactions(entry=entry, reason=rr,
-                                         interaction=current_interaction,
-                                         type=type[0]).save()
-                    if vlevel > 0:
-                        logger.info("%s interaction created with reason id %s and entry %s" % (xpath, rr.id, entry.id))
-
-            # Update interaction counters
-            current_interaction.bad_entries = counter_fields[TYPE_CHOICES[0]]
-            current_interaction.modified_entries = counter_fields[TYPE_CHOICES[1]]
-            current_interaction.extra_entries = counter_fields[TYPE_CHOICES[2]]
-            current_interaction.save()
-
-            mperfs = []
-            for times in statistics.findall('OpStamps'):
-                for metric, value in list(times.items()):
-                    mmatch = []
-                    if not quick:
-                        mmatch = Performance.objects.filter(metric=metric, value=value)
-
-                    if mmatch:
-                        mperf = mmatch[0]
-                    else:
-                        mperf = Performance(metric=metric, value=value)
-                        mperf.save()
-                    mperfs.append(mperf)
-            current_interaction.performance_items.add(*mperfs)
+    for name in names:
+        pingability.setdefault(name, 'N')
 
     for key in list(pingability.keys()):
         if key not in clients:
@@ -202,11 +375,301 @@ def load_stats(cdata, sdata, encoding, vlevel, logger, quick=False, location='')
         Ping(client=clients[key], status=pingability[key],
              starttime=datetime.now(),
              endtime=datetime.now()).save()
+        ClientSummary.objects.filter(client=clients[key]) \
+            .update(ping=pingability[key])
 
     if vlevel > 1:
         logger.info("---------------PINGDATA SYNCED---------------------")
 
+
+def load_stats(cdata, sdata, encoding, vlevel, logger, quick=False,
+               location='', batch_size=BATCH_SIZE):
+    """Import the statistics in sdata, batch_size clients per
+    transaction.  Returns the number of interactions imported."""
+    nodes = sdata.findall('Node')
+    imported = 0
+    for start in range(0, len(nodes), batch_size):
+        try:
+            imported += import_batch(nodes[start:start + batch_size],
+                                     encoding, vlevel, logger, quick=quick,
+                                     location=location)
+        except:
+            # the cache may hold ids of reasons that were rolled back
+            REASON_CACHE.clear()
+            raise
+    sync_pings(cdata, [node.get('name') for node in nodes], vlevel, logger)
+
     #Clients are consistent
+    return imported
+
+
+def statistics_files(paths):
+    """Return the statistics files in a list of files and statistics.d
+    directories."""
+    rv = []
+    for path in paths:
+        if os.path.isdir(path):
+            rv.extend([os.path.join(path, fname)
+                       for fname in sorted(os.listdir(path))
+                       if fname.endswith('.xml')])
+        else:
+            rv.append(path)
+    return rv
+
+
+def iter_nodes(path):
+    """Yield the Node elements of a statistics file as they are
+    parsed, discarding each one when the next is read."""
+    for (event, node) in iterparse(path, tag='Node'):
+        yield node
+        node.clear()
+        while node.getprevious() is not None:
+            del node.getparent()[0]
+
+
+def import_serialized(data, encoding, vlevel, logger, quick=False,
+                      location=''):
+    """Import a batch of serialized Node elements, retrying failures
+    such as a reason created by another worker at the same time.
+    Returns the number of interactions imported, or None."""
+    nodes = [XML(node) for node in data]
+    for attempt in range(3):
+        try:
+            return import_batch(nodes, encoding, vlevel, logger, quick=quick,
+                                location=location)
+        except:
+            REASON_CACHE.clear()
+            err = sys.exc_info()[1]
+    logger.error("Failed to import statistics of %s: %s" %
+                 (", ".join([node.get('name') for node in nodes]), err))
+    return None
+
+
+def import_worker(batches, results, encoding, vlevel, logger, quick,
+                  location):
+    """Import the batches put on the batches queue until it yields
+    None, and put the number of interactions imported from each on the
+    results queue.  Runs in a child process."""
+    # the connection inherited from the parent must not be shared
+    connection.close()
+    while True:
+        item = batches.get()
+        if item is None:
+            break
+        (fileno, data) = item
+        results.put((fileno, len(data),
+                     import_serialized(data, encoding, vlevel, logger,
+                                       quick=quick, location=location)))
+    connection.close()
+
+
+class ParallelImport(object):
+    """
+    Import statistics files without reading them into memory, spread
+    over jobs worker processes with their own database connections.
+    Each client is always imported by the same worker, batch_size
+    clients per transaction.
+
+    Files that have been imported completely are listed in state_file
+    and skipped when they are imported again.  Interactions that are
+    in the database already are always skipped, so an interrupted
+    import can simply be run again.
+    """
+
+    def __init__(self, encoding, vlevel, logger, jobs=1, quick=False,
+                 location='', batch_size=BATCH_SIZE, state_file=None,
+                 report_interval=10):
+        object.__init__(self)
+        self.encoding = encoding
+        self.vlevel = vlevel
+        self.logger = logger
+        if jobs > 1 and multiprocessing is None:
+            logger.error("Parallel import needs multiprocessing; "
+                         "importing serially")
+            jobs = 1
+        self.jobs = max(jobs, 1)
+        self.quick = quick
+        self.location = location
+        self.batch_size = batch_size
+        self.state_file = state_file
+        self.report_interval = report_interval
+        self.done = set()
+        if state_file and os.path.exists(state_file):
+            self.done = set([line.strip() for line in open(state_file)])
+        # file number -> (path, state line)
+        self.files = []
+        # file number -> number of batches being imported
+        self.outstanding = dict()
+        self.failed = set()
+        self.parsed = set()
+        self.workers = []
+        self.queues = []
+        self.results = None
+        self.clients = 0
+        self.imported = 0
+        self.started = None
+        self.reported = None
+
+    def start(self):
+        """Start the worker processes."""
+        self.started = self.reported = time.time()
+        if self.jobs == 1:
+            return
+        # the workers must open their own connections
+        connection.close()
+        self.results = multiprocessing.Queue()
+        for i in range(self.jobs):
+            queue = multiprocessing.Queue(2)
+            worker = multiprocessing.Process(target=import_worker,
+                                             args=(queue, self.results,
+                                                   self.encoding, self.vlevel,
+                                                   self.logger, self.quick,
+                                                   self.location))
+            worker.daemon = True
+            worker.start()
+            self.queues.append(queue)
+            self.workers.append(worker)
+
+    def submit(self, fileno, worker, data):
+        """Import a batch of serialized Node elements."""
+        self.outstanding[fileno] += 1
+        if self.workers:
+            self.queues[worker].put((fileno, data))
+            self.collect()
+        else:
+            self.finished(fileno, len(data),
+                          import_serialized(data, self.encoding, self.vlevel,
+                                            self.logger, quick=self.quick,
+                                            location=self.location))
+
+    def collect(self, timeout=None):
+        """Handle the results the workers have sent.  With a timeout,
+        wait that long for one.  Returns False if there was none."""
+        try:
+            if timeout is None:
+                item = self.results.get_nowait()
+            else:
+                item = self.results.get(timeout=timeout)
+        except Empty:
+            return False
+        while True:
+            self.finished(*item)
+            try:
+                item = self.results.get_nowait()
+            except Empty:
+                return True
+
+    def finished(self, fileno, clients, imported):
+        """Record the result of a batch."""
+        self.outstanding[fileno] -= 1
+        if imported is None:
+            self.failed.add(fileno)
+        else:
+            self.clients += clients
+            self.imported += imported
+        self.check_file(fileno)
+        if time.time() - self.reported >= self.report_interval:
+            self.report()
+
+    def check_file(self, fileno):
+        """Record a file in the state file once it has been
+        imported."""
+        if fileno not in self.parsed or self.outstanding[fileno]:
+            return
+        (path, stamp) = self.files[fileno]
+        if fileno in self.failed:
+            self.logger.error("Failed to import all statistics in %s" % path)
+            return
+        self.logger.info("Imported %s" % path)
+        if self.state_file:
+            sfile = open(self.state_file, 'a')
+            sfile.write(stamp + "\n")
+            sfile.close()
+
+    def report(self):
+        """Log the progress of the import."""
+        self.reported = time.time()
+        elapsed = max(self.reported - self.started, 0.001)
+        self.logger.info("Imported %d interactions of %d clients in %.0f "
+                         "seconds (%.1f interactions/sec)" %
+                         (self.imported, self.clients, elapsed,
+                          self.imported / elapsed))
+
+    def load(self, path):
+        """Import a statistics file.  Returns the names of its
+        clients."""
+        st = os.stat(path)
+        stamp = "%d %d %s" % (st.st_size, st.st_mtime, os.path.abspath(path))
+        names = set()
+        if stamp in self.done:
+            self.logger.info("Skipping %s, which was imported already" % path)
+            return names
+        fileno = len(self.files)
+        self.files.append((path, stamp))
+        self.outstanding[fileno] = 0
+        pending = [[] for i in range(self.jobs)]
+        try:
+            for node in iter_nodes(path):
+                name = node.get('name')
+                names.add(name)
+                worker = (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % \
+                         self.jobs
+                pending[worker].append(tostring(node))
+                if len(pending[worker]) >= self.batch_size:
+                    self.submit(fileno, worker, pending[worker])
+                    pending[worker] = []
+        except (IOError, XMLSyntaxError):
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to parse %s: %s" % (path, err))
+            self.failed.add(fileno)
+        for (worker, data) in enumerate(pending):
+            if data:
+                self.submit(fileno, worker, data)
+        self.parsed.add(fileno)
+        self.check_file(fileno)
+        return names
+
+    def stop(self):
+        """Wait for the workers to import every batch and exit."""
+        for queue in self.queues:
+            queue.put(None)
+        while sum(self.outstanding.values()):
+            if (not self.collect(timeout=1) and
+                not [w for w in self.workers if w.is_alive()] and
+                not self.collect(timeout=1)):
+                self.logger.error("Import workers exited with %d batches "
+                                  "left" % sum(self.outstanding.values()))
+                break
+        for worker in self.workers:
+            worker.join()
+        self.report()
+
+    def run(self, paths):
+        """Import the statistics in a list of files and directories.
+        Returns the names of their clients and the number of
+        interactions imported."""
+        names = set()
+        self.start()
+        try:
+            for path in statistics_files(paths):
+                names.update(self.load(path))
+        finally:
+            self.stop()
+        return (names, self.imported)
+
+
+def parallel_load_stats(cdata, paths, encoding, vlevel, logger, jobs=1,
+                        quick=False, location='', batch_size=BATCH_SIZE,
+                        state_file=None):
+    """Import the statistics in a list of files and statistics.d
+    directories with a ParallelImport.  Returns the number of
+    interactions imported."""
+    importer = ParallelImport(encoding, vlevel, logger, jobs=jobs,
+                              quick=quick, location=location,
+                              batch_size=batch_size, state_file=state_file)
+    (names, imported) = importer.run(paths)
+    sync_pings(cdata, names, vlevel, logger)
+    return imported
 
 if __name__ == '__main__':
     from sys import argv
@@ -271,13 +734,13 @@ if __name__ == '__main__':
 
     if not statpath:
         try:
-            statpath = "%s/etc/statistics.xml" % cf.get('server', 'repository')
+            statpath = statistics_path(cf.get('server', 'repository'))
         except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
             print("Could not read bcfg2.conf; exiting")
             raise SystemExit(1)
     try:
-        statsdata = XML(open(statpath).read())
-    except (IOError, XMLSyntaxError):
+        statsdata = load_statistics(statpath)
+    except (IOError, OSError, XMLSyntaxError):
         print("StatReports: Failed to parse %s" % (statpath))
         raise SystemExit(1)
 
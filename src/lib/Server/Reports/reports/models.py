@@ -1,9 +1,16 @@
 """Django models for Bcfg2 reports."""
 from django.db import models
 from django.db import connection, transaction
-from django.db.models import Q
+from django.db.models import Count, Max, Q
 from datetime import datetime, timedelta
 from time import strptime
+import sys
+
+# FIXME: Remove when server python dep is 2.5 or greater
+if sys.version_info >= (2, 5):
+    from hashlib import md5
+else:
+    from md5 import md5
 
 KIND_CHOICES = (
     #These are the kinds of config elements
@@ -278,10 +285,40 @@ class Reason(models.Model):
     current_diff = models.TextField(max_length=1280, blank=True)
     is_binary = models.BooleanField(default=False)
     is_sensitive = models.BooleanField(default=False)
+    # digest of all other fields, so reasons can be found with an
+    # indexed lookup instead of comparing every column
+    digest = models.CharField(max_length=32, unique=True, null=True)
 
     def _str_(self):
         return "Reason"
 
+    def save(self, *args, **kwargs):
+        self.digest = Reason.make_digest(self.__dict__)
+        super(Reason, self).save(*args, **kwargs)
+
+    @staticmethod
+    def make_digest(values):
+        '''Return the digest of a dict of reason field values'''
+        digest = md5()
+        for field in Reason._meta.fields:
+            if field.name in ('id', 'digest'):
+                continue
+            value = values.get(field.name)
+            if isinstance(field, models.BooleanField):
+                value = value and '1' or '0'
+            elif value is None:
+                value = ''
+            try:
+                value = value.encode('utf-8')
+            except (AttributeError, UnicodeDecodeError):
+                # binary data
+                pass
+            # prefix each value with its length, so values cannot run
+            # into each other
+            digest.update(("%d:" % len(value)).encode('ascii'))
+            digest.update(value)
+        return digest.hexdigest()
+
     @staticmethod
     @transaction.commit_on_success
     def prune_orphans():
@@ -334,6 +371,182 @@ class Performance(models.Model):
         transaction.set_dirty()
 
 
+class ClientSummaryManager(models.Manager):
+    """Manages client summaries."""
+
+    def latest_ping_status(self, clients=None):
+        """
+        Return a dict of the status of the latest ping of each client.
+
+        Arguments:
+        clients -- list of client ids to limit the query to (default None)
+
+        """
+        cursor = connection.cursor()
+        sql = 'select p.client_id, p.status from reports_ping p, ' + \
+              '(select client_id, MAX(endtime) as latest from reports_ping'
+        params = []
+        if clients is not None:
+            if not clients:
+                return dict()
+            sql = sql + ' where client_id in (%s)' % \
+                  ', '.join(['%s'] * len(clients))
+            params = list(clients)
+        sql = sql + ' GROUP BY client_id) x where p.client_id = x.client_id' + \
+              ' and p.endtime = x.latest'
+        cursor.execute(sql, params)
+        return dict(cursor.fetchall())
+
+    def build(self, interactions):
+        """
+        Return unsaved summaries for a list of interactions.
+
+        Entry counts missing from interactions imported by old versions
+        are counted with a single query.
+        """
+        fields = {TYPE_BAD: 'bad_entries',
+                  TYPE_MODIFIED: 'modified_entries',
+                  TYPE_EXTRA: 'extra_entries'}
+        uncounted = [inter.id for inter in interactions
+                     if min(inter.bad_entries, inter.modified_entries,
+                            inter.extra_entries) < 0]
+        counts = dict()
+        if uncounted:
+            for row in Entries_interactions.objects \
+                    .filter(interaction__in=uncounted) \
+                    .values('interaction', 'type').annotate(count=Count('id')):
+                counts[(row['interaction'], row['type'])] = row['count']
+        pings = self.latest_ping_status()
+
+        summaries = []
+        for inter in interactions:
+            summary = self.model(client=inter.client, interaction=inter,
+                                 timestamp=inter.timestamp, state=inter.state,
+                                 ping=pings.get(inter.client_id, ''))
+            for (type, field) in fields.items():
+                count = getattr(inter, field)
+                if count < 0:
+                    count = counts.get((inter.id, type), 0)
+                setattr(summary, field, count)
+            summaries.append(summary)
+        return summaries
+
+    def current(self, maxdate=None):
+        """
+        Return the summaries of active clients as of a date.
+
+        Without maxdate this reads the summary table in one query.
+        Otherwise the summaries are built from the interaction history,
+        also in a constant number of queries, and are not saved.
+
+        Arguments:
+        maxdate -- datetime object.  Most recent date to pull. (dafault None)
+
+        """
+        if maxdate is None:
+            return list(self.filter(client__expiration__isnull=True)
+                        .select_related('client'))
+        return self.build(list(Interaction.objects
+                               .interaction_per_client(maxdate)
+                               .select_related('client')))
+
+    def record(self, interactions):
+        """Make each interaction the summary of its client, unless the
+        client has a later one already."""
+        summaries = dict()
+        for summary in self.filter(client__in=[i.client_id for i in interactions]):
+            summaries[summary.client_id] = summary
+        new = [i.client_id for i in interactions
+               if i.client_id not in summaries]
+        pings = self.latest_ping_status(new)
+        for inter in interactions:
+            summary = summaries.get(inter.client_id, None)
+            if summary is None:
+                summary = self.model(client_id=inter.client_id,
+                                     ping=pings.get(inter.client_id, ''))
+            elif summary.timestamp > inter.timestamp:
+                continue
+            summary.interaction = inter
+            summary.timestamp = inter.timestamp
+            summary.state = inter.state
+            summary.bad_entries = inter.bad_entries
+            summary.modified_entries = inter.modified_entries
+            summary.extra_entries = inter.extra_entries
+            summary.save()
+
+    @transaction.commit_on_success
+    def rebuild(self):
+        """Recompute all summaries from the interaction history."""
+        self.all().delete()
+        summaries = self.build(list(Interaction.objects
+                                    .interaction_per_client(active_only=False)
+                                    .select_related('client')))
+        if hasattr(self, 'bulk_create'):
+            self.bulk_create(summaries)
+        else:
+            for summary in summaries:
+                summary.save()
+
+
+class ClientSummary(models.Model):
+    """
+    The latest interaction of a client, with its ping status and entry
+    counts.  Kept up to date by the importer so that summary views do
+    not have to search the interaction history.
+    """
+    client = models.OneToOneField(Client, related_name="summary")
+    interaction = models.ForeignKey(Interaction, related_name="summaries")
+    timestamp = models.DateTimeField()
+    state = models.CharField(max_length=32)
+    bad_entries = models.IntegerField(default=0)
+    modified_entries = models.IntegerField(default=0)
+    extra_entries = models.IntegerField(default=0)
+    ping = models.CharField(max_length=4, blank=True)  # status of the latest ping
+
+    objects = ClientSummaryManager()
+
+    def __str__(self):
+        return "%s at %s" % (self.client, self.timestamp)
+
+
+class InteractionRollup(models.Model):
+    """
+    Daily summary of the interactions of a client.  Rollups are kept
+    after retention removes the interactions they summarize.
+    """
+    client = models.ForeignKey(Client, related_name="rollups")
+    date = models.DateField()
+    interactions = models.IntegerField(default=0)
+    clean = models.IntegerField(default=0)  # interactions in a clean state
+    last_state = models.CharField(max_length=32)
+    goodcount = models.IntegerField(default=0)  # sums over all interactions
+    totalcount = models.IntegerField(default=0)
+    bad_entries = models.IntegerField(default=0)
+    modified_entries = models.IntegerField(default=0)
+    extra_entries = models.IntegerField(default=0)
+    runtime_median = models.FloatField(null=True)  # seconds from start to finished
+    runtime_p95 = models.FloatField(null=True)
+    runtime_max = models.FloatField(null=True)
+    rolled_until = models.DateTimeField()  # timestamp of the last interaction added
+
+    def __str__(self):
+        return "%s on %s" % (self.client, self.date)
+
+    def dirty(self):
+        return self.interactions - self.clean
+
+    def percentgood(self):
+        if not self.totalcount == 0:
+            return (self.goodcount / float(self.totalcount)) * 100
+        else:
+            return 0
+
+    class Meta:
+        get_latest_by = 'date'
+        ordering = ['-date']
+        unique_together = ("client", "date")
+
+
 class InternalDatabaseVersion(models.Model):
     """Object that tell us to witch version is the database."""
     version = models.IntegerField()
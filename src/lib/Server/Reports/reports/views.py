@@ -14,6 +14,7 @@ from django.shortcuts import render_to_response, get_object_or_404
 from django.core.urlresolvers import \
         resolve, reverse, Resolver404, NoReverseMatch
 from django.db import connection
+from django.db.models import Min
 
 from Bcfg2.Server.Reports.reports.models import *
 
@@ -160,8 +161,8 @@ def client_index(request, timestamp=None):
       timestamp -- datetime objectto render from
 
     """
-    list = Interaction.objects.interaction_per_client(timestamp).select_related()\
-           .order_by("client__name").all()
+    list = ClientSummary.objects.current(timestamp)
+    list.sort(key=lambda summary: summary.client.name)
 
     return render_to_response('clients/index.html',
                               {'inter_list': list,
@@ -230,9 +231,8 @@ def display_summary(request, timestamp=None):
     """
     Display a summary of the bcfg2 world
     """
-    query = Interaction.objects.interaction_per_client(timestamp).select_related()
-    node_count = query.count()
-    recent_data = query.all()
+    recent_data = ClientSummary.objects.current(timestamp)
+    node_count = len(recent_data)
     if not timestamp:
         timestamp = datetime.now()
 
@@ -246,19 +246,18 @@ def display_summary(request, timestamp=None):
         if timestamp - node.timestamp > timedelta(hours=24):
             collected_data['stale'].append(node)
             # If stale check for uptime
-        try:
-            if node.client.pings.latest().status == 'N':
-                collected_data['pings'].append(node)
-        except Ping.DoesNotExist:
+        if not node.ping:
             collected_data['pings'].append(node)
             continue
-        if node.bad_entry_count() > 0:
+        if node.ping == 'N':
+            collected_data['pings'].append(node)
+        if node.bad_entries > 0:
             collected_data['bad'].append(node)
         else:
             collected_data['clean'].append(node)
-        if node.modified_entry_count() > 0:
+        if node.modified_entries > 0:
             collected_data['modified'].append(node)
-        if node.extra_entry_count() > 0:
+        if node.extra_entries > 0:
             collected_data['extra'].append(node)
 
     # label, header_text, node_list
@@ -294,12 +293,19 @@ def display_summary(request, timestamp=None):
 @timeview
 def display_timing(request, timestamp=None):
     mdict = dict()
-    inters = Interaction.objects.interaction_per_client(timestamp).select_related().all()
-    [mdict.__setitem__(inter, {'name': inter.client.name}) \
-        for inter in inters]
-    for metric in Performance.objects.filter(interaction__in=list(mdict.keys())).all():
-        for i in metric.interaction.all():
-            mdict[i][metric.metric] = metric.value
+    summaries = ClientSummary.objects.current(timestamp)
+    [mdict.__setitem__(summary.interaction_id, {'name': summary.client.name}) \
+        for summary in summaries]
+    metrics = Performance.interaction.through.objects
+    if timestamp:
+        metrics = metrics.filter(interaction__in=list(mdict.keys()))
+    else:
+        metrics = metrics.filter(interaction__summaries__isnull=False)
+    for (inter, metric, value) in metrics.values_list('interaction',
+                                                      'performance__metric',
+                                                      'performance__value'):
+        if inter in mdict:
+            mdict[inter][metric] = value
     return render_to_response('displays/timing.html',
                               {'metrics': list(mdict.values()),
                                'timestamp': timestamp},
@@ -377,6 +383,19 @@ def render_history_view(request, template='clients/history.html', **kwargs):
     else:
         context['entry_list'] = iquery.all()
 
+    # After the last page, show the daily rollups of interactions that
+    # have been removed by retention
+    if (client and not kwargs.get('state') and not kwargs.get('server') and
+        (max_results == 0 or page >= context.get('total_pages', 1))):
+        rollups = client.rollups.all()
+        oldest = Interaction.objects.filter(client=client) \
+                 .aggregate(Min('timestamp'))['timestamp__min']
+        if oldest:
+            rollups = rollups.filter(rolled_until__lt=oldest)
+        if entry_max:
+            rollups = rollups.filter(date__lte=entry_max.date())
+        context['rollup_list'] = rollups
+
     return render_to_response(template, context,
                 context_instance=RequestContext(request))
 
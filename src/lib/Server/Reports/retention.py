@@ -0,0 +1,225 @@
+"""
+Retention of interaction history in the reports database.
+
+Interactions older than the retention window are added to daily
+per-client rollups and then deleted, along with the entries, reasons
+and performance data that only they used.  Deletes are done in small
+chunks, each in its own transaction, so that table locks are only
+held briefly.
+"""
+import Bcfg2.Server.Reports.settings
+
+from datetime import date, datetime, time, timedelta
+import logging
+import math
+
+from django.db import connection, transaction
+from django.db.models import Min
+from Bcfg2.Server.Reports.reports.models import Interaction, \
+                InteractionRollup, Performance
+
+logger = logging.getLogger('Bcfg2.Server.Reports.Retention')
+
+# rows handled per query or transaction; below the sqlite limit of
+# 999 parameters
+CHUNK_SIZE = 500
+
+
+def chunks(items, size=CHUNK_SIZE):
+    """Split a list into lists of at most size items."""
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    rank = int(math.ceil(fraction * len(values)))
+    return values[min(len(values), max(rank, 1)) - 1]
+
+
+def merge(old, old_count, new, new_count):
+    """Combine two statistics weighted by the number of values they
+    describe.  Percentiles cannot be merged exactly, so this is an
+    approximation for days that are rolled up in more than one run."""
+    if old is None:
+        return new
+    if new is None:
+        return old
+    return (old * old_count + new * new_count) / float(old_count + new_count)
+
+
+def runtimes(ids):
+    """Return a dict of the run time of each interaction in ids, from
+    its start and finished OpStamps."""
+    stamps = dict()
+    through = Performance.interaction.through
+    for chunk in chunks(ids):
+        for (inter, metric, value) in through.objects \
+                .filter(interaction__in=chunk,
+                        performance__metric__in=['start', 'finished']) \
+                .values_list('interaction', 'performance__metric',
+                             'performance__value'):
+            stamps.setdefault(inter, dict())[metric] = float(value)
+    rv = dict()
+    for (inter, mdict) in stamps.items():
+        if 'start' in mdict and 'finished' in mdict:
+            rv[inter] = mdict['finished'] - mdict['start']
+    return rv
+
+
+@transaction.commit_on_success
+def rollup_day(day, cutoff):
+    """
+    Add the interactions of a day that are older than cutoff to the
+    rollups of their clients.  Interactions that a rollup already
+    covers are skipped.  Returns the number of interactions added.
+    """
+    start = datetime.combine(day, time())
+    end = min(start + timedelta(days=1), cutoff)
+    rollups = dict()
+    for rollup in InteractionRollup.objects.filter(date=day):
+        rollups[rollup.client_id] = rollup
+
+    rows = dict()
+    for row in Interaction.objects.filter(timestamp__gte=start,
+                                          timestamp__lt=end) \
+            .order_by('timestamp') \
+            .values_list('id', 'client', 'timestamp', 'state', 'goodcount',
+                         'totalcount', 'bad_entries', 'modified_entries',
+                         'extra_entries'):
+        client = row[1]
+        if client in rollups and row[2] <= rollups[client].rolled_until:
+            continue
+        rows.setdefault(client, []).append(row)
+    if not rows:
+        return 0
+    times = runtimes([row[0] for crows in rows.values() for row in crows])
+
+    added = 0
+    for (client, crows) in rows.items():
+        rollup = rollups.get(client, None)
+        if rollup is None:
+            rollup = InteractionRollup(client_id=client, date=day)
+        ctimes = sorted([times[row[0]] for row in crows if row[0] in times])
+        old_count = rollup.interactions
+        for (iid, client, timestamp, state, good, total, bad, modified,
+             extra) in crows:
+            rollup.interactions += 1
+            if state == 'clean':
+                rollup.clean += 1
+            rollup.goodcount += good
+            rollup.totalcount += total
+            # counts are -1 for interactions imported by old versions
+            rollup.bad_entries += max(bad, 0)
+            rollup.modified_entries += max(modified, 0)
+            rollup.extra_entries += max(extra, 0)
+        rollup.last_state = crows[-1][3]
+        rollup.rolled_until = crows[-1][2]
+        if ctimes:
+            rollup.runtime_median = merge(rollup.runtime_median, old_count,
+                                          percentile(ctimes, 0.5), len(crows))
+            rollup.runtime_p95 = merge(rollup.runtime_p95, old_count,
+                                       percentile(ctimes, 0.95), len(crows))
+            if rollup.runtime_max is None or rollup.runtime_max < ctimes[-1]:
+                rollup.runtime_max = ctimes[-1]
+        rollup.save()
+        added += len(crows)
+    return added
+
+
+def prune(cursor, table, link_table, column, ids):
+    """Delete the rows of table with the given ids that no row of
+    link_table refers to any more."""
+    for chunk in chunks(ids):
+        cursor.execute('delete from %s where id in (%s) and not exists '
+                       '(select 1 from %s l where l.%s = %s.id)' %
+                       (table, ', '.join(['%s'] * len(chunk)),
+                        link_table, column, table), chunk)
+
+
+@transaction.commit_on_success
+def delete_interactions(ids):
+    """Delete interactions, and the reasons, entries and performance
+    data that only they used."""
+    cursor = connection.cursor()
+    marks = ', '.join(['%s'] * len(ids))
+    cursor.execute('select distinct performance_id from '
+                   'reports_performance_interaction where interaction_id in (%s)'
+                   % marks, ids)
+    perfs = [row[0] for row in cursor.fetchall()]
+    cursor.execute('select distinct reason_id, entry_id from '
+                   'reports_entries_interactions where interaction_id in (%s)'
+                   % marks, ids)
+    rows = cursor.fetchall()
+    reasons = list(set([row[0] for row in rows]))
+    entries = list(set([row[1] for row in rows]))
+
+    cursor.execute('delete from reports_entries_interactions '
+                   'where interaction_id in (%s)' % marks, ids)
+    cursor.execute('delete from reports_performance_interaction '
+                   'where interaction_id in (%s)' % marks, ids)
+    cursor.execute('delete from reports_interaction where id in (%s)' % marks,
+                   ids)
+    prune(cursor, 'reports_performance', 'reports_performance_interaction',
+          'performance_id', perfs)
+    prune(cursor, 'reports_reason', 'reports_entries_interactions',
+          'reason_id', reasons)
+    prune(cursor, 'reports_entries', 'reports_entries_interactions',
+          'entry_id', entries)
+    transaction.set_dirty()
+
+
+@transaction.commit_on_success
+def delete_rollups(ids):
+    """Delete rollups."""
+    InteractionRollup.objects.filter(id__in=ids).delete()
+
+
+def retain(days, rollup_days=None):
+    """
+    Roll up and delete interactions more than days days old, and
+    delete rollups more than rollup_days days old.  The latest
+    interaction of each client is always kept.
+
+    Returns the number of interactions rolled up, of interactions
+    deleted and of rollups deleted.
+    """
+    cutoff = datetime.combine(date.today() - timedelta(days=days), time())
+    rolled = 0
+    first = Interaction.objects.filter(timestamp__lt=cutoff) \
+            .aggregate(Min('timestamp'))['timestamp__min']
+    if first is not None:
+        day = first.date()
+        while day < cutoff.date():
+            rolled += rollup_day(day, cutoff)
+            day += timedelta(days=1)
+    logger.info("Rolled up %d interactions before %s" % (rolled, cutoff))
+
+    # a client's latest interaction is its summary and current
+    # interaction
+    old = Interaction.objects.filter(timestamp__lt=cutoff) \
+          .exclude(summaries__isnull=False) \
+          .exclude(parent_client__isnull=False)
+    deleted = 0
+    while True:
+        ids = list(old.values_list('id', flat=True)[:CHUNK_SIZE])
+        if not ids:
+            break
+        delete_interactions(ids)
+        deleted += len(ids)
+        logger.debug("Deleted %d interactions" % deleted)
+    logger.info("Deleted %d interactions before %s" % (deleted, cutoff))
+
+    rollups_deleted = 0
+    if rollup_days:
+        old = InteractionRollup.objects.filter(
+            date__lt=date.today() - timedelta(days=rollup_days))
+        while True:
+            ids = list(old.values_list('id', flat=True)[:CHUNK_SIZE])
+            if not ids:
+                break
+            delete_rollups(ids)
+            rollups_deleted += len(ids)
+        logger.info("Deleted %d rollups" % rollups_deleted)
+    return (rolled, deleted, rollups_deleted)
@@ -5,7 +5,7 @@ import django.core.management
 import logging
 import traceback
 from Bcfg2.Server.Reports.reports.models import InternalDatabaseVersion, \
-                TYPE_BAD, TYPE_MODIFIED, TYPE_EXTRA
+                ClientSummary, Reason, TYPE_BAD, TYPE_MODIFIED, TYPE_EXTRA
 logger = logging.getLogger('Bcfg2.Server.Reports.UpdateFix')
 
 
@@ -80,6 +80,46 @@ def _populate_interaction_entry_counts():
     cursor.close()
 
 
+def _populate_client_summary():
+    '''Build the client summary table from existing interactions'''
+    ClientSummary.objects.rebuild()
+
+
+def _populate_reason_digests():
+    '''Compute the digest of every reason, merge duplicate reasons
+    and index the digests'''
+    cursor = connection.cursor()
+    cursor.execute('alter table reports_reason add digest varchar(32) null')
+    digests = dict()
+    duplicates = []
+    last = 0
+    while True:
+        reasons = list(Reason.objects.filter(id__gt=last).order_by('id')
+                       .values('id', *[field.name
+                                       for field in Reason._meta.fields
+                                       if field.name not in ('id', 'digest')])
+                       [:1000])
+        if not reasons:
+            break
+        updates = []
+        for reason in reasons:
+            digest = Reason.make_digest(reason)
+            if digest in digests:
+                duplicates.append((digests[digest], reason['id']))
+            else:
+                digests[digest] = reason['id']
+                updates.append((digest, reason['id']))
+        cursor.executemany('update reports_reason set digest=%s where id=%s',
+                           updates)
+        last = reasons[-1]['id']
+    cursor.executemany('update reports_entries_interactions set reason_id=%s '
+                       'where reason_id=%s', duplicates)
+    cursor.executemany('delete from reports_reason where id=%s',
+                       [(dup,) for (orig, dup) in duplicates])
+    cursor.execute('create unique index reports_reason_digest '
+                   'on reports_reason (digest)')
+
+
 # be sure to test your upgrade query before reflecting the change in the models
 # the list of function and sql command to do should go here
 _fixes = [_merge_database_table_entries,
@@ -103,6 +143,8 @@ _fixes = [_merge_database_table_entries,
           _interactions_constraint_or_idx,
           'alter table reports_reason add is_binary bool NOT NULL default False;',
           'alter table reports_reason add is_sensitive bool NOT NULL default False;',
+          _populate_client_summary,
+          _populate_reason_digests,
 ]
 
 # this will calculate the last possible version of the database
@@ -0,0 +1,83 @@
+import difflib
+import os
+import shutil
+import tempfile
+from subprocess import Popen, PIPE
+
+from Bcfg2.Server.Plugins.Cfg import apply_diff, PatchError
+
+base = ''.join(["line %d\n" % i for i in range(1, 31)])
+
+
+def make_diff(old, new):
+    rv = []
+    for line in difflib.unified_diff(old.splitlines(True),
+                                     new.splitlines(True),
+                                     'a/file', 'b/file'):
+        rv.append(line)
+        if not line.endswith('\n'):
+            rv.append("\n\\ No newline at end of file\n")
+    return ''.join(rv)
+
+
+def replace(data, old, new):
+    return data.replace(old, new, 1)
+
+
+class test_apply_diff(object):
+    """Compare apply_diff with patch -u -f, which Cfg used to run."""
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def patch(self, data, diff):
+        """Return the exit status of patch -u -f and the patched
+        data."""
+        fname = os.path.join(self.path, 'file')
+        open(fname, 'w').write(data)
+        proc = Popen(["patch", "-u", "-f", fname],
+                     stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        proc.communicate(input=diff.encode('ascii'))
+        return (proc.wait(), open(fname).read())
+
+    def check(self, data, diff):
+        status, expected = self.patch(data, diff)
+        assert status == 0
+        assert apply_diff(data, diff) == expected
+
+    def test_change(self):
+        new = replace(replace(base, "line 3\n", "three\n"),
+                      "line 20\n", "twenty\nmore\n")
+        self.check(base, make_diff(base, new))
+
+    def test_offset(self):
+        """Hunks apply where their context is found, even if lines
+        were added or removed before them."""
+        diff = make_diff(base, replace(base, "line 15\n", "fifteen\n"))
+        self.check("first\nsecond\n" + base, diff)
+        self.check(replace(base, "line 2\n", ""), diff)
+
+    def test_fuzz(self):
+        """Hunks whose outer context lines do not match apply with
+        fuzz."""
+        diff = make_diff(base, replace(base, "line 15\n", "fifteen\n"))
+        self.check(replace(base, "line 12\n", "twelve\n"), diff)
+
+    def test_end_of_file(self):
+        data = base + "last"
+        self.check(data, make_diff(data, data + " line\n"))
+        self.check(data, make_diff(data, replace(data, "line 29\n", "")))
+
+    def test_failure(self):
+        """A hunk that does not apply raises PatchError, where patch
+        fails."""
+        diff = make_diff(base, replace(base, "line 15\n", "fifteen\n"))
+        data = replace(base, "line 15\n", "something else\n")
+        assert self.patch(data, diff)[0] != 0
+        try:
+            apply_diff(data, diff)
+            assert False
+        except PatchError:
+            pass
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+
+from Bcfg2.Bcfg2Py3k import Empty
+from Bcfg2.Server.Journal import JournalQueue
+
+
+class test_journal(object):
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def drain(self, queue):
+        rv = []
+        while True:
+            try:
+                rv.append(queue.get_nowait())
+            except Empty:
+                return rv
+
+    def test_fifo(self):
+        queue = JournalQueue(self.path)
+        for data in [b'one', b'two', b'three']:
+            queue.put(data)
+        assert [data for _, data in self.drain(queue)] == \
+               [b'one', b'two', b'three']
+        assert queue.empty()
+        queue.close()
+
+    def test_sync_on_put(self):
+        """With sync_interval 0, put syncs without deadlocking."""
+        queue = JournalQueue(self.path, sync_interval=0)
+        queue.put(b'one')
+        assert not queue.unsynced
+        assert queue.get_nowait()[1] == b'one'
+        queue.close()
+
+    def test_recovery(self):
+        """Records that were not acknowledged are returned again after
+        the journal is reopened."""
+        queue = JournalQueue(self.path)
+        for data in [b'one', b'two', b'three']:
+            queue.put(data)
+        pos = queue.get_nowait()[0]
+        queue.ack(pos)
+        queue.get_nowait()
+        queue.close()
+
+        queue = JournalQueue(self.path)
+        assert [data for _, data in self.drain(queue)] == [b'two', b'three']
+        queue.put(b'four')
+        assert queue.get_nowait()[1] == b'four'
+        queue.close()
+
+    def test_torn_record(self):
+        """An incomplete record at the end of the journal is
+        discarded when it is opened."""
+        queue = JournalQueue(self.path)
+        queue.put(b'one')
+        queue.put(b'two')
+        queue.close()
+        segment = queue.segment_path(queue.write_segment)
+        sfile = open(segment, 'r+b')
+        sfile.truncate(os.path.getsize(segment) - 1)
+        sfile.close()
+
+        queue = JournalQueue(self.path)
+        assert [data for _, data in self.drain(queue)] == [b'one']
+        queue.put(b'three')
+        assert queue.get_nowait()[1] == b'three'
+        queue.close()
+
+    def test_ack_removes_segments(self):
+        """Segments are removed once every record in them has been
+        acknowledged."""
+        queue = JournalQueue(self.path, segment_size=32)
+        for i in range(6):
+            queue.put(('record %d' % i).encode('ascii'))
+        assert len(queue.segments()) > 1
+        records = self.drain(queue)
+        assert len(records) == 6
+        queue.ack(records[-1][0])
+        assert queue.segments() == [queue.write_segment]
+        queue.close()
+
+        queue = JournalQueue(self.path, segment_size=32)
+        assert queue.empty()
+        queue.close()
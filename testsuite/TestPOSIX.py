@@ -0,0 +1,157 @@
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+import lxml.etree
+
+from Bcfg2.Client.Tools.POSIX import DigestCache, POSIX
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+old = time.time() - 3600
+
+
+def write(path, data, mtime=old):
+    open(path, 'w').write(data)
+    os.utime(path, (mtime, mtime))
+
+
+def digest(data):
+    return sha1(data.encode('ascii')).hexdigest()
+
+
+class test_digest_cache(object):
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.cachefile = os.path.join(self.path, 'cache', 'digests')
+        self.file = os.path.join(self.path, 'file')
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def test_persist(self):
+        """Digests are saved to a private file, one line per file, and
+        used again by the next run."""
+        write(self.file, 'data')
+        cache = DigestCache(self.cachefile)
+        assert cache.digest(self.file) == digest('data')
+        cache.save()
+        assert stat.S_IMODE(os.stat(self.cachefile).st_mode) == \
+               stat.S_IRUSR | stat.S_IWUSR
+        lines = open(self.cachefile).readlines()
+        assert len(lines) == 1
+        ondisk = os.stat(self.file)
+        (inode, mtime, size, sha, path) = lines[0].rstrip('\n').split(' ', 4)
+        assert int(inode) == ondisk.st_ino
+        assert float(mtime) == ondisk.st_mtime
+        assert int(size) == 4
+        assert sha == digest('data')
+        assert path == self.file
+
+        cache = DigestCache(self.cachefile)
+        assert cache.digests[self.file][3] == digest('data')
+        # an unchanged file is not read again
+        os.chmod(self.file, 0)
+        if os.getuid() != 0:
+            assert cache.digest(self.file) == digest('data')
+        cache.save()
+        assert not cache.dirty
+
+    def test_corrupt(self):
+        """A cache file that cannot be parsed is ignored."""
+        os.makedirs(os.path.dirname(self.cachefile))
+        open(self.cachefile, 'w').write("garbage\n")
+        assert DigestCache(self.cachefile).digests == {}
+
+    def test_stale(self):
+        """A digest is computed again when the inode, mtime or size
+        of its file changes."""
+        write(self.file, 'data')
+        cache = DigestCache(self.cachefile)
+        cache.digest(self.file)
+        # same size, other mtime
+        write(self.file, 'more', old + 10)
+        assert cache.digest(self.file) == digest('more')
+        # same mtime, other size
+        write(self.file, 'longer', old + 10)
+        assert cache.digest(self.file) == digest('longer')
+        # same mtime and size, other inode
+        write(self.file + '.new', 'other!', old + 10)
+        os.rename(self.file + '.new', self.file)
+        assert cache.digest(self.file) == digest('other!')
+
+    def test_recent(self):
+        """Files modified in the last two seconds are not cached,
+        since they could change again within the same mtime."""
+        write(self.file, 'data', time.time())
+        cache = DigestCache(self.cachefile)
+        assert cache.digest(self.file) == digest('data')
+        assert self.file not in cache.digests
+        write(self.file, 'data', time.time() - 3)
+        cache.digest(self.file)
+        assert self.file in cache.digests
+
+    def test_newline(self):
+        """Paths containing a newline are not cached, since they
+        cannot be saved one per line."""
+        fname = os.path.join(self.path, 'two\nlines')
+        write(fname, 'data')
+        cache = DigestCache(self.cachefile)
+        assert cache.digest(fname) == digest('data')
+        assert cache.digests == {}
+        cache.save()
+        assert not os.path.exists(self.cachefile)
+
+    def test_not_regular(self):
+        assert DigestCache(self.cachefile).digest(self.path) is None
+
+
+class test_content_unchanged(object):
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.file = os.path.join(self.path, 'file')
+        write(self.file, 'data')
+        os.chmod(self.file, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP |
+                 stat.S_IROTH)
+        setup = dict(interactive=True, encoding='ascii')
+        self.posix = POSIX(logging.getLogger('posix'), setup, [])
+        self.posix.digests = DigestCache()
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def entry(self, sha=None, perms='0644'):
+        ondisk = os.stat(self.file)
+        entry = lxml.etree.Element('Path', name=self.file, type='file',
+                                   perms=perms, owner=str(ondisk.st_uid),
+                                   group=str(ondisk.st_gid))
+        entry.text = 'data'
+        if sha:
+            entry.set('sha1', sha)
+        return entry
+
+    def test_content_unchanged(self):
+        assert self.posix._content_unchanged(self.entry(digest('data')))
+        assert not self.posix._content_unchanged(self.entry(digest('x')))
+        assert not self.posix._content_unchanged(self.entry())
+        entry = self.entry(digest('data'))
+        os.unlink(self.file)
+        assert not self.posix._content_unchanged(entry)
+
+    def test_verify(self):
+        """Verifyfile gives the same result and prompt whether or not
+        the digest lets it skip the comparison."""
+        for perms in ['0644', '0600']:
+            entries = [self.entry(digest('data'), perms),
+                       self.entry(perms=perms)]
+            results = [self.posix.Verifyfile(entry, []) for entry in entries]
+            assert results[0] == results[1] == (perms == '0644')
+            assert entries[0].get('qtext') == entries[1].get('qtext')
+        assert entries[0].get('qtext').endswith(
+            "Install Path %s: (y/N): " % self.file)
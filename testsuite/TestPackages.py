@@ -0,0 +1,176 @@
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from Bcfg2.Server.Plugins.Packages.Source import Source, StringTable, \
+     DependencyTable
+
+
+class repo_handler(BaseHTTPRequestHandler):
+    """Serve the files in the server's repo dict with an ETag, and
+    record the conditional headers of each request."""
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('If-None-Match'))
+        data = self.server.repo[self.path]
+        etag = '"%d"' % len(data)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class test_source(Source):
+    """A Source with one file, whose read_files fails unless the
+    file holds the expected data."""
+    def __init__(self, basepath, url):
+        self.basepath = basepath
+        self.url = url
+        self.cachefile = os.path.join(basepath, 'cache')
+        self.read = 0
+
+    def get_urls(self):
+        return [self.url]
+    urls = property(get_urls)
+
+    def read_files(self):
+        if open(self.escape_url(self.url), 'rb').read() != b'good':
+            raise ValueError
+        self.read += 1
+
+
+class test_update(object):
+    def setup(self):
+        self.basepath = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), repo_handler)
+        self.server.repo = {'/primary.xml': b'good'}
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/primary.xml' % self.server.server_port
+        self.source = test_source(self.basepath, self.url)
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.basepath)
+
+    def test_conditional(self):
+        """An unchanged file is not downloaded again."""
+        assert self.source.update_url(self.url)
+        assert not self.source.update_url(self.url)
+        assert self.server.requests == [None, '"4"']
+
+    def test_corrupt_file(self):
+        """A file that cannot be read is downloaded again even though
+        the server says it is unchanged."""
+        assert self.source.update_url(self.url)
+        open(self.source.escape_url(self.url), 'wb').write(b'bad!')
+        self.source.setup_data()
+        assert self.server.requests == [None, None]
+        assert self.source.read == 1
+        assert open(self.source.escape_url(self.url), 'rb').read() == b'good'
+
+
+deps = {'global': {'foo': ['libc', 'bar'], 'bar': ['libc'], 'empty': []},
+        'x86_64': {'foo': ['libc', 'lib64'], 'baz': ['bar']}}
+provides = {'global': {'libc': ['glibc'], 'mta': ['postfix', 'exim']},
+            'x86_64': {'mta': ['sendmail'], 'lib64': ['glibc']}}
+
+
+class metadata(object):
+    def __init__(self, groups):
+        self.hostname = 'client'
+        self.groups = groups
+
+
+class table_source(Source):
+    """A Source with fixed deps and provides, cached like Apt."""
+    def __init__(self, basepath):
+        self.basepath = basepath
+        self.arches = ['x86_64']
+        self.cachefile = os.path.join(basepath, 'cache')
+        self.deps = dict([(arch, dict(data)) for arch, data in deps.items()])
+        self.provides = dict([(arch, dict(data))
+                              for arch, data in provides.items()])
+        self.read = 0
+
+    def save_state(self):
+        pickle.dump((self.deps, self.provides), open(self.cachefile, 'wb'), 2)
+
+    def load_state(self):
+        self.deps, self.provides = pickle.load(open(self.cachefile, 'rb'))
+
+    def read_files(self):
+        self.read += 1
+
+
+class test_tables(object):
+    def setup(self):
+        self.basepath = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.basepath)
+
+    def test_pickle(self):
+        """Tables survive pickling, and still share their
+        StringTable."""
+        strings = StringTable()
+        tables = (DependencyTable(deps['global'], strings),
+                  DependencyTable(provides['global'], strings))
+        dtable, ptable = pickle.loads(pickle.dumps(tables, 2))
+        assert dtable.strings is ptable.strings
+        for table, data in [(dtable, deps['global']),
+                            (ptable, provides['global'])]:
+            assert sorted(table.keys()) == sorted(data.keys())
+            for key, values in data.items():
+                assert list(table[key]) == values
+            assert table.get('missing') is None
+        # names can still be added once the reverse index is rebuilt
+        assert strings.add('libc') == dtable.strings.add('libc')
+        assert dtable.strings.add('new') == len(strings.strings)
+
+    def test_compact_old_cache(self):
+        """A cache file holding plain dicts is compacted when it is
+        loaded, without reading the source's files."""
+        source = table_source(self.basepath)
+        source.save_state()
+        source = table_source(self.basepath)
+        source.setup_data()
+        assert source.read == 0
+        strings = source.deps['global'].strings
+        for table in [source.deps, source.provides]:
+            for data in table.values():
+                assert isinstance(data, DependencyTable)
+                assert data.strings is strings
+
+    def test_lookups(self):
+        """get_deps, get_provides and get_vpkgs return the same with
+        tables as with dicts."""
+        old = table_source(self.basepath)
+        new = table_source(self.basepath)
+        new.compact()
+        names = ['foo', 'bar', 'baz', 'empty', 'libc', 'mta', 'lib64',
+                 'missing']
+        for groups in [[], ['x86_64']]:
+            meta = metadata(groups)
+            for name in names:
+                assert list(new.get_deps(meta, name)) == \
+                       list(old.get_deps(meta, name))
+                assert list(new.get_provides(meta, name)) == \
+                       list(old.get_provides(meta, name))
+            assert new.get_vpkgs(meta) == old.get_vpkgs(meta)
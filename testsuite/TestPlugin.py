@@ -1,9 +1,18 @@
 import gamin
+import logging
 import lxml.etree
 import os
+import shutil
+import tempfile
+import threading
+import time
 
 import Bcfg2.Server.Core
-from Bcfg2.Server.Plugin import EntrySet
+from Bcfg2.Bcfg2Py3k import Empty
+from Bcfg2.Server.FileMonitor import Event
+from Bcfg2.Server.Journal import JournalQueue
+from Bcfg2.Server.Plugin import EntrySet, PluginExecutionError, \
+     ThreadedStatistics
 
 
 class es_testtype(object):
@@ -120,3 +129,173 @@ class test_entry_set(object):
         i = open("%s/info.xml" % dir, 'w')
         i.write('<FileInfo><Info owner="root" group="other" perms="0600" /></FileInfo>\n')
         i.close
+
+
+class es_matchtype(object):
+    def __init__(self, name, specific, encoding):
+        self.name = name
+        self.specific = specific
+
+    def handle_event(self, event):
+        pass
+
+
+class test_entry_set_matching(object):
+    def setup(self):
+        self.es = EntrySet('template', '/tmp', es_matchtype, 'UTF-8')
+        for fname in ['template', 'template.G10_base', 'template.G20_debian',
+                      'template.G10_debian', 'template.G30_other',
+                      'template.H_testhost', 'template.H_otherhost']:
+            self.event(fname, 'exists')
+
+    def event(self, fname, action):
+        self.es.handle_event(Event(1, fname, action))
+
+    def names(self, entries):
+        return [ent.name.split('/')[-1] for ent in entries]
+
+    def test_get_matching(self):
+        """Matching entries are ordered host, group by priority and
+        name, then the entry for all clients."""
+        assert self.names(self.es.get_matching(metadata('testhost'))) == \
+               ['template.H_testhost', 'template.G20_debian',
+                'template.G10_base', 'template.G10_debian', 'template']
+
+    def test_best_matching(self):
+        """best_matching returns the first entry of get_matching."""
+        es = self.es
+        assert es.best_matching(metadata('testhost')).name.endswith(
+            'template.H_testhost')
+        assert es.best_matching(metadata('newhost')).name.endswith(
+            'template.G20_debian')
+        self.event('template.G20_debian', 'deleted')
+        assert es.best_matching(metadata('newhost')).name.endswith(
+            'template.G10_base')
+        self.event('template.G10_base', 'deleted')
+        self.event('template.G10_debian', 'deleted')
+        assert es.best_matching(metadata('newhost')).name.endswith(
+            '/template')
+        self.event('template', 'deleted')
+        try:
+            es.best_matching(metadata('newhost'))
+            assert False
+        except PluginExecutionError:
+            pass
+        self.event('template.G10_base', 'created')
+        assert es.best_matching(metadata('newhost')).name.endswith(
+            'template.G10_base')
+
+
+class stats_core(object):
+    def __init__(self, worker=None, workers=None):
+        self.terminate = threading.Event()
+        self.worker = worker
+        self.workers = workers
+
+    def build_metadata(self, hostname):
+        return metadata(hostname)
+
+
+class stats_plugin(ThreadedStatistics):
+    """A ThreadedStatistics plugin whose handle_statistics_batch
+    fails the given number of times."""
+    max_retries = 2
+    retry_delay = 0.01
+
+    def __init__(self, core, datastore, failures=0):
+        self.core = core
+        self.logger = logging.getLogger('stats_plugin')
+        self.failures = failures
+        self.handled = []
+        ThreadedStatistics.__init__(self, core, datastore)
+
+    def handle_statistics_batch(self, batch):
+        if self.failures:
+            self.failures -= 1
+            raise ValueError
+        self.handled.extend([meta.hostname for (meta, _) in batch])
+
+
+class test_threaded_statistics(object):
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = os.path.join(self.path, 'etc', 'stats_plugin.journal')
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def start(self, core, failures=0, clients=['one']):
+        plugin = stats_plugin(core, self.path, failures)
+        for client in clients:
+            plugin.process_statistics(metadata(client),
+                                      lxml.etree.Element('Statistics'))
+        return plugin
+
+    def stop(self, plugin, handled=0):
+        """Wait until plugin has handled that many interactions, then
+        shut it down."""
+        for _ in range(500):
+            if len(plugin.handled) >= handled:
+                break
+            time.sleep(0.01)
+        plugin.core.terminate.set()
+        plugin.join()
+
+    def queued(self, path):
+        queue = JournalQueue(path)
+        rv = []
+        while True:
+            try:
+                rv.append(queue.get_nowait()[1])
+            except Empty:
+                queue.close()
+                return rv
+
+    def test_retry(self):
+        """A batch that fails is retried, and acknowledged once it was
+        handled."""
+        plugin = self.start(stats_core(), failures=2)
+        self.stop(plugin, 1)
+        assert plugin.handled == ['one']
+        assert self.queued(self.journal) == []
+        assert not os.path.exists(self.journal + '.failed')
+
+    def test_failed(self):
+        """A batch that keeps failing is moved to the failed
+        journal."""
+        plugin = self.start(stats_core(), failures=3)
+        for _ in range(500):
+            if os.path.exists(self.journal + '.failed'):
+                break
+            time.sleep(0.01)
+        self.stop(plugin)
+        assert plugin.handled == []
+        assert self.queued(self.journal) == []
+        assert len(self.queued(self.journal + '.failed')) == 1
+
+    def test_shutdown(self):
+        """A batch that has not been handled when the server shuts
+        down is kept in the journal."""
+        stats_plugin.retry_delay = 10
+        try:
+            plugin = self.start(stats_core(), failures=1)
+            time.sleep(0.1)
+            self.stop(plugin)
+        finally:
+            stats_plugin.retry_delay = 0.01
+        assert plugin.handled == []
+        assert len(self.queued(self.journal)) == 1
+
+    def test_stray_journals(self):
+        """The first worker takes over the journals of slots that no
+        longer exist."""
+        for (slot, client) in [(1, 'one'), (3, 'three')]:
+            core = stats_core(slot, 4)
+            # only queue the interaction
+            core.terminate.set()
+            self.start(core, clients=[client]).join()
+        plugin = self.start(stats_core(0, 2), clients=[])
+        self.stop(plugin, 1)
+        assert plugin.handled == ['three']
+        assert not os.path.exists(self.journal[:-8] + '-3.journal')
+        assert len(self.queued(self.journal[:-8] + '-1.journal')) == 1
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+
+from Bcfg2.Server.Plugins.Probes import stores, XMLProbeStore, \
+     ClientProbeDataSet, ProbeData
+
+
+def probe_data(values, timestamp=1000):
+    probed = ClientProbeDataSet(timestamp=timestamp)
+    for name, value in values.items():
+        probed[name] = ProbeData(value)
+        probed.hashes[name] = "hash-%s" % name
+    return probed
+
+
+class test_probe_stores(object):
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def check_store(self, cls):
+        store = cls(self.path)
+        assert not store.exists()
+        store.save({'one': (probe_data({'os': 'debian'}), ['g1', 'g2']),
+                    'two': (probe_data({'os': 'redhat', 'arch': 'x86_64'}),
+                            [])})
+        assert store.exists()
+        # saving a client keeps the others
+        store.save({'one': (probe_data({'os': 'ubuntu'}, 2000), ['g2'])})
+
+        store = cls(self.path)
+        data = store.load()
+        assert sorted(data.keys()) == ['one', 'two']
+        probed, groups = data['one']
+        assert str(probed['os']) == 'ubuntu'
+        assert probed.hashes['os'] == 'hash-os'
+        assert float(probed.timestamp) == 2000
+        assert groups == ['g2']
+        probed, groups = store.load('two')['two']
+        assert sorted(probed.keys()) == ['arch', 'os']
+        assert groups == []
+        assert store.load('three') == {}
+
+    def test_stores(self):
+        for cls in stores.values():
+            self.check_store(cls)
+            self.teardown()
+            self.setup()
+
+    def test_xml_changed(self):
+        """XMLProbeStore notices when another process wrote
+        probed.xml, and merges what both wrote."""
+        one = XMLProbeStore(self.path)
+        two = XMLProbeStore(self.path)
+        one.save({'one': (probe_data({'os': 'debian'}), [])})
+        assert one.changed('probed.xml') == []
+        two.save({'two': (probe_data({'os': 'redhat'}), [])})
+        assert one.changed('probed.xml') is None
+        assert two.changed('probed.xml') == []
+        assert sorted(one.load().keys()) == ['one', 'two']
+        assert not [fname for fname in os.listdir(self.path)
+                    if fname.endswith('.new')]